@@ -7,7 +7,7 @@ Created on Apr 20, 2016
 """
 from ConfigParser import SafeConfigParser
 from os import environ, getenv
-from random import choice
+from random import shuffle
 from os.path import dirname, abspath, join as oPjoin
 #import sys
 from DmpWorkflow import version as DAMPE_VERSION
@@ -41,7 +41,28 @@ __myDefaults = {
     "ratio_mem": "1.0",
     "ratio_cpu": "1.0",
     "logfile": "/tmp/flask.log",
-    "loglevel": "INFO"
+    "loglevel": "INFO",
+    "lease_timeout": "600",
+    "body_cache_size": "256",
+    "resource_cache_size": "256",
+    "resource_cache_ttl": "900",
+    "resource_cache_margin": "120",
+    "summary_cache_ttl": "0",
+    "resource_samples": "500",
+    "client_retries": "3",
+    "client_backoff": "2",
+    "client_status_backoff": "120",
+    "client_max_backoff": "300",
+    "client_timeout": "30",
+    "client_pool_size": "10",
+    "batch_snapshot_ttl": "60",
+    "array_max_age": "86400",
+    "newjobs_wait_max": "300",
+    "newjobs_wait_poll": "10",
+    "bulk_insert_chunk": "10000",
+    "heartbeat_ttl": "1209600",
+    "heartbeat_flush": "0",
+    "datacat_chunk": "5000"
 }
 
 cfg = SafeConfigParser(defaults=__myDefaults)
@@ -63,12 +84,13 @@ dbg = cfg.getboolean("global", "traceback")
 
 DAMPE_WORKFLOW_URL = getenv("DAMPE_WORKFLOW_SERVER_URL",cfg.get("server", "url"))
 
-# for clients: support multiple servers.
-if DAMPE_BUILD == "client" and "," in DAMPE_WORKFLOW_URL:
-    DAMPE_WORKFLOW_URL = choice(DAMPE_WORKFLOW_URL.split(",")) 
-    # some cleanup in syntax to get rid of extra whitespaces.
-    while " " in DAMPE_WORKFLOW_URL:
-        DAMPE_WORKFLOW_URL = DAMPE_WORKFLOW_URL.replace(" ","")
+# for clients: support multiple servers, DAMPE_WORKFLOW_URLS holds all of them (in random order), 
+# the client session (DmpWorkflow.utils.client) fails over to the next one if a server can't be reached.
+DAMPE_WORKFLOW_URLS = [url.replace(" ","") for url in DAMPE_WORKFLOW_URL.split(",") if len(url.strip())]
+if DAMPE_BUILD == "client" and len(DAMPE_WORKFLOW_URLS) > 1:
+    shuffle(DAMPE_WORKFLOW_URLS)
+# without any url configured, the client raises once a request is actually sent.
+DAMPE_WORKFLOW_URL = DAMPE_WORKFLOW_URLS[0] if len(DAMPE_WORKFLOW_URLS) else ""
 
 DAMPE_WORKFLOW_DIR = cfg.get("site", "workdir")
 EXEC_DIR_ROOT = cfg.get("site", "EXEC_DIR_ROOT")
@@ -12,14 +12,13 @@ from os import environ, getenv
 from jsonpickle import encode as Jencode, decode as Jdecode
 from json import dumps
 from time import ctime
-from requests import post as Rpost
 from importlib import import_module
 from copy import deepcopy
-from DmpWorkflow.config.defaults import FINAL_STATII, DAMPE_WORKFLOW_URL, DAMPE_WORKFLOW_ROOT, BATCH_DEFAULTS, DAMPE_BUILD, cfg
+from DmpWorkflow.config.defaults import FINAL_STATII, DAMPE_WORKFLOW_ROOT, BATCH_DEFAULTS, DAMPE_BUILD, cfg
 from DmpWorkflow.utils.tools import mkdir, touch, rm, safe_copy, parseJobXmlToDict, getSixDigits 
-from DmpWorkflow.utils.tools import ResourceMonitor, sleep, random_string_generator
+from DmpWorkflow.utils.tools import ResourceMonitor, random_string_generator, datacat_record, register_files
 from DmpWorkflow.utils.shell import make_executable  # , source_bash
-from requests.exceptions import HTTPError
+from DmpWorkflow.utils.client import post as Rpost
 
 RunningInBatchMode = False
 if DAMPE_BUILD == "client": 
@@ -73,20 +72,17 @@ class DmpJob(object):
         error_line = "%s:ERROR: %s \n"%(ctime(),str(err))
         self.error_log += str(error_line)
 
-    def registerDS(self, filename=None, overwrite=False):
+    def registerDS(self, filename=None, overwrite=False, checksum=False):
+        """ registers all output files (or filename) in the data catalog, with as few requests as possible """
         site = cfg.get("site", "name")
         if filename is None:
             files = [fi['target'] for fi in self.OutputFiles]
         else:
             files = [filename]
-        for fi in files:
-            tg = oPath.expandvars(fi)
-            res = Rpost("%s/datacat/" % DAMPE_WORKFLOW_URL, data={"filename": tg, "site": site,
-                                                                  "action": "register",
-                                                                  "overwrite": str(overwrite)})
-            res.raise_for_status()
-            if not res.json().get("result", "nok") == "ok":
-                raise Exception(res.json().get("error", "No error provided."))
+        records = [datacat_record(oPath.expandvars(fi), site, checksum=checksum) for fi in files]
+        for res in register_files(records, overwrite=overwrite):
+            if not res.get("result", "nok") == "ok":
+                raise Exception(res.get("error", "No error provided."))
 
     def getWorkDir(self):
         wdROOT = cfg.get("site", "workdir") 
@@ -248,19 +244,15 @@ class DmpJob(object):
             my_dict['log']=self.error_log
         # print '*DEBUG* my_dict: %s'%str(my_dict)
         res = None
-        counter = 0
-        while (attempts >= counter) and (res is None):
-            try:
-                res = Rpost("%s/jobstatus/" % DAMPE_WORKFLOW_URL, data={"args": dumps(my_dict)}, timeout=tout)
-                res.raise_for_status()
-            except HTTPError as err:
-                counter+=1
-                slt = 60*counter
-                print '%i/%i: could not complete request, sleeping %i seconds and retrying again'%(counter, attempts, slt)
-                print err
-                sleep(slt)
-                res = None
-        if res is None and counter == attempts:
+        try:
+            # retries with backoff (and fails over to other servers) are handled by the client session.
+            res = Rpost("/jobstatus/", data={"args": dumps(my_dict)}, timeout=tout, retries=attempts,
+                        backoff=float(cfg.get("server", "client_status_backoff")))
+            res.raise_for_status()
+        except Exception as err:
+            print 'could not complete request after %i attempts: %s'%(attempts, err)
+            res = None
+        if res is None:
             if majorStatus == "Running":
                 # this is desaster recovery (to keep running jobs running)
                 print 'keeping job running, ignoring this update'
@@ -276,12 +268,14 @@ class DmpJob(object):
         return
         # update_status(self.jobId, self.instanceId, majorStatus, minor_status=minorStatus, **kwargs)
 
-    def getStatusBatch(self):
-        """ interacts with the backend HPC stuff and returns the status of the job """
-        # todo: make the whole thing batch-independent!
-        batch = HPC.BatchEngine()
-        ret = batch.status_map[batch.getJob(self.batchId, key="STAT")]
-        return ret
+    def getStatusBatch(self, batch=None):
+        """ interacts with the backend HPC stuff and returns the status of the job,
+            the queue is read from the shared batch snapshot, pass batch to re-use an engine that was updated already.
+        """
+        if batch is None:
+            batch = HPC.BatchEngine()
+            batch.update()
+        return batch.status_map.get(batch.getJob(self.batchId, key="STAT"), "Unknown")
 
     def submit(self, **kwargs):
         """ handles the submission part """
@@ -291,8 +285,7 @@ class DmpJob(object):
         if not dry:
             self.createLogFile()
 
-        bj = HPC.BatchJob(name=self.getJobName(), command=self.execCommand, logFile=self.logfile,
-                          defaults=BATCH_DEFAULTS)
+        bj = self.getBatchJob()
         if dry:
             print "DRY_COMMAND: %s" % self.execCommand
             return -1
@@ -306,6 +299,11 @@ class DmpJob(object):
             self.batchId = bj.submit(**kwargs)
         return self.batchId
     
+    def getBatchJob(self, defaults=None):
+        """ returns the batch job executing this instance, requires write_script & createLogFile to be called first. """
+        return HPC.BatchJob(name=self.getJobName(), command=self.execCommand, logFile=self.logfile,
+                            defaults=BATCH_DEFAULTS if defaults is None else defaults)
+
     def __run_locally(self):    
         tsk = Popen(self.execCommand.split(),stdout=PIPE,stderr=PIPE)
         poll = spoll()
@@ -0,0 +1,64 @@
+"""
+@brief: write-behind buffer for the heartbeats received on /testDB/, 
+        only the latest beat per (hostname, process) is kept and all of them are written with one bulk_write.
+"""
+import logging
+from atexit import register
+from os import getpid
+from threading import Lock, Thread, Event
+from DmpWorkflow.config.defaults import cfg
+from DmpWorkflow.core.models import HeartBeat
+
+log = logging.getLogger("core")
+
+
+class HeartBeatBuffer(object):
+    """ collects heartbeats and flushes them every <interval> seconds from a background thread,
+        with interval 0 every heartbeat is written right away.
+    """
+
+    def __init__(self, interval):
+        self.interval = float(interval)
+        self.__lock = Lock()
+        self.__beats = {}
+        self.__pid = None
+        self.__stop = Event()
+
+    def put(self, hostname, process, version, timestamp):
+        if self.interval <= 0:
+            HeartBeat.record([(hostname, process, version, timestamp)])
+            return
+        with self.__lock:
+            self.__beats[(hostname, process)] = (hostname, process, version, timestamp)
+            if self.__pid != getpid():
+                # (re-)start the flusher, threads do not survive a fork of the server process.
+                self.__pid = getpid()
+                thread = Thread(target=self.__run__, name="HeartBeatBuffer")
+                thread.daemon = True
+                thread.start()
+
+    def flush(self):
+        """ writes all buffered heartbeats, returns their number """
+        with self.__lock:
+            beats, self.__beats = self.__beats.values(), {}
+        try:
+            HeartBeat.record(beats)
+        except Exception as err:
+            log.error("HeartBeatBuffer: could not write %i heartbeats: %s", len(beats), err)
+            with self.__lock:
+                for beat in beats:
+                    self.__beats.setdefault(beat[0:2], beat)
+            return 0
+        return len(beats)
+
+    def __run__(self):
+        while not self.__stop.wait(self.interval):
+            self.flush()
+
+    def stop(self):
+        self.__stop.set()
+        self.flush()
+
+
+HEARTBEATS = HeartBeatBuffer(cfg.get("server", "heartbeat_flush"))
+register(HEARTBEATS.stop)
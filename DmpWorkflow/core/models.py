@@ -2,65 +2,374 @@
 import logging
 from datetime import datetime, timedelta
 import sys
-from mongoengine import CASCADE
+from time import time
+from itertools import islice
+from mongoengine import CASCADE, NotUniqueError
+from pymongo import ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from copy import deepcopy
 from flask import url_for
 from ast import literal_eval
 from json import dumps
-from numpy import array as np_array, median as np_median, mean as np_mean, histogram as np_hist
+from numpy import array as np_array, median as np_median, mean as np_mean, histogram as np_hist, fromiter as np_fromiter
 # from StringIO import StringIO
-from DmpWorkflow.config.defaults import MAJOR_STATII, FINAL_STATII, TYPES, SITES
+from DmpWorkflow.config.defaults import MAJOR_STATII, FINAL_STATII, TYPES, SITES, cfg
 from DmpWorkflow.core import db
+from DmpWorkflow.utils.cache import LRUCache
 from DmpWorkflow.utils.tools import random_string_generator, exceptionHandler, datetime_to_js
-from DmpWorkflow.utils.tools import parseJobXmlToDict, convertHHMMtoSec, sortTimeStampList
+from DmpWorkflow.utils.tools import parseJobXmlToDict, convertHHMMtoSec
 
 sys.excepthook = exceptionHandler
 log = logging.getLogger("core")
 
+# parsed job bodies, keyed by the GridFS id of the body (a new upload always yields a new id)
+BODY_CACHE = LRUCache(maxsize=int(cfg.get("server", "body_cache_size")))
+# per-instance resource peaks of each job, refreshed incrementally from the instances updated since the last call
+RESOURCE_CACHE = LRUCache(maxsize=int(cfg.get("server", "resource_cache_size")))
+RESOURCE_CACHE_TTL = int(cfg.get("server", "resource_cache_ttl"))
+RESOURCE_CACHE_MARGIN = timedelta(seconds=int(cfg.get("server", "resource_cache_margin")))
+
+# length of the rolling window of cpu/memory samples stored with each instance
+RESOURCE_SAMPLES = int(cfg.get("server", "resource_samples"))
+
+# number of instance documents sent per insert_many by Job.addInstanceBulk
+BULK_INSERT_CHUNK = int(cfg.get("server", "bulk_insert_chunk"))
+# largest instanceId a job may have
+MAX_INSTANCES = 1000000
+# number of update tokens kept per instance, see tokenPush
+UPDATE_TOKENS = 4
+# set once the StatusCounters of this deployment are known to be seeded, see StatusCounter.ensureSeeded
+COUNTER_STATE = {"seeded": False}
+
+# seconds after the last heartbeat a host/process is removed by the DB (TTL index), 0 keeps them forever
+HEARTBEAT_TTL = int(cfg.get("server", "heartbeat_ttl"))
+
+
+def resourcesFromMetadata(jobBody, instanceBody="", cpu_max=-1., mem_max=-1.):
+    """ returns cpu_max & mem_max as overridden by the BATCH_OVERRIDE_* variables
+        found in the (parsed) job body and the instance body, does not touch the DB.
+    """
+    md = []
+    res = {"BATCH_OVERRIDE_CPUTIME": cpu_max, "BATCH_OVERRIDE_MEMORY": mem_max}
+    var_map = {"BATCH_OVERRIDE_CPUTIME": "cpu_max", "BATCH_OVERRIDE_MEMORY": "mem_max"}
+    if isinstance(jobBody, dict):
+        if 'MetaData' in jobBody:
+            md += jobBody['MetaData']
+    if instanceBody not in ["", None]:
+        instance_dict = literal_eval(instanceBody) if not isinstance(instanceBody, dict) else instanceBody
+        if 'MetaData' in instance_dict:
+            md += instance_dict['MetaData']
+    # next, set the values
+    for v in md:
+        if v['name'] in var_map:
+            val = v['value']
+            if ":" in val: val = convertHHMMtoSec(val)
+            res[v['name']] = float(val)
+    return {v: res[k] for k, v in var_map.iteritems()}
+
+
+def rollbackDocument(now=None):
+    """ returns the fields ($set) that are reset when an instance is rolled back to New """
+    if now is None: now = datetime.now()
+    return {"created_at": now, "last_update": now, "batchId": None, "batchIndex": None, "Nevents": 0, "hostname": None,
+            "status": "New", "minor_status": "AwaitingBatchSubmission", "status_history": [],
+            "memory": [], "cpu": [], "memory_stats": {}, "cpu_stats": {}, "pilotReference": None,
+            "lease": None, "lease_time": None, "log": ""}
+
+
+def instanceDocuments(template, first, n):
+    """ yields n raw instance documents numbered from first on, each one a shallow copy of template,
+        the (read-only) values of the template are shared rather than copied.
+    """
+    for inst_id in xrange(first, first + n):
+        doc = dict(template)
+        doc["instanceId"] = inst_id
+        yield doc
+
+
+def counterDelta(changes, before, to_set):
+    """ accumulates in changes ((job, site, status) -> [count, nevents]) the effect of to_set ($set)
+        on an instance in state before (raw document holding job, site, status & Nevents), see StatusCounter.
+    """
+    n_old = before.get("Nevents", 0) or 0
+    n_new = to_set.get("Nevents", n_old) or 0
+    old = (before["job"], before["site"], before["status"])
+    new = (before["job"], before["site"], to_set.get("status", before["status"]))
+    if old == new and n_old == n_new: return changes
+    for key, count, nevents in ((old, -1, -n_old), (new, 1, n_new)):
+        delta = changes.setdefault(key, [0, 0])
+        delta[0] += count
+        delta[1] += nevents
+    return changes
+
+
+def leaseExpiry(now):
+    """ returns the time before which a lease has expired (see lease_timeout in settings.cfg) """
+    return now - timedelta(seconds=float(cfg.get("server", "lease_timeout")))
+
+
+def claimLeases(coll, query, limit, token, now, sort=None, to_set=None):
+    """ marks the first limit documents of coll matching query (pymongo filter) with the lease token and to_set ($set),
+        returns the number of documents claimed. the candidates are read first and claimed with one update_many
+        that repeats query, whatever a concurrent caller claimed in between doesn't match it anymore.
+    """
+    cursor = coll.find(query, {"_id": 1})
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    candidates = [doc["_id"] for doc in cursor.limit(int(limit))]
+    if not len(candidates):
+        return 0
+    return coll.update_many({"$and": [query, {"_id": {"$in": candidates}}]},
+                            {"$set": dict(to_set or {}, lease=token, lease_time=now)}).matched_count
+
+
+def tokenPush(token):
+    """ returns the $push that tags an instance with token (only the last UPDATE_TOKENS are kept),
+        the instances carrying the token are exactly those the update was applied to.
+    """
+    return {"update_tokens": {"$each": [token], "$slice": -UPDATE_TOKENS}}
+
+
+def updateInstances(query, to_set):
+    """ applies to_set ($set) to all instances matching query (pymongo filter) and keeps the StatusCounters in sync,
+        one update_many per (job, site, status) found. returns the number of instances matched.
+        every update tags its instances with a token, the changes of the counters are summed over the tagged instances,
+        so instances that changed their status in the meantime are neither lost nor counted twice.
+    """
+    coll = JobInstance._get_collection()
+    pipeline = [{"$match": query},
+                {"$group": {"_id": {"job": "$job", "site": "$site", "status": "$status"},
+                            "count": {"$sum": 1}, "nevents": {"$sum": "$Nevents"}}}]
+    groups = list(coll.aggregate(pipeline, allowDiskUse=True))
+    # groups already in the new status first, their update can't match instances moved there by the others.
+    groups.sort(key=lambda group: group["_id"]["status"] != to_set.get("status", None))
+    changes = {}
+    matched = 0
+    for group in groups:
+        key = group["_id"]
+        token = random_string_generator(16)
+        n = coll.update_many({"$and": [query, {"job": key["job"], "site": key["site"], "status": key["status"]}]},
+                             {"$set": to_set, "$push": tokenPush(token)}).matched_count
+        if not n: continue
+        matched += n
+        if "Nevents" in to_set:
+            # the Nevents before are overwritten, all but a concurrently changed group hold the counted ones.
+            n_old = group["nevents"] if n == group["count"] else group["nevents"] * n / max(group["count"], 1)
+            n_new = to_set["Nevents"] * n
+        else:
+            tagged = list(coll.aggregate([{"$match": {"job": key["job"], "update_tokens": token}},
+                                          {"$group": {"_id": None, "nevents": {"$sum": "$Nevents"}}}]))
+            n_old = n_new = tagged[0]["nevents"] if len(tagged) else 0
+        old = (key["job"], key["site"], key["status"])
+        new = (key["job"], key["site"], to_set.get("status", key["status"]))
+        if old == new and n_old == n_new: continue
+        for k, count, nev in ((old, -n, -n_old), (new, n, n_new)):
+            delta = changes.setdefault(k, [0, 0])
+            delta[0] += count
+            delta[1] += nev
+    StatusCounter.apply(changes)
+    return matched
+
+
+def statusUpdateDocument(current, arguments, now=None):
+    """ translates the key/value pairs of a status request into one atomic update ($set/$push)
+        for an instance in state current (dictionary with status, minor_status & last_update).
+        as with JobInstance.setStatus, the status only changes if a minor_status is given 
+        and the previous state is appended to the status_history. raises if the transition is not allowed.
+        cpu/memory samples are kept in a sorted window of RESOURCE_SAMPLES entries, 
+        min/max/sum/n/last of all samples are accumulated in cpu_stats/memory_stats.
+    """
+    if now is None: now = datetime.now()
+    to_set = {"last_update": now}
+    to_push = {}
+    to_min, to_max, to_inc = {}, {}, {}
+    major_status = arguments.get("major_status", None)
+    minor_status = arguments.get("minor_status", None)
+    if major_status is not None and minor_status is not None:
+        if major_status not in MAJOR_STATII:
+            raise Exception("status not found in supported list of statii: %s" % major_status)
+        curr_status = current.get("status", None)
+        curr_minor = current.get("minor_status", None)
+        if not (curr_status == major_status and curr_minor == minor_status):
+            if curr_status in FINAL_STATII:
+                raise Exception("job found in final state, can only set to New")
+            to_push["status_history"] = {"$each": [{"status": curr_status, "minor_status": curr_minor,
+                                                    "update": current.get("last_update", now)}],
+                                         "$sort": {"update": 1}}
+            to_set.update({"status": major_status, "minor_status": minor_status})
+    for key, value in arguments.iteritems():
+        if key in ["t_id", "inst_id", "major_status", "minor_status", "pilotReference"]:
+            continue
+        if key in ["cpu", "memory"]:
+            to_push[key] = {"$each": [{"time": now, "value": value}], "$sort": {"time": 1}, "$slice": -RESOURCE_SAMPLES}
+            # ignore empty entries in the summary
+            if not isinstance(value, list):
+                stats = "%s_stats" % key
+                value = float(value)
+                to_min["%s.min" % stats] = value
+                to_max["%s.max" % stats] = value
+                to_inc["%s.sum" % stats] = value
+                to_inc["%s.n" % stats] = 1
+                to_set["%s.last" % stats] = value
+        elif key == "created_at" and value == "Now":
+            to_set[key] = now
+        elif key in ["cpu_max", "mem_max"]:
+            to_set[key] = float(value)
+        elif key in JobInstance._fields:
+            to_set[key] = value if value is None else JobInstance._fields[key].to_mongo(value)
+        else:
+            log.warning("statusUpdateDocument: ignoring unknown key %s", key)
+    update = {"$set": to_set}
+    for op, fields in zip(["$push", "$min", "$max", "$inc"], [to_push, to_min, to_max, to_inc]):
+        if len(fields):
+            update[op] = fields
+    return update
+
 
 class DataFile(db.Document):
-    my_choices = ("New", "Copied", "Orphaned")
+    my_choices = ("New", "InProgress", "Copied", "Orphaned")
     created_at = db.DateTimeField(default=datetime.now, required=True)
     filename = db.StringField(max_length=1024, required=True)
     site = db.StringField(max_length=24, required=True)
     filetype = db.StringField(max_length=16, required=False, default="root")
     status = db.StringField(max_length=16, default="New")
+    size = db.LongField(verbose_name="size (bytes)", required=False, default=None)
+    checksum = db.StringField(max_length=128, required=False, default=None)
+    # set while the file is InProgress (claimed by a transfer agent), expired leases may be claimed again.
+    lease = db.StringField(verbose_name="lease", required=False, default=None)
+    lease_time = db.DateTimeField(verbose_name="lease_time", required=False, default=None)
 
     def setStatus(self, stat):
         if stat not in self.my_choices:
             raise Exception("status not supported in DB")
         self.status = stat
+        if stat != "InProgress":
+            self.lease = self.lease_time = None
 
     def save(self):
-        req = DataFile.objects.filter(filename=self.filename, site=self.site)
-        if req:
+        # uniqueness of (filename, site) is enforced by the index below.
+        try:
+            super(DataFile, self).save(force_insert=True)
+        except NotUniqueError:
             raise Exception("a file with the specified properties exists already, consider updating instead!")
-        super(DataFile, self).save()
 
     def update(self):
         log.debug("calling update on DataFile")
         super(DataFile, self).save()
 
+    @staticmethod
+    def registerMany(records, overwrite=False, chunk=None):
+        """ registers a list of files (dictionaries with the fields of DataFile) with insert_many, in chunks.
+            with overwrite, existing (filename, site) entries are replaced instead.
+            returns one result per record: the id of the document or an Exception.
+        """
+        chunk = BULK_INSERT_CHUNK if chunk is None else int(chunk)
+        results = [None] * len(records)
+        docs = []
+        for i, record in enumerate(records):
+            try:
+                df = DataFile(**record)
+                df.validate()
+                if df.status not in DataFile.my_choices:
+                    raise Exception("status not supported in DB")
+                docs.append((i, df.to_mongo().to_dict()))
+            except Exception as err:
+                results[i] = err
+        coll = DataFile._get_collection()
+        for start in xrange(0, len(docs), chunk):
+            batch = docs[start:start + chunk]
+            try:
+                if overwrite:
+                    # replaced documents keep their _id, the ids are looked up with one query per chunk.
+                    ops = [ReplaceOne({"filename": doc["filename"], "site": doc["site"]},
+                                      {k: v for k, v in doc.iteritems() if k != "_id"}, upsert=True) for _, doc in batch]
+                    coll.bulk_write(ops, ordered=False)
+                    index = {(doc["filename"], doc["site"]): i for i, doc in batch}
+                    query = {"$or": [{"filename": f, "site": site} for f, site in index.keys()]}
+                    for doc in coll.find(query, {"filename": 1, "site": 1}):
+                        results[index[(doc["filename"], doc["site"])]] = doc["_id"]
+                else:
+                    res = coll.insert_many([doc for _, doc in batch], ordered=False)
+                    for (i, _), _id in zip(batch, res.inserted_ids):
+                        results[i] = _id
+            except BulkWriteError as err:
+                failed = {}
+                for error in err.details.get("writeErrors", []):
+                    msg = "file exists already" if error.get("code", None) == 11000 else error.get("errmsg", "write failed")
+                    failed[error["index"]] = Exception(msg)
+                for n, (i, doc) in enumerate(batch):
+                    results[i] = failed.get(n, doc.get("_id", None))
+        return results
+
+    @staticmethod
+    def page(query, after=None, limit=1000, projection=None):
+        """ returns the next limit files matching query (raw documents) ordered by _id, starting after the _id after.
+            keyset pagination, each page is a short scan of the (site, status, filetype, _id) index.
+        """
+        if int(limit) <= 0:
+            raise Exception("limit MUST be positive")
+        query = dict(query)
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        return list(DataFile._get_collection().find(query, projection).sort("_id", 1).limit(int(limit)))
+
+    @staticmethod
+    def claim(site, filetype="root", limit=100, status="New"):
+        """ atomically marks the next limit files with status at site as InProgress under a new lease token,
+            files InProgress with an expired lease (see lease_timeout in settings.cfg) are claimed after those.
+            returns the token and the claimed files (raw documents), concurrent callers never get the same file.
+        """
+        token = random_string_generator(24)
+        now = datetime.now()
+        coll = DataFile._get_collection()
+        # separate queries, each one is a scan of the (site, status, filetype, _id) index in the order of _id.
+        claimed = 0
+        for query in ({"site": site, "status": status, "filetype": filetype},
+                      {"site": site, "status": "InProgress", "filetype": filetype, "lease_time": {"$lte": leaseExpiry(now)}}):
+            if claimed >= limit: break
+            claimed += claimLeases(coll, query, limit - claimed, token, now, sort=[("_id", 1)],
+                                   to_set={"status": "InProgress"})
+        return token, list(coll.find({"lease": token, "status": "InProgress"}).sort("_id", 1))
+
     meta = {
         'allow_inheritance': True,
-        'indexes': ['-created_at', 'filename', 'site'],
+        'index_cls': False,
+        'indexes': ['-created_at', 'site', {'fields': ['filename', 'site'], 'unique': True},
+                    {'fields': ['site', 'status', 'filetype', 'id']}, {'fields': ['lease'], 'sparse': True}],
         'ordering': ['-created_at']
     }
 
 
 class HeartBeat(db.Document):
-    ''' dummy class to test DB connection from remote workers '''
+    ''' last sign of life of each (hostname, process) of the remote workers, stale ones expire after HEARTBEAT_TTL '''
     created_at = db.DateTimeField(default=datetime.now, required=True)
     timestamp = db.DateTimeField(verbose_name="last sign of life", required=True)
     hostname = db.StringField(max_length=255, required=True)
     process  = db.StringField(max_length=64, required=False,default="default")
     deltat = db.FloatField(verbose_name="deltat",required=False,default=0.)
     version = db.StringField(max_length=32,verbose_name="version of package", required=False, default="None")
+    # unique (hostname, process): one document per process, see dampe-server-remove-duplicates --heartbeats.
     meta = {
         'allow_inheritance': True,
-        'indexes': ['-created_at', 'hostname','process'],
+        'index_cls': False,
+        'indexes': ['-created_at', 'process', {'fields': ['hostname', 'process'], 'unique': True}] +
+                   ([{'fields': ['timestamp'], 'expireAfterSeconds': HEARTBEAT_TTL}] if HEARTBEAT_TTL > 0 else []),
         'ordering': ['-created_at']
     }
+
+    @staticmethod
+    def upsert(hostname, process, version, timestamp):
+        """ returns the (single) upsert that records a heartbeat """
+        return UpdateOne({"hostname": hostname, "process": process},
+                         {"$set": {"timestamp": timestamp, "version": version},
+                          "$setOnInsert": {"created_at": timestamp, "deltat": 0., "_cls": HeartBeat._class_name}},
+                         upsert=True)
+
+    @staticmethod
+    def record(beats):
+        """ writes beats (list of (hostname, process, version, timestamp)) with one bulk_write """
+        if not len(beats): return
+        HeartBeat._get_collection().bulk_write([HeartBeat.upsert(*beat) for beat in beats], ordered=False)
     
     def checkStatus(self,deltaDays=1):
         now = datetime.now()
@@ -68,6 +377,162 @@ class HeartBeat(db.Document):
         p = now - margin <= self.timestamp <= now + margin
         return p
 
+class InstanceCounter(db.Document):
+    """ last instanceId handed out per job (the id of the counter is the id of the job),
+        ids are allocated with a single atomic $inc, see dampe-server-migrate-counters for existing jobs.
+    """
+    id = db.ObjectIdField(primary_key=True)
+    last = db.LongField(required=True, default=0)
+
+    @staticmethod
+    def seed(job):
+        """ raises the counter of job to the largest instanceId found in the DB (creates it if needed) """
+        top = JobInstance._get_collection().find_one({"job": job.id}, {"instanceId": 1}, sort=[("instanceId", -1)])
+        last = int(top["instanceId"]) if top is not None and top.get("instanceId", None) is not None else 0
+        InstanceCounter._get_collection().update_one({"_id": job.id}, {"$max": {"last": last}}, upsert=True)
+
+    @staticmethod
+    def allocate(job, n=1):
+        """ reserves n consecutive instanceIds for job, returns the first one.
+            raises if the job would exceed MAX_INSTANCES, in which case nothing is reserved.
+        """
+        n = int(n)
+        coll = InstanceCounter._get_collection()
+        query = {"_id": job.id, "last": {"$lte": MAX_INSTANCES - n}}
+        for attempt in (0, 1):
+            doc = coll.find_one_and_update(query, {"$inc": {"last": n}}, return_document=ReturnDocument.AFTER)
+            if doc is not None:
+                return doc["last"] - n + 1
+            if attempt == 0 and coll.find_one({"_id": job.id}, {"_id": 1}) is None:
+                InstanceCounter.seed(job)
+            else:
+                break
+        raise Exception("reached maximum of job instances, consider cloning this job instead.")
+
+    @staticmethod
+    def reserve(job, inst):
+        """ makes sure the counter of job is at least inst, so that inst is never handed out by allocate """
+        res = InstanceCounter._get_collection().update_one({"_id": job.id}, {"$max": {"last": int(inst)}})
+        if not res.matched_count:
+            InstanceCounter.seed(job)
+            InstanceCounter._get_collection().update_one({"_id": job.id}, {"$max": {"last": int(inst)}})
+
+
+class StatusCounterSeed(db.Document):
+    """ marks that the StatusCounters of all existing instances were created (the id is always 'seeded') """
+    id = db.StringField(primary_key=True)
+    created_at = db.DateTimeField(default=datetime.now)
+
+
+class StatusCounter(db.Document):
+    """ number of instances & the sum of their Nevents per (job, site, status), kept in sync with $inc by
+        all code paths that add instances or change their status, so that summaries never count instances.
+        run dampe-server-reconcile-counters periodically to repair drift (e.g. from edits in the admin pages).
+    """
+    job = db.ObjectIdField(required=True)
+    site = db.StringField(required=True)
+    status = db.StringField(required=True)
+    count = db.LongField(required=True, default=0)
+    nevents = db.LongField(required=True, default=0)
+
+    @staticmethod
+    def apply(changes):
+        """ applies changes ((job, site, status) -> [count, nevents]) with a single bulk_write """
+        ops = [UpdateOne({"job": key[0], "site": key[1], "status": key[2]},
+                         {"$inc": {"count": delta[0], "nevents": delta[1]}}, upsert=True)
+               for key, delta in changes.iteritems() if delta[0] or delta[1]]
+        if not len(ops): return
+        coll = StatusCounter._get_collection()
+        try:
+            coll.bulk_write(ops, ordered=False)
+        except BulkWriteError as err:
+            # concurrent upserts of the same (new) counter: the losers are retried, the counter exists by now.
+            errors = err.details.get("writeErrors", [])
+            if len([e for e in errors if e.get("code", None) != 11000]):
+                raise
+            coll.bulk_write([ops[e["index"]] for e in errors], ordered=False)
+
+    @staticmethod
+    def totals(query):
+        """ returns dictionary status -> [count, nevents] summed over all counters matching query (pymongo filter) """
+        StatusCounter.ensureSeeded()
+        out = {}
+        for counter in StatusCounter._get_collection().find(query, {"status": 1, "count": 1, "nevents": 1}):
+            total = out.setdefault(counter["status"], [0, 0])
+            total[0] += counter["count"]
+            total[1] += counter["nevents"]
+        return out
+
+    @staticmethod
+    def ensureSeeded():
+        """ seeds the counters from the instances the first time a deployment without counters reads them,
+            the seeding is marked in the DB (see StatusCounterSeed) so that it happens only once.
+        """
+        if COUNTER_STATE["seeded"]: return
+        if StatusCounterSeed.objects.filter(id="seeded").count():
+            COUNTER_STATE["seeded"] = True
+            return
+        log.warning("StatusCounter: no counters were seeded yet, counting all instances")
+        StatusCounter.reconcile()
+        StatusCounterSeed(id="seeded").save()
+        COUNTER_STATE["seeded"] = True
+
+    @staticmethod
+    def reconcile(job_ids=None, dry=False, attempts=5):
+        """ recounts the instances (of job_ids) and repairs the counters that differ,
+            returns list of ((job, site, status), [count, nevents] stored, [count, nevents] counted).
+            each repair only applies if the counter still holds the value read (compare-and-set), counters
+            changed by a concurrent $inc are read and recounted again, at most attempts times.
+        """
+        coll = StatusCounter._get_collection()
+        repaired = []
+        for attempt in xrange(attempts):
+            match = {} if job_ids is None else {"job": {"$in": list(job_ids)}}
+            # counters are read before the instances are counted: an $inc in between shows up as a miss below.
+            stored = {}
+            for counter in coll.find(match):
+                stored[(counter["job"], counter["site"], counter["status"])] = [counter["count"], counter["nevents"]]
+            pipeline = [{"$match": match},
+                        {"$group": {"_id": {"job": "$job", "site": "$site", "status": "$status"},
+                                    "count": {"$sum": 1}, "nevents": {"$sum": "$Nevents"}}}]
+            counted = {}
+            for group in JobInstance._get_collection().aggregate(pipeline, allowDiskUse=True):
+                counted[(group["_id"]["job"], group["_id"]["site"], group["_id"]["status"])] = [group["count"],
+                                                                                                group["nevents"]]
+            diffs = []
+            for key in set(counted.keys()) | set(stored.keys()):
+                if stored.get(key, [0, 0]) != counted.get(key, [0, 0]):
+                    diffs.append((key, stored.get(key, [0, 0]), counted.get(key, [0, 0])))
+            if dry: return diffs
+            missed = set()
+            for key, before, actual in diffs:
+                query = {"job": key[0], "site": key[1], "status": key[2]}
+                if key in stored:
+                    query.update({"count": before[0], "nevents": before[1]})
+                else:
+                    query["count"] = {"$exists": False}
+                try:
+                    res = coll.update_one(query, {"$set": {"count": actual[0], "nevents": actual[1]}},
+                                          upsert=key not in stored)
+                except DuplicateKeyError:
+                    # the counter was created by a concurrent $inc after it was read.
+                    missed.add(key[0])
+                    continue
+                if res.matched_count or res.upserted_id is not None:
+                    repaired.append((key, before, actual))
+                else:
+                    missed.add(key[0])
+            if not len(missed): break
+            job_ids = missed
+        else:
+            log.warning("StatusCounter: %i jobs kept changing while being reconciled", len(job_ids))
+        return repaired
+
+    meta = {
+        'indexes': [{'fields': ['job', 'site', 'status'], 'unique': True}, ['site', 'status']]
+    }
+
+
 class Job(db.Document):
     created_at = db.DateTimeField(default=datetime.now, required=True)
     slug = db.StringField(verbose_name="slug", required=True, default=random_string_generator)
@@ -78,34 +543,61 @@ class Job(db.Document):
     release = db.StringField(max_length=255, required=False)
     dependencies = db.ListField(db.ReferenceField("Job"))
     execution_site = db.StringField(max_length=255, required=True, default="local", choices=SITES)
+    # deprecated: no longer maintained (instances refer to their job), emptied by dampe-server-migrate-counters.
     jobInstances = db.ListField(db.ReferenceField("JobInstance"))
     archived = db.BooleanField(verbose_name="task closed", required=False, default=False)
     comment = db.StringField(max_length=1024, required=False, default="N/A")
     enable_monitoring = db.BooleanField(verbose_name="enable_monitoring", required=False, default=False)
     
+    def __resourcePeaks__(self):
+        """ returns dictionary instance _id -> (max cpu, max memory) for all instances that are not New,
+            only instances updated since the previous call (less resource_cache_margin) are read from the DB,
+            all of them once the cached peaks are older than resource_cache_ttl (deleted instances drop out).
+        """
+        key = str(self.id)
+        cached = RESOURCE_CACHE.get(key)
+        if cached is None or time() - cached["computed"] > RESOURCE_CACHE_TTL:
+            cached = {"watermark": None, "peaks": {}, "computed": time()}
+        match = {"job": self.id}
+        if cached["watermark"] is not None:
+            match["last_update"] = {"$gte": cached["watermark"] - RESOURCE_CACHE_MARGIN}
+        # legacy samples may hold [] as value, arrays sort above numbers, only numeric values are considered.
+        numeric = lambda field: {"$max": {"$filter": {"input": field, "as": "v",
+                                                      "cond": {"$in": [{"$type": "$$v"}, ["double", "int", "long", "decimal"]]}}}}
+        pipeline = [{"$match": match},
+                    {"$project": {"status": 1, "last_update": 1,
+                                  "cpu": {"$ifNull": ["$cpu_stats.max", numeric("$cpu.value")]},
+                                  "memory": {"$ifNull": ["$memory_stats.max", numeric("$memory.value")]}}}]
+        # the cached dictionary may be read by other threads, it is replaced rather than modified.
+        peaks = dict(cached["peaks"])
+        watermark = cached["watermark"]
+        for row in JobInstance._get_collection().aggregate(pipeline):
+            if watermark is None or row["last_update"] > watermark:
+                watermark = row["last_update"]
+            if row["status"] == "New":
+                # rolled back instances don't count anymore.
+                peaks.pop(row["_id"], None)
+                continue
+            peaks[row["_id"]] = tuple([float(row[k]) if isinstance(row[k], (int, long, float)) else float("nan")
+                                       for k in ("cpu", "memory")])
+        RESOURCE_CACHE.put(key, {"watermark": watermark, "peaks": peaks, "computed": cached["computed"]})
+        return peaks
+
     def aggregateResources(self,nbins=20):
         """ returns a json object which contains max, min, mean, median, 
-            and the histogram itself for all memories/cpu 
-            WARNING: this method is not particularly efficient 
-            and shouldn't be used lightly!
+            and the histogram itself for all memories/cpu, 
+            based on the peak cpu/memory of each instance (computed by the DB).
         """
         allData = {"memory":{"data":[]},"cpu":{"data":[]}}
-        query = JobInstance.objects.filter(job=self,status__not__exact="New").only("cpu").only("memory")
-        if query.count():
-            for inst in query:
-                agg = inst.aggregateResources()
-                for key in ['cpu','memory']:
-                    if len(agg[key]):
-                        allData[key]['data'].append(max(agg[key]))
-            del query
-            # finished aggregation, now we can do calculations                                                                                                                                              
-            for key in allData:
-                d = allData[key]["data"]
-                if not len(d): 
+        peaks = self.__resourcePeaks__()
+        if len(peaks):
+            for index, key in enumerate(['cpu', 'memory']):
+                arr = np_fromiter((p[index] for p in peaks.itervalues()), dtype=float, count=len(peaks))
+                arr = arr[arr == arr] # drops NaN
+                if not len(arr):
                     continue
-                allData[key]["max"]=max(d)
-                allData[key]["min"]=min(d)
-                arr = np_array(d,dtype=float)
+                allData[key]["max"]=float(arr.max())
+                allData[key]["min"]=float(arr.min())
                 allData[key]["mean"]=float(np_mean(arr,axis=0))
                 allData[key]["median"]=float(np_median(arr,axis=0))
                 hist, bins = np_hist(arr,nbins)
@@ -117,7 +609,6 @@ class Job(db.Document):
                 del allData[key]['data']
         return dumps(allData)
 
-    
     def addDependency(self, job):
         if not isinstance(job, Job):
             raise Exception("Must be job to be added")
@@ -166,23 +657,125 @@ class Job(db.Document):
             else:
                 return tuple(self.dependencies)
 
+    def checkDependenciesBulk(self, instanceIds, check_status=u"Done"):
+        """ returns the subset of instanceIds whose upstream instances are all in check_status, 
+            one query per dependency rather than one per instance and dependency. 
+        """
+        ready = set(instanceIds)
+        for task in self.getDependency():
+            if not ready: break
+            done = JobInstance.objects.filter(job=task, instanceId__in=list(ready), status=check_status).scalar("instanceId")
+            ready &= set(done)
+        return ready
+
+    def getDependents(self):
+        """ returns the jobs that list this job in their dependencies """
+        return Job.objects.filter(dependencies=self.id)
+
+    def releaseDependents(self, instanceIds):
+        """ to be called once instanceIds of this job reached Done: the instances with the same instanceIds
+            in the dependent jobs become claimable if all their other dependencies are Done as well.
+            returns dictionary site -> number of instances released.
+        """
+        released = {}
+        if not len(instanceIds): return released
+        coll = JobInstance._get_collection()
+        for job in self.getDependents():
+            query = {"job": job.id, "instanceId": {"$in": list(instanceIds)}, "dependencies_met": False}
+            blocked = [inst["instanceId"] for inst in coll.find(query, {"instanceId": 1, "_id": 0})]
+            ready = job.checkDependenciesBulk(blocked) if len(blocked) else set()
+            if not len(ready): continue
+            query["instanceId"] = {"$in": list(ready)}
+            n = coll.update_many(query, {"$set": {"dependencies_met": True}}).modified_count
+            if n: released[job.execution_site] = released.get(job.execution_site, 0) + n
+        return released
+
+    def blockDependents(self, instanceIds):
+        """ reverse of releaseDependents, for instances of this job that are no longer Done (roll-back) """
+        if not len(instanceIds): return
+        for job in self.getDependents():
+            JobInstance._get_collection().update_many({"job": job.id, "instanceId": {"$in": list(instanceIds)}, "status": "New"},
+                                                      {"$set": {"dependencies_met": False}})
+
+    def refreshDependencies(self, first=None, last=None):
+        """ recomputes dependencies_met of the New instances of this job (with instanceIds in [first, last] if given),
+            returns the number of instances that are claimable.
+        """
+        query = {"job": self.id, "status": "New"}
+        id_range = {}
+        if first is not None: id_range["$gte"] = int(first)
+        if last is not None: id_range["$lte"] = int(last)
+        if len(id_range): query["instanceId"] = id_range
+        coll = JobInstance._get_collection()
+        if not len(self.dependencies):
+            return coll.update_many(query, {"$set": {"dependencies_met": True}}).matched_count
+        # block first, a release arriving while the Done instances are read is then not lost.
+        coll.update_many(query, {"$set": {"dependencies_met": False}})
+        ready = None
+        for task in self.getDependency():
+            upstream = {"job": task.id, "status": "Done"}
+            if len(id_range): upstream["instanceId"] = id_range
+            done = set([inst["instanceId"] for inst in coll.find(upstream, {"instanceId": 1, "_id": 0})])
+            ready = done if ready is None else ready & done
+        ready = sorted(ready)
+        for start in xrange(0, len(ready), BULK_INSERT_CHUNK):
+            coll.update_many(dict(query, instanceId={"$in": ready[start:start + BULK_INSERT_CHUNK]}),
+                             {"$set": {"dependencies_met": True}})
+        return len(ready)
+
+    def rollBackInstances(self, query, body=None):
+        """ resets all instances of this job matching query (pymongo filter) to New with a single update_many.
+            body (dict) replaces the instance bodies, the cpu_max/mem_max overrides it implies are computed once
+            from the job body. returns the number of instances rolled back.
+        """
+        to_set = rollbackDocument()
+        if body is not None:
+            to_set["body"] = str(body)
+            res = resourcesFromMetadata(self.getBody(), body, cpu_max=None, mem_max=None)
+            # instances keep their limits unless the metadata overrides them
+            to_set.update({key: value for key, value in res.iteritems() if value is not None})
+        query = dict(query)
+        query["job"] = self.id
+        coll = JobInstance._get_collection()
+        done = []
+        if self.getDependents().count():
+            done = [inst["instanceId"] for inst in coll.find({"$and": [query, {"status": "Done"}]}, {"instanceId": 1, "_id": 0})]
+        nrolled = updateInstances(query, to_set)
+        self.blockDependents(done)
+        return nrolled
+
     def getNevents(self):
         return self.getNeventsFast()
 
     def getNeventsFast(self):
-        return JobInstance.objects.filter(job=self).aggregate_sum("Nevents")
+        return sum([total[1] for total in StatusCounter.totals({"job": self.id}).itervalues()])
 
-    def getBody(self,setVars=False):
-        # os.environ["DWF_JOBNAME"] = self.title
-        bdy = deepcopy(self.body.get().read())
+    def __readBody__(self):
+        bdy = self.body.get().read()
         self.body.get().seek(0)
-        # bdy_file = StringIO(deepcopy(bdy))
-        # self.body.delete()
-        # self.body.put(bdy_file,content_type="application/xml")
-        # self.update()
-        return parseJobXmlToDict(bdy,setVars=setVars)
+        return bdy
+
+    def getBody(self,setVars=False):
+        """ returns the parsed job body, bodies are parsed once and then served from BODY_CACHE.
+            setVars=True exports the variables into the environment and thus always re-parses.
+        """
+        key = self.body.grid_id
+        if setVars or key is None:
+            return parseJobXmlToDict(self.__readBody__(),setVars=setVars)
+        bdy = BODY_CACHE.get(key)
+        if bdy is None:
+            bdy = parseJobXmlToDict(self.__readBody__(),setVars=False)
+            BODY_CACHE.put(key, bdy)
+        # callers modify the returned lists, never hand out the cached object.
+        return deepcopy(bdy)
+
+    def invalidateBody(self):
+        """ drops the parsed body from BODY_CACHE, call before replacing the body """
+        if self.body.grid_id is not None:
+            BODY_CACHE.invalidate(self.body.grid_id)
 
     def resetBody(self, body, content_type="application/xml"):
+        self.invalidateBody()
         self.body.replace(open(body, "rb"), content_type=content_type)
         self.save()
 
@@ -195,57 +788,68 @@ class Job(db.Document):
         return None
         
     def addInstance(self, jInst, inst=None):
+        """ attaches jInst to the job, either with the next free instanceId or with inst """
         if self.archived:
             raise Exception("cannot append new instances to job that is archived, must unlock first.")
-        if len(self.jobInstances) >= 1000000:
-            raise Exception("reached maximum of job instances, consider cloning this job instead.")
         if not isinstance(jInst, JobInstance):
             log.exception("must be job instance to be added")
             raise Exception("Must be job instance to be added")
-        q = JobInstance.objects.filter(job=self).order_by("-instanceId")
-        last_stream = 0
-        if q.count():
-            last_stream = int(q.first().instanceId)
         if inst is not None:
-            # FIXME: offsets one, but then goes back to the length counter.
-            last_stream = inst - 1
-            if self.getInstance(last_stream + 1):
-                log.exception("job with instance %i exists already", inst)
-                raise Exception("job with instance %i exists already" % inst)
-        jInst.instanceId = last_stream + 1
+            InstanceCounter.reserve(self, inst)
+            jInst.instanceId = int(inst)
+        else:
+            jInst.instanceId = InstanceCounter.allocate(self)
         if not len(jInst.status_history):
             sH = {"status": jInst.status, "update": jInst.last_update, "minor_status": jInst.minor_status}
             jInst.status_history.append(sH)
         jInst.job = self  # add self reference?
         # jInst.getResourcesFromMetadata()
+        jInst.dependencies_met = not len(self.dependencies)
         jInst.save()
-        self.jobInstances.append(jInst)
+        StatusCounter.apply({(self.id, jInst.site, jInst.status): [1, jInst.Nevents or 0]})
+        if not jInst.dependencies_met:
+            jInst.dependencies_met = bool(self.refreshDependencies(jInst.instanceId, jInst.instanceId))
 
-    def addInstanceBulk(self,nreplica):
-        """ using jInst as input instance, and creating a deepcopy of it, replicate it nreplica times and attach to job """
-        if nreplica == 0: raise Exception("must be called with integer > 0.")
+    def addInstanceBulk(self, nreplica, chunk=None):
+        """ adds nreplica New instances to the job, returns the number of instances added.
+            raw documents are generated from a single template and inserted in chunks (constant memory),
+            the range of instanceIds is reserved up front through the InstanceCounter of the job.
+        """
+        if nreplica <= 0: raise Exception("must be called with integer > 0.")
+        chunk = BULK_INSERT_CHUNK if chunk is None else int(chunk)
         isPilot = True if self.type == "Pilot" else False
-        site = self.execution_site
         dummy_dict = {"InputFiles": [], "OutputFiles": [], "MetaData": []}
-        query = JobInstance.objects.filter(job=self).order_by("-instanceId")
-        inst_id = 1
-        if query.count(): inst_id = query.first().instanceId 
-        jInst = JobInstance(body=str(dummy_dict), site = site, isPilot=isPilot)
-        sH = {"status": jInst.status, "update": jInst.last_update, "minor_status": jInst.minor_status}
-        jInst.status_history.append(sH)
-        jInst.job = self
-        instances = []
-        first = inst_id + 1
-        last =  inst_id + nreplica + 1
-        if last <= first: raise Exception("Must never happen")
-        for i in xrange(first,last):
-            jI = deepcopy(jInst)
-            jI.instanceId = i
-            instances.append(jI)
-        query = JobInstance.objects.insert(instances)
-        #print "added {added} instances to job {job}".format(job=self.title, added=len(instances))
-        return len(instances)
-        
+        now = datetime.now()
+        jInst = JobInstance(body=str(dummy_dict), site=self.execution_site, isPilot=isPilot, job=self,
+                            created_at=now, last_update=now, dependencies_met=not len(self.dependencies))
+        jInst.status_history.append({"status": jInst.status, "update": now, "minor_status": jInst.minor_status})
+        jInst.validate()
+        template = jInst.to_mongo().to_dict()
+        template.pop("_id", None)
+        first = InstanceCounter.allocate(self, nreplica)
+        docs = instanceDocuments(template, first, nreplica)
+        coll = JobInstance._get_collection()
+        added = 0
+        start = time()
+        try:
+            while added < nreplica:
+                batch = list(islice(docs, chunk))
+                try:
+                    coll.insert_many(batch, ordered=False)
+                except BulkWriteError as err:
+                    added += err.details.get("nInserted", 0)
+                    log.error("job %s: %i of %i instances added", self.title, added, nreplica)
+                    raise Exception("instances were added to this job concurrently, try again.")
+                added += len(batch)
+        finally:
+            StatusCounter.apply({(self.id, template["site"], template["status"]): [added, 0]})
+        if len(self.dependencies):
+            self.refreshDependencies(first, first + added - 1)
+        elapsed = time() - start
+        log.info("added %i instances (%i to %i) to job %s in %1.2f s (%1.0f instances/s)",
+                 added, first, first + added - 1, self.title, elapsed, added / max(elapsed, 1e-6))
+        return added
+
     def aggregateStatii(self, asdict=False):
         # just an alias
         """ will return an aggregated summary of all instances in all statuses """
@@ -254,14 +858,35 @@ class Job(db.Document):
     def aggregateStatiiFast(self, asdict=False):
         """ will return an aggregated summary of all instances in all statuses """
         counting_dict = {unicode(key): 0 for key in MAJOR_STATII}
-        counting_dict.update(JobInstance.objects.filter(job=self).item_frequencies("status"))
+        counting_dict.update({key: total[0] for key, total in StatusCounter.totals({"job": self.id}).iteritems()})
         if asdict:
             return counting_dict
         else:
             return [(key, value) for key, value in counting_dict.iteritems()]
 
     def countInstances(self):
-        return JobInstance.objects.filter(job=self).count()
+        return sum([total[0] for total in StatusCounter.totals({"job": self.id}).itervalues()])
+
+    @staticmethod
+    def aggregateSummary(job_ids):
+        """ returns one row per job (in default job ordering) holding title, slug, site, type, release,
+            the number of events, the number of instances per major status and the total,
+            all instance counts come from the StatusCounters of the jobs.
+        """
+        rows = {}
+        jobs = Job.objects.filter(id__in=job_ids).only("title", "slug", "execution_site", "type", "release")
+        for job in jobs:
+            rows[job.id] = {"title": job.title, "slug": job.slug, "execution_site": job.execution_site,
+                            "type": job.type, "release": job.release, "nevents": 0, "total": 0,
+                            "statii": {unicode(key): 0 for key in MAJOR_STATII}}
+        StatusCounter.ensureSeeded()
+        for item in StatusCounter._get_collection().find({"job": {"$in": rows.keys()}}):
+            row = rows.get(item['job'], None)
+            if row is None: continue
+            row['statii'][item['status']] = row['statii'].get(item['status'], 0) + item['count']
+            row['total'] += item['count']
+            row['nevents'] += item['nevents']
+        return [rows[job.id] for job in jobs]
 
     def get_absolute_url(self):
         return url_for('job', kwargs={"slug": self.slug})
@@ -271,9 +896,13 @@ class Job(db.Document):
 
     def delete(self):
         instances = JobInstance.objects.filter(job=self)
+        self.invalidateBody()
+        RESOURCE_CACHE.invalidate(str(self.id))
         self.body.delete()
         if len(instances):
             for ji in instances: ji.delete()
+        InstanceCounter.objects.filter(id=self.id).delete()
+        StatusCounter.objects.filter(job=self.id).delete()
         super(Job, self).delete()
 
     #    def save(self):
@@ -288,7 +917,7 @@ class Job(db.Document):
 
     meta = {
         'allow_inheritance': True,
-        'indexes': ['-created_at', 'slug', 'title', 'id', 'execution_site'],
+        'indexes': ['-created_at', 'slug', 'title', 'id', 'execution_site', 'dependencies'],
         'ordering': ['-created_at']
     }
 
@@ -300,6 +929,8 @@ class JobInstance(db.Document):
     body = db.StringField(verbose_name="JobInstance", required=False, default="")
     last_update = db.DateTimeField(default=datetime.now, required=True)
     batchId = db.LongField(verbose_name="batchId", required=False, default=None)
+    # index of the element if the instance runs as part of an array job (batchId is the id of the array)
+    batchIndex = db.IntField(verbose_name="batchIndex", required=False, default=None)
     Nevents = db.LongField(verbose_name="Nevents", required=False, default=0)
     job = db.ReferenceField("Job", reverse_delete_rule=CASCADE)
     site = db.StringField(verbose_name="site", required=True, choices=SITES)
@@ -309,6 +940,9 @@ class JobInstance(db.Document):
     status_history = db.ListField(db.DictField())
     memory = db.ListField(db.DictField())
     cpu = db.ListField(db.DictField())
+    # summary (min, max, sum, n, last) over all samples, the lists above only keep the most recent ones.
+    memory_stats = db.DictField()
+    cpu_stats = db.DictField()
     log = db.StringField(verbose_name="log", required=False, default="",help="last 20 lines of error messages")
     cpu_max = db.FloatField(verbose_name="maximal CPU time (seconds)", required=False, default=-1.)
     mem_max = db.FloatField(verbose_name="maximal memory (mb)", required=False, default=-1.)
@@ -319,9 +953,32 @@ class JobInstance(db.Document):
     isPilot      = db.BooleanField(verbose_name="is_pilot",required=False, default=False)
     pilotReference = db.ReferenceField("JobInstance") 
 
+    # set when a fetcher claims the instance through /newjobs/claim/, 
+    # expired leases (see lease_timeout in settings.cfg) can be claimed again.
+    lease = db.StringField(verbose_name="lease", required=False, default=None)
+    lease_time = db.DateTimeField(verbose_name="lease_time", required=False, default=None)
+
+    # False while the instances with the same instanceId in the jobs this job depends on are not all Done,
+    # New instances are only handed out once it is set, see Job.releaseDependents. missing counts as met.
+    dependencies_met = db.BooleanField(verbose_name="dependencies_met", required=False, default=True)
+
+    # tokens of the last bulk updates applied to the instance, tells exactly which instances an update matched.
+    update_tokens = db.ListField(db.StringField(), required=False)
+
     def setAsPilot(self,val):
         self.isPilot = val
     
+    def getResourceStats(self, key):
+        """ returns the summary for cpu or memory, computed from the stored samples for instances without one. """
+        if key not in ["cpu", "memory"]: raise Exception("must be cpu or memory")
+        stats = self.cpu_stats if key == "cpu" else self.memory_stats
+        if stats and stats.get("n", 0):
+            return stats
+        values = self.aggregateResources()[key]
+        if not len(values): return {}
+        values = [float(v) for v in values]
+        return {"min": min(values), "max": max(values), "sum": sum(values), "n": len(values), "last": values[-1]}
+
     def aggregateResources(self):
         """ returns dict of two arrays, first is memory, second is cpu """
         data = {"memory":[],"cpu":[]}
@@ -384,13 +1041,12 @@ class JobInstance(db.Document):
             override_dict['MetaData'] = [{"name": k, "value": v, "type": "str"} for k, v in var_dict.iteritems()]        
         my_dict = {"t_id": str(self.job.id), "inst_id": self.instanceId,
                    "major_status": "New", "minor_status": "AwaitingBatchSubmission", "hostname": None,
-                   "batchId": None, "status_history": [], "body": str(override_dict),
+                   "batchId": None, "batchIndex": None, "status_history": [], "body": str(override_dict),
                    "log": "", "cpu": [], "memory": [], "created_at": "Now"}
         return dumps(my_dict)
 
     def setBody(self, bdy):
-        self.body = str(bdy)
-        self.update()
+        self.set("body", str(bdy))
 
     def __evalBody(self, includeParent=False):
         evalKeys = ['InputFiles', 'OutputFiles', 'MetaData']
@@ -433,26 +1089,11 @@ class JobInstance(db.Document):
         for k, v in _dict.iteritems(): bdy['MetaData'].append({'value': v, 'name': k, 'type': 'str'})
         self.set("body", str(bdy))
 
-    def getResourcesFromMetadata(self):
-        md = []
-        res = {"BATCH_OVERRIDE_CPUTIME": self.cpu_max, "BATCH_OVERRIDE_MEMORY": self.mem_max}
-        var_map = {"BATCH_OVERRIDE_CPUTIME": "cpu_max", "BATCH_OVERRIDE_MEMORY": "mem_max"}
-        metadata = self.job.getBody()
-        if isinstance(metadata, dict):
-            if 'MetaData' in metadata:
-                md = metadata['MetaData']
-        if self.body != "":
-            instance_dict = literal_eval(self.body)
-            if 'MetaData' in instance_dict:
-                md += instance_dict['MetaData']
-                # next, set the values
-        for v in md:
-            if v['name'] in var_map:
-                val = v['value']
-                if ":" in val: val = convertHHMMtoSec(val)
-                res[v['name']] = float(val)
-        for k, v in var_map.iteritems():
-            self.set(v, res[k])
+    def getResourcesFromMetadata(self, jobBody=None):
+        if jobBody is None:
+            jobBody = self.job.getBody()
+        res = resourcesFromMetadata(jobBody, self.body, cpu_max=self.cpu_max, mem_max=self.mem_max)
+        self.setMany(res)
         return
 
     def getWallTime(self, unit='s'):
@@ -475,7 +1116,9 @@ class JobInstance(db.Document):
         if self.status == "New": return 0.
         if self.status not in FINAL_STATII:
             log.debug("job not find in final status, CPU time may not be accurate")
-        total_sec = self.cpu[-1]['value']
+        stats = self.getResourceStats("cpu")
+        if not len(stats): return 0.
+        total_sec = stats['last']
         if unit == "min":
             return float(total_sec) / 60.
         elif unit == "hrs":
@@ -497,13 +1140,14 @@ class JobInstance(db.Document):
         if self.status not in FINAL_STATII:
             log.debug("job not find in final status, result may not be accurate")
         assert method in ['average', 'min', 'max'], "method not supported"
-        all_memory = [float(v["value"]) for v in self.memory if not isinstance(v["value"],list)]
+        stats = self.getResourceStats("memory")
+        if not len(stats): return 0.
         if method == 'min':
-            return min(all_memory)
+            return stats['min']
         elif method == 'max':
-            return max(all_memory)
+            return stats['max']
         else:
-            return sum(all_memory) / float(len(all_memory))
+            return stats['sum'] / float(stats['n'])
 
     def checkDependencies(self, check_status=u"Done"):
         dependent_tasks = self.job.getDependency()
@@ -544,52 +1188,47 @@ class JobInstance(db.Document):
     def set(self, key, value):
         if key == 'minor_status':
             raise NotImplementedError("use JobInstance.setStatus(major_status,minorStatus) instead.")
-        elif key == "created_at" and value == "Now":
-            value = datetime.now()
-        elif key == 'cpu':
-            self.cpu.append({"time": datetime.now(), "value": value})
-        elif key == 'memory':
-            self.memory.append({"time": datetime.now(), "value": value})
-        elif key in ['cpu_max', 'mem_max']:
-            #self._data.__setitem__(key, float(value))                                                                                                                                                               
-            ret = 0
-            if key == 'cpu_max':
-                ret = JobInstance.objects.filter(job=self.job,instanceId=self.instanceId).update(cpu_max=value)
-            else:
-                ret = JobInstance.objects.filter(job=self.job,instanceId=self.instanceId).update(mem_max=value)
-            if ret!=1:
-                log.critical("ERROR: JobInstance::set(%s,%s) returned %i",key,value,ret)
-                raise Exception("ERROR: JobInstance::set(%s,%s), returned %i"%(key,value,ret))
-            self.update()
-        else:
-            self.__setattr__(key, value)
         log.debug("setting %s : %s", key, value)
-        self.__setattr__("last_update", datetime.now())
-        self.update()
-
-    def __logHistory__(self):
-        """ does the accounting in status_history field """
-        stat = self.status
-        minStat  = self.minor_status
-        upd  = self.last_update
-        item = {"status":stat, "minor_status": minStat, "update":upd}
-
-        history_so_far = self.status_history
-        appd = False
-        if len(history_so_far): appd = True
-        elif self.getHistoryMinorStatusLast() != minStat: appd = True
-        if appd: history_so_far.append(item)
-        else:
-            return
-        # finally, perform atomic update
-        try:
-            res = JobInstance.objects.filter(instanceId=self.instanceId, job=self.job).update(status_history=history_so_far)
-            if res!= 1: raise Exception("could not perform atomic update on status history.")
-        except Exception as err:
-            log.exception("JobInstance.__logHistory__() trew error, %s",err)
-            raise Exception(err)
-        return
-    
+        self.setMany({key: value})
+
+    def setMany(self, arguments, now=None):
+        """ applies all key/value pairs (incl. major_status & minor_status) in one atomic $set/$push, 
+            only the modified fields are sent to the DB; the in-memory document is kept in sync. 
+        """
+        current = {"status": self.status, "minor_status": self.minor_status, "last_update": self.last_update}
+        update = statusUpdateDocument(current, arguments, now=now)
+        # the state before the update (rather than the in-memory one) decides which StatusCounters change.
+        before = JobInstance._get_collection().find_one_and_update({"_id": self.id}, update,
+                                                                   projection={"job": 1, "site": 1, "status": 1, "Nevents": 1})
+        if before is None:
+            log.critical("ERROR: JobInstance::setMany(%s) matched 0 documents", str(arguments.keys()))
+            raise Exception("ERROR: JobInstance::setMany(%s), matched 0 documents" % str(arguments.keys()))
+        StatusCounter.apply(counterDelta({}, before, update["$set"]))
+        self.__applyUpdate__(update)
+        return update
+
+    def __applyUpdate__(self, update):
+        """ mirrors an update built by statusUpdateDocument on the in-memory document """
+        for key, value in update["$set"].iteritems():
+            if "." in key:
+                field, sub = key.split(".", 1)
+                self._data[field][sub] = value
+            else:
+                self._data[key] = self._fields[key].to_python(value)
+        for key, value in update.get("$push", {}).iteritems():
+            items = getattr(self, key)
+            items.extend(value["$each"])
+            for skey in value.get("$sort", {}).keys():
+                items.sort(key=lambda item: item[skey])
+            if "$slice" in value and len(items) > -value["$slice"]:
+                del items[:len(items) + value["$slice"]]
+        for op, func in zip(["$min", "$max", "$inc"], [min, max, lambda a, b: a + b]):
+            for key, value in update.get(op, {}).iteritems():
+                field, sub = key.split(".", 1)
+                stats = self._data[field]
+                stats[sub] = func(stats[sub], value) if sub in stats else value
+        self._clear_changed_fields()
+
     def getHistoryMinorStatusLast(self):
         """ returns the last minor status """
         item = None
@@ -604,9 +1243,6 @@ class JobInstance(db.Document):
         if stat not in MAJOR_STATII:
             raise Exception("status not found in supported list of statii: %s", stat)
         curr_status = self.status
-        if curr_status in FINAL_STATII: 
-            self.__sortTimeStampedLists()
-            self.update()
         curr_minor  = self.minor_status
         if minorStatus is None:
             log.warning("no minorStatus provided, assuming last minor status!")
@@ -620,24 +1256,8 @@ class JobInstance(db.Document):
                 log.error(exc)
                 raise Exception(exc)
             return
-        else:
-            # now store the old status in the history
-            self.__logHistory__()
-        q = {"job":self.job, "instanceId":self.instanceId}
-        upd_dict = {"status":stat, "minor_status":minorStatus, "last_update":datetime.now()}
-        ret = JobInstance.objects.filter(**q).update(**upd_dict)
-        if ret != 1:
-            raise Exception("error setting status")
-        return
-
-    def __sortTimeStampedLists(self):
-        # final step - sort time-stamped lists to be chronological
-        if len(self.status_history) > 1:
-            self.status_history = sortTimeStampList(self.status_history, timestamp="update")
-        if len(self.cpu) > 1:
-            self.cpu = sortTimeStampList(self.cpu)
-        if len(self.memory) > 1:
-            self.memory = sortTimeStampList(self.memory)
+        # stores the old status in the history & sets the new one in one go.
+        self.setMany({"major_status": stat, "minor_status": minorStatus})
         return
 
     def sixDigit(self, size=6):
@@ -648,13 +1268,27 @@ class JobInstance(db.Document):
         super(JobInstance, self).save()
 
     def save(self):
-        req = JobInstance.objects.filter(job=self.job, instanceId=self.instanceId)
-        if req:
+        # uniqueness of (job, instanceId) is enforced by the index below.
+        try:
+            super(JobInstance, self).save(force_insert=True)
+        except NotUniqueError:
             raise Exception("instance exists already.")
-        super(JobInstance, self).save()
 
+    # indexes follow the query shapes of the server, see dampe-server-check-indexes.
+    # they are not prefixed with _cls so that raw queries on the collection can use them as well.
+    # they are not created by the server: on large collections, dampe-server-check-indexes --create builds them
+    # in the background (after dampe-server-remove-duplicates, the unique index fails on duplicates).
     meta = {
         'allow_inheritance': True,
-        'indexes': ['-created_at', 'instanceId', 'site'],
+        'index_cls': False,
+        'auto_create_index': False,
+        'index_background': True,
+        'indexes': ['-created_at', 'instanceId', 'site', 'pilotReference',
+                    {'fields': ['job', 'instanceId'], 'unique': True},
+                    ['job', 'status'],
+                    ['status', 'site', 'job'],
+                    ['status', 'last_update'],
+                    ['last_update', 'isPilot'],
+                    {'fields': ['lease'], 'sparse': True}],
         'ordering': ['-created_at']
     }
@@ -0,0 +1,40 @@
+"""
+@brief: in-process notification of new job instances per site, wakes up requests waiting on /newjobs/wait/.
+"""
+from threading import Condition
+from time import time
+
+
+class NewInstanceNotifier(object):
+    """ keeps one counter per site which is increased whenever New instances become available there,
+        waiting threads are woken up as soon as the counter of their site changes.
+        notifications are only seen within the same server process, waiters must therefore re-check the DB
+        once in a while (instances added by other processes or scripts).
+    """
+
+    def __init__(self):
+        self.__cond = Condition()
+        self.__counters = {}
+
+    def counter(self, site):
+        with self.__cond:
+            return self.__counters.get(site, 0)
+
+    def notify(self, site, n=1):
+        with self.__cond:
+            self.__counters[site] = self.__counters.get(site, 0) + n
+            self.__cond.notify_all()
+
+    def wait(self, site, since, timeout):
+        """ blocks until the counter of site differs from since or timeout seconds have passed, returns the counter """
+        deadline = time() + timeout
+        with self.__cond:
+            while self.__counters.get(site, 0) == since:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self.__cond.wait(remaining)
+            return self.__counters.get(site, 0)
+
+
+NOTIFIER = NewInstanceNotifier()
@@ -2,19 +2,47 @@ import logging
 #from copy import deepcopy
 #from os.path import basename
 from json import loads, dumps
-from flask import Blueprint, request, render_template
+from flask import Blueprint, request, render_template, redirect, url_for, Response, stream_with_context
 from datetime import datetime, timedelta
+from time import time
 from flask.views import MethodView
 from ast import literal_eval
-from re import findall
+from re import findall, match
+from bson import ObjectId
+from mongoengine import Q
+from pymongo import UpdateOne, UpdateMany
 from DmpWorkflow import version as DAMPE_VERSION
+from DmpWorkflow.config.defaults import cfg
 from DmpWorkflow.core.DmpJob import DmpJob
-from DmpWorkflow.core.models import Job, JobInstance, HeartBeat, DataFile
+from DmpWorkflow.core.models import Job, JobInstance, HeartBeat, DataFile, resourcesFromMetadata, BODY_CACHE
+from DmpWorkflow.core.models import statusUpdateDocument, counterDelta, updateInstances, StatusCounter, RESOURCE_CACHE
+from DmpWorkflow.core.models import tokenPush, claimLeases, leaseExpiry
+from DmpWorkflow.core.notify import NOTIFIER
+from DmpWorkflow.core.heartbeats import HEARTBEATS
+from DmpWorkflow.utils.tools import random_string_generator
+from DmpWorkflow.utils.cache import LRUCache
 
 jobs = Blueprint('jobs', __name__, template_folder='templates')
 
 logger = logging.getLogger("core")
 
+# rendered job summaries, only used if summary_cache_ttl > 0
+SUMMARY_CACHE = LRUCache(maxsize=64, ttl=float(cfg.get("server", "summary_cache_ttl")))
+
+def summarizeActiveJobs(query, cache_key=None):
+    """ returns the summary rows (see Job.aggregateSummary) of all jobs with instances matching query """
+    use_cache = cache_key is not None and SUMMARY_CACHE.ttl > 0
+    if use_cache:
+        rows = SUMMARY_CACHE.get(cache_key)
+        if rows is not None:
+            return rows
+    # raw distinct, the queryset version would de-reference every job.
+    job_ids = JobInstance._get_collection().distinct("job", query._query)
+    rows = Job.aggregateSummary(job_ids)
+    if use_cache:
+        SUMMARY_CACHE.put(cache_key, rows)
+    return rows
+
 
 class PilotView(MethodView):
         
@@ -30,7 +58,7 @@ class PilotView(MethodView):
             query = query.filter(site=site)
         if status != "None":
             query = query.filter(status=status)
-        jobs = query.distinct("job")
+        jobs = summarizeActiveJobs(query, cache_key=("pilots", days_since, hours_since, site, status))
         return render_template('jobs/plist.html', jobs=jobs, 
                                timestamp=new_date.strftime('%A, %d. %B %Y %I:%M%p'), 
                                server_time=datetime.now())
@@ -49,7 +77,8 @@ class ListView(MethodView):
             query = query.filter(site=site)
         if status != "None":
             query = query.filter(status=status)
-        jobs = query.filter(isPilot__in=[False,None]).distinct("job")
+        query = query.filter(isPilot__in=[False,None])
+        jobs = summarizeActiveJobs(query, cache_key=("jobs", days_since, hours_since, site, status))
         return render_template('jobs/list.html', jobs=jobs, 
                                timestamp=new_date.strftime('%A, %d. %B %Y %I:%M%p'), 
                                server_time=datetime.now())
@@ -70,18 +99,18 @@ class InstanceView(MethodView):
             instance = JobInstance.objects.get(job=job,instanceId=instId)
             logger.debug("InstanceView:GET: found instance, rendering templates")
         except Exception as err:
-            jobs = Job.objects.all()
             logger.exception("InstanceView:GET: caught exception %s",err)
-            return render_template('jobs/list.html', jobs=jobs)
+            return redirect(url_for('jobs.list'))
         try:
             return render_template('jobs/instanceDetail.html', instance=instance)
         except Exception as err:
             logger.critical("could not render instanceDetail, error below may provide more information\n%s",err)
-            render_template("jobs/list.html",jobs = Job.objects.all())
+            return redirect(url_for('jobs.list'))
             
 class StatsView(MethodView):
     def get(self):
         logger.debug("StatsView:GET: request %s", str(request))
+        HEARTBEATS.flush()
         heartbeats = HeartBeat.objects.filter(process="JobFetcher")
         now = datetime.now()
         for h in heartbeats:
@@ -90,6 +119,8 @@ class StatsView(MethodView):
             h.deltat = deltaT
         return render_template('stats/siteSummary.html', heartbeats=heartbeats, 
                                processbeats = HeartBeat.objects.all(), 
+                               caches = {"job bodies": BODY_CACHE.stats(), "job summaries": SUMMARY_CACHE.stats(),
+                                         "job resources": RESOURCE_CACHE.stats()},
                                server_version = DAMPE_VERSION, server_time = now)
 
 class DetailView(MethodView):
@@ -97,7 +128,7 @@ class DetailView(MethodView):
         logger.debug("DetailView:GET: request %s", str(request))
         job = Job.objects.get_or_404(slug=slug)
         status  = request.args.get("status",None)
-        limit   = request.args.get("limit",None)
+        limit   = int(request.args.get("limit",1000))
         inst_min= int(request.args.get("MinInstanceId",0))
         inst_max= int(request.args.get("MaxInstanceId",0))
         if status is None:
@@ -110,15 +141,87 @@ class DetailView(MethodView):
             query = query.filter(instanceId__gte=inst_min)
         if inst_max > 0:
             query = query.filter(instanceId__lte=inst_max)
-        if limit is not None:
-            query = query.limit(int(limit))
-        instances = query
-        logger.info("DetailView:GET: found %i instances for job %s",instances.count(),job.title)
-        return render_template('jobs/detail.html',job=job, instances=instances, status = status)
+        ninstances = query.count()
+        # only the first <limit> instances are rendered, all of them are available from the streaming API.
+        instances = query.only("instanceId", "batchId", "created_at", "last_update", "status", "minor_status", 
+                               "hostname").order_by("instanceId").limit(limit)
+        logger.info("DetailView:GET: found %i instances for job %s",ninstances,job.title)
+        return render_template('jobs/detail.html',job=job, instances=instances, ninstances=ninstances, 
+                               limit=limit, status = status)
 
     def post(self):
         dumps({"result":"ok","error":"Nothing to display"})
 
+
+class InstanceExport(MethodView):
+    """ streams the instances of a job as newline-delimited JSON, ordered by instanceId. 
+        query arguments: status (comma-separated), min & max (instanceId, inclusive), after (instanceId, exclusive,
+        to continue where a previous request stopped), limit (max. number of instances), 
+        fields (comma-separated, default EXPORT_FIELDS) and type (if the job is given by title instead of slug).
+    """
+    EXPORT_FIELDS = ["instanceId", "status", "minor_status", "site", "batchId", "batchIndex", "hostname", "created_at", "last_update"]
+
+    def __findJob__(self, slug):
+        job = Job.objects.filter(slug=slug).only("id").first()
+        if job is None:
+            job = Job.objects.filter(title=slug, type=request.args.get("type", "Generation")).only("id").first()
+        if job is None:
+            raise Exception("could not find job %s" % slug)
+        return job
+
+    @staticmethod
+    def __encode__(value):
+        """ dates as ISO strings, ObjectIds (job, pilotReference...) as strings, at any depth of the document """
+        if isinstance(value, datetime):
+            return value.isoformat()
+        if isinstance(value, ObjectId):
+            return str(value)
+        raise TypeError("%r is not JSON serializable" % value)
+
+    def __rows__(self, query, projection, after, limit, page):
+        """ keyset pagination on (job, instanceId), each page is a short index scan, 
+            no cursor is kept open while the client consumes the output.
+        """
+        coll = JobInstance._get_collection()
+        jobId = str(query["job"])
+        sent = 0
+        while limit is None or sent < limit:
+            n = page if limit is None else min(page, limit - sent)
+            if after is not None:
+                query["instanceId"]["$gt"] = after
+            rows = list(coll.find(query, projection).sort("instanceId", 1).limit(n))
+            for row in rows:
+                row["jobId"] = jobId
+                yield "%s\n" % dumps(row, default=self.__encode__)
+            if len(rows) < n:
+                break
+            sent += len(rows)
+            after = rows[-1]["instanceId"]
+
+    def get(self, slug):
+        logger.debug("InstanceExport:GET: request %s", str(request))
+        try:
+            job = self.__findJob__(slug)
+            fields = request.args.get("fields", None)
+            fields = self.EXPORT_FIELDS if fields is None else fields.split(",")
+            projection = dict([(str(f), 1) for f in fields] + [("instanceId", 1), ("_id", 0)])
+            query = {"job": job.id, "instanceId": {"$gte": int(request.args.get("min", 0))}}
+            if "max" in request.args:
+                query["instanceId"]["$lte"] = int(request.args.get("max"))
+            if "status" in request.args:
+                query["status"] = {"$in": request.args.get("status").split(",")}
+            after = int(request.args["after"]) if "after" in request.args else None
+            limit = int(request.args["limit"]) if "limit" in request.args else None
+            page = int(request.args.get("page", 1000))
+            if page <= 0 or (limit is not None and limit <= 0):
+                raise Exception("page and limit MUST be positive")
+        except Exception as err:
+            logger.error("InstanceExport:GET: %s", err)
+            return Response(dumps({"result": "nok", "error": str(err)}), status=400, mimetype="application/json")
+        return Response(stream_with_context(self.__rows__(query, projection, after, limit, page)),
+                        mimetype="application/x-ndjson")
+
+
 class JobView(MethodView):
     def get(self):
         dumps({"result":"ok","error":"Nothing to display"})
@@ -145,6 +248,7 @@ class JobView(MethodView):
             except Job.DoesNotExist:
                 job = Job(title=taskname, type=t_type, execution_site=site)
             # job = Job.objects(title=taskname, type=t_type).modify(upsert=True, new=True, title=taskname, type=t_type)
+            job.invalidateBody()
             job.body.put(jobdesc, content_type="application/xml")
             if comment is not None: job.setDescription(comment)
             job.save()
@@ -156,14 +260,7 @@ class JobView(MethodView):
             if t_type is not None:
                 job.type = t_type
             #if job.type == "Pilot": isPilot = True
-            if n_instances:
-                added = job.addInstanceBulk(n_instances)
-                logger.debug("JobView:GET: added %i instances to job %s", added, job.title)
-                #for j in range(n_instances):
-                #    jI = JobInstance(body=str(override_dict), site=site, isPilot=isPilot)
-                #    job.addInstance(jI)
-                #    logger.debug("JobView:GET: added instance %i to job %s", (j + 1), job.id)
-            # print len(job.jobInstances)
+            # dependencies go first, new instances must not be claimable before they are known.
             if depends != "None":
                 depends = depends.split(",")
                 for d in depends:
@@ -172,7 +269,19 @@ class JobView(MethodView):
                         job.addDependency(dependent_job[0])
                     else:
                         logger.warning("JobView:GET: could not find job dependency %s for job %s", d, job.slug)
+                job.save()
+                job.refreshDependencies()
+            if n_instances:
+                added = job.addInstanceBulk(n_instances)
+                logger.debug("JobView:GET: added %i instances to job %s", added, job.title)
+                #for j in range(n_instances):
+                #    jI = JobInstance(body=str(override_dict), site=site, isPilot=isPilot)
+                #    job.addInstance(jI)
+                #    logger.debug("JobView:GET: added instance %i to job %s", (j + 1), job.id)
+            # print len(job.jobInstances)
             job.save()
+            if n_instances:
+                NOTIFIER.notify(job.execution_site, n_instances)
             return dumps({"result": "ok", "jobID": str(job.id)})
         except Exception as err:
             logger.error("request dict: %s", str(request.form))
@@ -233,11 +342,43 @@ class JobInstanceView(MethodView):
                     logger.debug("JobInstanceView:POST: added instance %i to job %s", (j + 1), job.id)
             # print len(job.jobInstances)
             job.save()
+            NOTIFIER.notify(site)
             return dumps({"result": "ok"})
         else:
             logger.error("JobInstanceView:POST: Cannot find job")
             return dumps({"result": "nok", "error": 'Could not find job %s' % taskName})
 
+def extractBatchId(bId):
+    """ returns the (first) number found in bId, e.g. 'Job <1234> is submitted' -> 1234 """
+    logger.debug("extractBatchId: batchId passed to DB %s", bId)        
+    if bId is None: return bId
+    elif isinstance(bId,(int, long)): 
+        logger.debug("extractBatchId: batchId already type of int, not doing anything") 
+    else:
+        res = findall(r"\d+", str(bId))
+        if len(res):
+            bId = int(res[0])
+    logger.debug("extractBatchId: batchId: %s", bId)
+    return bId
+
+
+def splitBatchId(bId):
+    """ returns (batchId, index) for elements of array jobs (NNN[i], NNN_i, NNN.i or cluster.i),
+        (extractBatchId(bId), None) for anything else.
+    """
+    res = match(r"^\s*(\d+)(?:\[(\d+)\]|[._](\d+))\s*$", str(bId))
+    if res is None:
+        return extractBatchId(bId), None
+    return int(res.group(1)), int(res.group(2) or res.group(3))
+
+
+def releaseDependents(job, instanceIds):
+    """ instanceIds of job reached Done: releases the matching instances of dependent jobs & wakes up waiting fetchers """
+    for site, n in job.releaseDependents(instanceIds).iteritems():
+        logger.debug("releaseDependents: released %i instances at site %s", n, site)
+        NOTIFIER.notify(site, n)
+
+
 class SetJobStatusBulk(MethodView):
     def get(self):
         pass
@@ -251,23 +392,44 @@ class SetJobStatusBulk(MethodView):
             if major_status != "Submitted": 
                 logger.warning("SetJobStatusBulk:POST: should not use this end-point for anything but submitted jobs")
             minor_status = str(request.form.get("minor_status","WaitingForExecution"))
-            update_dict = {"status":major_status,"minor_status":minor_status,"last_update":datetime.now()}
+            # submitted instances are no longer claimed, their leases are released.
+            update_dict = {"status":major_status,"minor_status":minor_status,"last_update":datetime.now(),
+                           "lease":None,"lease_time":None}
             logger.debug("found %i entries to update",len(status_data))
             # data is of this form:
-            #[{jobId=XXX, instanceId=i}]
+            #[{t_id=XXX, instanceId=i, batchId=None}], batchId is optional
             jobIds = list(set([j['t_id'] for j in status_data]))
-            # make as few queries as possible 
+            jobs = {str(job.id): job for job in Job.objects.filter(id__in=jobIds).only("id", "execution_site")}
+            for jobId in jobIds:
+                if jobId not in jobs:
+                    raise Exception("error while updating query for job Id: %s" % jobId)
+            # make as few queries as possible: one per job, one per instance if a batchId is given.
             query_dict = {k:[] for k in jobIds}
+            updates = {k:[] for k in jobIds}
             for j in status_data:
-                query_dict[j['t_id']].append(j['instanceId'])
-            # assembled, now let's do the query
+                bId, bIndex = splitBatchId(j.get("batchId", None))
+                if bId is None or bId == "None":
+                    query_dict[j['t_id']].append(j['instanceId'])
+                else:
+                    updates[j['t_id']].append(UpdateOne({"job": jobs[j['t_id']].id, "instanceId": j['instanceId'], "status": "New"},
+                                                        {"$set": dict(update_dict, batchId=bId, batchIndex=bIndex)}))
             for jobId, instances in query_dict.iteritems():
-                try: 
-                    q = JobInstance.objects.filter(status="New",job=Job.objects.get(id=jobId), instanceId__in=instances)
-                    if q.count():
-                        njobs+=q.update(**update_dict)
-                except Exception as err:
-                    raise Exception("error while updating query for job Id: %s",jobId)
+                if len(instances):
+                    updates[jobId].append(UpdateMany({"job": jobs[jobId].id, "instanceId": {"$in": instances}, "status": "New"},
+                                                     {"$set": update_dict}))
+            # one bulk_write per job, the number of instances modified moves from New to major_status.
+            changes = {}
+            for jobId, job_updates in updates.iteritems():
+                if not len(job_updates): continue
+                n = JobInstance._get_collection().bulk_write(job_updates, ordered=False).modified_count
+                njobs += n
+                if n and major_status != "New":
+                    changes[(jobs[jobId].id, jobs[jobId].execution_site, "New")] = [-n, 0]
+                    changes[(jobs[jobId].id, jobs[jobId].execution_site, major_status)] = [n, 0]
+            StatusCounter.apply(changes)
+            if major_status == "Done":
+                for jobId, job in jobs.iteritems():
+                    releaseDependents(job, [j['instanceId'] for j in status_data if j['t_id'] == jobId])
             return dumps({"result":"ok","njobs":njobs})
         except Exception as err:
             return dumps({"result":"nok","error":str(err)})
@@ -275,18 +437,6 @@ class SetJobStatusBulk(MethodView):
 
 class SetJobStatus(MethodView):
     # these are helper methods to reduce complexity of POST    
-    def __extractBatchId__(self,bId):
-        logger.debug("SetJobStatus:POST: batchId passed to DB %s", bId)        
-        if bId is None: return bId
-        elif isinstance(bId,int): 
-            logger.debug("SetJobStatus:POST: batchId already type of int, not doing anything") 
-        else:
-            res = findall(r"\d+", str(bId))
-            if len(res):
-                bId = int(res[0])
-        logger.debug("SetJobStatus:POST: batchId: %s", bId)
-        return bId
-    
     def __readArgs__(self,request):
         arguments = loads(request.form.get("args", "{}"))
         logger.debug("SetJobStatus:POST: arguments %s,",str(arguments))
@@ -314,34 +464,10 @@ class SetJobStatus(MethodView):
         logger.debug("SetJobStatus:POST: requesting roll back for job %s and instance %i",job.title,inst_id)
         if not isinstance(job,Job):
             raise Exception("must be a valid Job instance.")
-        try:
-            query = JobInstance.objects.filter(job=job,instanceId=inst_id)
-            update_dict = {
-                        "created_at"    : datetime.now(),
-                        "last_update"   : datetime.now(),
-                        "batchId"       : None,
-                        "Nevents"       : 0,
-                        "hostname"      : None,
-                        "status"        : "New",
-                        "minor_status"  : "AwaitingBatchSubmission",
-                        "status_history": [],
-                        "memory"        : [],
-                        "cpu"           : [],
-                        "pilotReference": None,
-                        "log"           : ""
-                           }
-            res = query.update(**update_dict)
-            if not res:
-                raise Exception("error while updating instance")
-            # at this stage the instance MUST exist...
-            inst = query.first()
-            inst.reload()
-            if arguments is not None:
-                body = self.__readBdy__(arguments)
-                inst.setBody(body)
-                inst.getResourcesFromMetadata()
-        except Exception as err:
-            raise Exception(err)        
+        body = self.__readBdy__(arguments) if arguments is not None else None
+        if not job.rollBackInstances({"instanceId": inst_id}, body=body):
+            raise Exception("error while updating instance")
+        NOTIFIER.notify(job.execution_site)
         return dumps({"result": "ok"}) 
            
     def post(self):
@@ -364,7 +490,6 @@ class SetJobStatus(MethodView):
                 raise Exception("no instance ID provided")    
             # additional information, not critical
             site = str(arguments.get("site", "None"))
-            minor_status = arguments.get("minor_status", None)
             preference = arguments.get("pilotReference",None)
             pilot = None
             if preference is not None:
@@ -382,8 +507,8 @@ class SetJobStatus(MethodView):
             if major_status in ["Terminated","Failed"] and job.type == "Pilot":
                 # take care of assigned pilot instances...
                 jI = JobInstance.objects.get(job=job,instanceId=inst_id)
-                query = JobInstance.objects.filter(pilotReference=jI)
-                query.update(status="Terminated",minor_status="PilotTerminated")
+                updateInstances({"pilotReference": jI.id, "status": {"$ne": "Terminated"}},
+                                {"status": "Terminated", "minor_status": "PilotTerminated"})
             if major_status == "New":
                 if job.type == "Pilot":
                     raise Exception("SetJobStatus:POST: Try to roll-back pilot, this is not supported.")
@@ -391,10 +516,12 @@ class SetJobStatus(MethodView):
             # check for batchId, not used in query.
             bId = arguments.get("batchId",None)
             try: 
-                bId = self.__extractBatchId__(bId)
+                bId, bIndex = splitBatchId(bId)
                 arguments["batchId"]=bId
+                arguments["batchIndex"]=bIndex
                 if arguments['batchId'] == "None" or arguments['batchId'] is None:
                     del arguments['batchId']
+                    del arguments['batchIndex']
             except Exception as err:
                 raise Exception("SetJobStatus:POST: error extracting batchId,\n%s"%err)                        
             query = {"job":job, "instanceId":inst_id}
@@ -409,15 +536,11 @@ class SetJobStatus(MethodView):
             # now here we can update stuff...
             logger.debug("SetJobStatus:POST: found instance %s",str(jInstance))
             logger.debug("SetJobStatus:POST: arguments in request %s",str(arguments))
-            if minor_status is not None:
-                jInstance.setStatus(major_status,minor_status)
-            for key in ["t_id", "inst_id", "major_status","minor_status","pilotReference"]:
-                if key in arguments: del arguments[key]  
-            logger.debug("SetJobStatus:POST: arguments after cleanup %s",str(arguments))
-            # for the rest, we can just use the setters.
-            for key, value in arguments.iteritems():
-                jInstance.set(key, value)
-            
+            # status & all remaining keys go into one atomic update.
+            jInstance.setMany(arguments)
+            if major_status == "Done":
+                releaseDependents(job, [jInstance.instanceId])
+
 
         except Exception as err:
             logger.exception("SetJobStatus:POST: %s",err)
@@ -425,7 +548,7 @@ class SetJobStatus(MethodView):
         return dumps({"result": "ok"})
 
     def get(self):
-        queried_instances = output = []
+        output = []
         logger.debug("SetJobStatus:GET: request %s", str(request))
         jtype = unicode(request.form.get("type", "Generation"))
         stat = unicode(request.form.get("stat", "Any"))
@@ -442,40 +565,218 @@ class SetJobStatus(MethodView):
             query = {"job":job}
             if stat != "Any": query["status"]=stat
             if instId != -1 : query["instanceId"]=instId
-            instances = JobInstance.objects.filter(**query)
-            if not instances.count():
+            if n_min != -1: query["instanceId__gt"] = n_min
+            if n_max != -1: query["instanceId__lte"] = n_max
+            instanceIds = list(JobInstance.objects.filter(**query).scalar("instanceId"))
+            if not len(instanceIds):
                 raise Exception("could not find any job instances matching query")
-            if instances.count() == 1:
-                queried_instances.append(instances.first())
-            else:
-                for inst in instances:
-                    keep = True
-                    this_id = inst.instanceId
-                    if n_min != -1 and this_id <= n_min:
-                        keep = False
-                    if n_max != -1 and this_id > n_max:
-                        keep = False
-                    if not keep: continue
-                    queried_instances.append(inst)
-            output = [{"instanceId": q.instanceId, "jobId": str(q.job.id)} for q in queried_instances]
+            output = [{"instanceId": i, "jobId": str(job.id)} for i in instanceIds]
         except Exception as err:
             logger.error("SetJobStatus:GET: %s",err)
             return dumps({"result":"nok","error":str(err)})
         return dumps({"result": "ok", "jobs": output})
 
+class RollBackBulk(SetJobStatus):
+    """ rolls back all instances of a job selected by status and instanceId range with a single update,
+        takes the same selection as /jobstatus/ (GET): title, type, stat, inst, n_min (exclusive) & n_max,
+        stat may be a comma-separated list. body (optional) replaces the bodies of all selected instances.
+        dry=True only returns the number of instances that would be rolled back.
+    """
+
+    def __selection__(self, form):
+        query = {}
+        stat = unicode(form.get("stat", "Any"))
+        if stat != "Any": query["status"] = {"$in": stat.split(",")}
+        instId = int(form.get("inst", -1))
+        n_min = int(form.get("n_min", -1))
+        n_max = int(form.get("n_max", -1))
+        if instId != -1:
+            query["instanceId"] = instId
+        elif n_min != -1 or n_max != -1:
+            query["instanceId"] = {}
+            if n_min != -1: query["instanceId"]["$gt"] = n_min
+            if n_max != -1: query["instanceId"]["$lte"] = n_max
+        return query
+
+    def get(self):
+        return dumps({"result": "nok", "error": "roll-back requires POST"})
+
+    def post(self):
+        logger.debug("RollBackBulk:POST: request %s", str(request))
+        try:
+            title = request.form.get("title", None)
+            if title is None:
+                raise Exception("missing title in roll-back request")
+            job = Job.objects.get(title=unicode(title), type=unicode(request.form.get("type", "Generation")))
+            if job.type == "Pilot":
+                raise Exception("RollBackBulk:POST: Try to roll-back pilot, this is not supported.")
+            query = self.__selection__(request.form)
+            if literal_eval(request.form.get("dry", "False")):
+                query["job"] = job.id
+                return dumps({"result": "ok", "njobs": JobInstance.objects(__raw__=query).count(), "dry": True})
+            body = None
+            if "body" in request.form:
+                body = literal_eval(request.form.get("body"))
+                if not isinstance(body, dict):
+                    raise Exception("body MUST be dictionary.")
+            njobs = job.rollBackInstances(query, body=body)
+            logger.info("RollBackBulk:POST: rolled back %i instances of job %s", njobs, job.title)
+            if njobs:
+                NOTIFIER.notify(job.execution_site, njobs)
+        except Exception as err:
+            logger.exception("RollBackBulk:POST: %s", err)
+            return dumps({"result": "nok", "error": str(err)})
+        return dumps({"result": "ok", "njobs": njobs})
+
+
+class SetJobStatusBatch(SetJobStatus):
+    """ applies a list of status records (same keys as the args of /jobstatus/) with a single bulk_write,
+        returns ok/nok for each record in the order received. """
+
+    def __resolvePilots__(self, records):
+        """ returns dictionary pilotReference -> _id of the pilot instance """
+        pilots = {}
+        for preference in set([r['pilotReference'] for r in records if r.get('pilotReference', None) is not None]):
+            try:
+                pref = preference.split(".")
+                pilot = JobInstance.objects.filter(instanceId=int(pref[1]), job=pref[0]).only("id").first()
+                if pilot is not None:
+                    pilots[preference] = pilot.id
+            except Exception as err:
+                logger.error("SetJobStatusBatch:POST: could not resolve pilot reference %s: %s", preference, err)
+        return pilots
+
+    def get(self):
+        return dumps({"result": "nok", "error": "batch status updates require POST"})
+
+    def post(self):
+        try:
+            records = loads(request.form.get("data", "[]"))
+            if not isinstance(records, list):
+                raise Exception("data MUST be a list of status records.")
+        except Exception as err:
+            logger.exception("SetJobStatusBatch:POST: %s", err)
+            return dumps({"result": "nok", "error": str(err)})
+        logger.debug("SetJobStatusBatch:POST: found %i records to update", len(records))
+        results = [{"result": "nok", "error": "not processed"} for _ in records]
+        valid = []
+        for i, record in enumerate(records):
+            try:
+                if not isinstance(record, dict):
+                    raise Exception("record MUST be dictionary.")
+                for key in ["t_id", "inst_id", "major_status"]:
+                    if record.get(key, None) is None:
+                        raise Exception("missing %s in record" % key)
+                if record["major_status"] == "New":
+                    raise Exception("roll-back is not supported in batch mode, use /jobstatus/ instead")
+                record["inst_id"] = int(record["inst_id"])
+                if "body" in record: del record["body"]
+                if "batchId" in record:
+                    bId, bIndex = splitBatchId(record["batchId"])
+                    if bId is None or bId == "None": del record["batchId"]
+                    else: record["batchId"], record["batchIndex"] = bId, bIndex
+                valid.append(i)
+            except Exception as err:
+                results[i] = {"result": "nok", "error": str(err)}
+        try:
+            jobs = {str(job.id): job for job in Job.objects.filter(id__in=list(set([records[i]["t_id"] for i in valid])))}
+            # fetch the current state of all instances with one query per job
+            current = {}
+            for t_id, job in jobs.iteritems():
+                inst_ids = [records[i]["inst_id"] for i in valid if records[i]["t_id"] == t_id]
+                query = JobInstance.objects.filter(job=job, instanceId__in=inst_ids)
+                for inst in query.only("id", "job", "instanceId", "status", "minor_status", "last_update", "site", "Nevents").as_pymongo():
+                    current[(t_id, inst["instanceId"])] = inst
+            pilots = self.__resolvePilots__([records[i] for i in valid])
+            now = datetime.now()
+            # the n-th record of an instance goes into the n-th round, each round holds every instance at most once.
+            rounds = []
+            for i in valid:
+                record = records[i]
+                inst = current.get((record["t_id"], record["inst_id"]), None)
+                try:
+                    if record["t_id"] not in jobs:
+                        raise Exception("could not find job %s" % record["t_id"])
+                    if inst is None:
+                        raise Exception("could not find instance %i" % record["inst_id"])
+                    site = str(record.get("site", "None"))
+                    if site != "None" and inst.get("site", None) != site:
+                        raise Exception("instance is not assigned to site %s" % site)
+                    update = statusUpdateDocument(inst, record, now=now)
+                    preference = record.get("pilotReference", None)
+                    if preference is not None:
+                        if preference not in pilots:
+                            raise Exception("Could not find associated pilot instance")
+                        update["$set"]["pilotReference"] = pilots[preference]
+                    # the transition was checked against this state, the update only applies if it still holds.
+                    before = dict(inst)
+                    query = {"_id": inst["_id"], "status": inst["status"], "minor_status": inst["minor_status"]}
+                    inst["round"] = inst.get("round", -1) + 1
+                    if inst["round"] == len(rounds): rounds.append([])
+                    rounds[inst["round"]].append((i, before, query, update))
+                    # consecutive records of the same instance
+                    inst.update({key: update["$set"][key] for key in ["status", "minor_status", "last_update", "Nevents"]
+                                 if key in update["$set"]})
+                except Exception as err:
+                    results[i] = {"result": "nok", "error": str(err)}
+            coll = JobInstance._get_collection()
+            terminated_pilots = []
+            done = {}
+            changes = {}
+            failed = set()
+            for entries in rounds:
+                for i, before, _, _ in entries:
+                    if before["_id"] in failed:
+                        results[i] = {"result": "nok", "error": "a previous update of the instance failed, not updated"}
+                entries = [entry for entry in entries if entry[1]["_id"] not in failed]
+                if not len(entries): continue
+                # every instance matched in this round is tagged with its token, the others changed status in the meantime.
+                token = random_string_generator(16)
+                for entry in entries:
+                    entry[3].setdefault("$push", {}).update(tokenPush(token))
+                res = coll.bulk_write([UpdateOne(entry[2], entry[3]) for entry in entries], ordered=False)
+                missed = set()
+                if res.matched_count != len(entries):
+                    ids = [before["_id"] for _, before, _, _ in entries]
+                    missed = set(ids) - set(coll.find({"_id": {"$in": ids}, "update_tokens": token}).distinct("_id"))
+                    logger.warning("SetJobStatusBatch:POST: matched %i of %i instances", res.matched_count, len(entries))
+                for i, before, query, update in entries:
+                    record = records[i]
+                    if before["_id"] in missed:
+                        failed.add(before["_id"])
+                        results[i] = {"result": "nok", "error": "instance is no longer in status %s/%s, not updated"
+                                                                % (query["status"], query["minor_status"])}
+                        continue
+                    results[i] = {"result": "ok"}
+                    counterDelta(changes, before, update["$set"])
+                    if jobs[record["t_id"]].type == "Pilot" and record["major_status"] in ["Terminated", "Failed"]:
+                        terminated_pilots.append(before["_id"])
+                    if record["major_status"] == "Done":
+                        done.setdefault(record["t_id"], []).append(record["inst_id"])
+            StatusCounter.apply(changes)
+            for t_id, inst_ids in done.iteritems():
+                releaseDependents(jobs[t_id], inst_ids)
+            if len(terminated_pilots):
+                # take care of assigned pilot instances...
+                updateInstances({"pilotReference": {"$in": terminated_pilots}, "status": {"$ne": "Terminated"}},
+                                {"status": "Terminated", "minor_status": "PilotTerminated"})
+        except Exception as err:
+            logger.exception("SetJobStatusBatch:POST: %s", err)
+            return dumps({"result": "nok", "error": str(err)})
+        nok = len([r for r in results if r["result"] != "ok"])
+        return dumps({"result": "ok", "updated": len(records) - nok, "failed": nok, "results": results})
+
+
 class NewJobs(MethodView):
     
     def getJobsFast(self,site,status):
-        """ a superfast query to see how many jobs are running """
+        """ a superfast query to see how many jobs are running, reads the StatusCounters of the site """
         pilot = literal_eval(request.form.get("pilot","False"))
         if not isinstance(status,list):
             status = [status]
-        q = JobInstance.objects.filter(status__in=status, site=site)
-        if pilot:
-            q = q.filter(job__in=Job.objects.filter(type="Pilot"))
-        else:
-            q = q.filter(job__in=Job.objects.filter(type__not__exact="Pilot"))
-        return q.count()
+        pilots = list(Job.objects.filter(type="Pilot").scalar("id"))
+        query = {"site": site, "status": {"$in": status}, "job": {"$in" if pilot else "$nin": pilots}}
+        return sum([total[0] for total in StatusCounter.totals(query).itervalues()])
     
     def getNewJobs(self,batchsite, jstatus):
         _limit = int(request.form.get("limit", 1000))
@@ -486,18 +787,19 @@ class NewJobs(MethodView):
         else:
             job_query = job_query.filter(type__not__exact="Pilot")
         newJobInstances = []
-        newJobs = JobInstance.objects.filter(status=jstatus, job__in=job_query).limit(int(_limit))
+        # instances claimed by a fetcher (through /newjobs/claim/) are left out until their lease expires.
+        free = Q(lease=None) | Q(lease_time__lte=leaseExpiry(datetime.now()))
+        # instances waiting for their dependencies are released by SetJobStatus, see Job.releaseDependents
+        newJobs = JobInstance.objects.filter(free, status=jstatus, dependencies_met__ne=False,
+                                             job__in=job_query).limit(int(_limit))
         if newJobs.count():
             for j in newJobs:
                 job = j.job
                 dJob = DmpJob(job.id, body=None, title=job.title)
                 dJob.setBodyFromDict(job.getBody())
-                if j.checkDependencies():
-                    j.getResourcesFromMetadata()
-                    dJob.setInstanceParameters(j.instanceId, j.body)
-                    newJobInstances.append(dJob.exportToJSON())
-                else:
-                    logger.info("NewJobs:GET: dependencies not fulfilled yet")
+                j.getResourcesFromMetadata()
+                dJob.setInstanceParameters(j.instanceId, j.body)
+                newJobInstances.append(dJob.exportToJSON())
         return newJobInstances
 
     def get(self):
@@ -523,6 +825,102 @@ class NewJobs(MethodView):
             logger.error("NewJobs:GET: %s",err)
             return dumps({"result":"nok","error":str(err)})
 
+class ClaimNewJobs(NewJobs):
+    """ atomically claims up to <limit> New instances for a site by marking them with a lease token,
+        concurrent fetchers therefore never receive the same instance. """
+
+    def claimNewJobs(self, batchsite, _limit, pilot=False):
+        token = random_string_generator(24)
+        now = datetime.now()
+        job_query = Job.objects.filter(execution_site=batchsite)
+        if pilot:
+            job_query = job_query.filter(type="Pilot")
+        else:
+            job_query = job_query.filter(type__not__exact="Pilot")
+        # instances waiting for their dependencies are released by SetJobStatus, see Job.releaseDependents
+        query = {"job": {"$in": list(job_query.scalar("id"))}, "status": "New", "dependencies_met": {"$ne": False},
+                 "$or": [{"lease": None}, {"lease_time": {"$lte": leaseExpiry(now)}}]}
+        coll = JobInstance._get_collection()
+        if not claimLeases(coll, query, _limit, token, now):
+            return token, []
+        claimed = JobInstance.objects.filter(lease=token, status="New")
+        claimed = claimed.only("job", "instanceId", "body", "cpu_max", "mem_max").as_pymongo()
+        instances_by_job = {}
+        for inst in claimed:
+            instances_by_job.setdefault(inst['job'], []).append(inst)
+        jobs = {job.id: job for job in Job.objects.filter(id__in=instances_by_job.keys())}
+        newJobInstances = []
+        released = []
+        updates = []
+        for job_id, instances in instances_by_job.iteritems():
+            job = jobs.get(job_id, None)
+            if job is None:
+                logger.error("ClaimNewJobs: could not find job %s, releasing its instances", job_id)
+                released += [inst['_id'] for inst in instances]
+                continue
+            # parse the job body once for all its instances
+            body = job.getBody()
+            for inst in instances:
+                res = resourcesFromMetadata(body, inst.get("body", ""),
+                                            cpu_max=inst.get("cpu_max", -1.), mem_max=inst.get("mem_max", -1.))
+                updates.append(UpdateOne({"_id": inst['_id']}, {"$set": res}))
+                dJob = DmpJob(job.id, body=None, title=job.title)
+                dJob.setBodyFromDict(body)
+                dJob.setInstanceParameters(inst['instanceId'], inst.get("body", ""))
+                newJobInstances.append(dJob.exportToJSON())
+        if len(released):
+            logger.info("ClaimNewJobs: releasing lease of %i instances", len(released))
+            coll.update_many({"_id": {"$in": released}, "lease": token}, {"$set": {"lease": None, "lease_time": None}})
+        if len(updates):
+            coll.bulk_write(updates, ordered=False)
+        return token, newJobInstances
+
+    def get(self):
+        return dumps({"result": "nok", "error": "claiming jobs requires POST"})
+
+    def post(self):
+        logger.debug("ClaimNewJobs:POST: request %s", str(request))
+        batchsite = unicode(request.form.get("site", "local"))
+        _limit = int(request.form.get("limit", 1000))
+        pilot = literal_eval(request.form.get("pilot", "False"))
+        try:
+            token, newJobInstances = self.claimNewJobs(batchsite, _limit, pilot=pilot)
+            logger.debug("ClaimNewJobs:POST: claimed %i instances with lease %s", len(newJobInstances), token)
+        except Exception as err:
+            logger.exception("ClaimNewJobs:POST: %s", err)
+            return dumps({"result": "nok", "error": str(err)})
+        return dumps({"result": "ok", "jobs": newJobInstances, "lease": token, "query_type": "claim"})
+
+
+class WaitNewJobs(ClaimNewJobs):
+    """ long-poll version of ClaimNewJobs, holds the request until New instances can be claimed for the site
+        or <timeout> seconds have passed. the request is woken up by new or rolled-back instances added through
+        this server process, the DB is re-checked every newjobs_wait_poll seconds for everything else. 
+    """
+
+    def post(self):
+        logger.debug("WaitNewJobs:POST: request %s", str(request))
+        batchsite = unicode(request.form.get("site", "local"))
+        _limit = int(request.form.get("limit", 1000))
+        pilot = literal_eval(request.form.get("pilot", "False"))
+        timeout = min(float(request.form.get("timeout", 60.)), float(cfg.get("server", "newjobs_wait_max")))
+        poll = float(cfg.get("server", "newjobs_wait_poll"))
+        start = time()
+        try:
+            while True:
+                since = NOTIFIER.counter(batchsite)
+                token, newJobInstances = self.claimNewJobs(batchsite, _limit, pilot=pilot)
+                remaining = timeout - (time() - start)
+                if len(newJobInstances) or remaining <= 0:
+                    break
+                NOTIFIER.wait(batchsite, since, min(poll, remaining))
+            logger.debug("WaitNewJobs:POST: claimed %i instances after %1.1f s", len(newJobInstances), time() - start)
+        except Exception as err:
+            logger.exception("WaitNewJobs:POST: %s", err)
+            return dumps({"result": "nok", "error": str(err)})
+        return dumps({"result": "ok", "jobs": newJobInstances, "lease": token, "query_type": "wait",
+                      "waited": time() - start})
+
 
 class TestView(MethodView):
     def post(self):
@@ -535,17 +933,8 @@ class TestView(MethodView):
         try:
             if (hostname == "None") or (timestamp == "None"):
                 raise Exception("request empty")
-            query = {}
-            if proc  != "default": query['process'] = proc
-            if hostname != 'None': query['hostname']=hostname
-            q = HeartBeat.objects.filter(**query)
-            query["timestamp"] = timestamp
-            query["version"]   = version
-            if not q.count():
-                HB = HeartBeat(**query)
-                HB.save()
-            else:
-                q.update(**query)
+            # one upsert on (hostname, process), possibly buffered (see heartbeat_flush in settings.cfg)
+            HEARTBEATS.put(hostname, proc, version, timestamp)
         except Exception as err:
             logger.error("TestView:POST: %s",err)
             return dumps({"result":"nok","error":str(err)})
@@ -633,18 +1022,125 @@ class DataCatalog(MethodView):
         return dumps({"result": "ok",
                       "docId": [d.filename if action == 'delete' else str(d.id) for d in touched_files]})
 
+    def __rows__(self, query, projection, after, limit, page):
+        """ streams the matching files page by page as newline-delimited JSON, see DataFile.page """
+        sent = 0
+        while limit is None or sent < limit:
+            n = page if limit is None else min(page, limit - sent)
+            rows = DataFile.page(query, after=after, limit=n, projection=projection)
+            for row in rows:
+                for key, value in row.iteritems():
+                    if isinstance(value, datetime):
+                        row[key] = value.isoformat()
+                row["_id"] = str(row["_id"])
+                yield "%s\n" % dumps(row)
+            if len(rows) < n:
+                break
+            sent += len(rows)
+            after = ObjectId(rows[-1]["_id"])
+
     def get(self):
-        limit = int(request.form.get("limit", 1000))
-        site = str(request.form.get("site", "None"))
-        status = str(request.form.get("status", "New"))
-        filetype = str(request.form.get("filetype", "root"))
+        """ lists files with site, status & filetype ordered by _id, at most limit of them.
+            continue with after=<next> of the previous answer to read the next page.
+            with format=ndjson, the files (fields, comma-separated) are streamed as newline-delimited JSON instead,
+            all of them unless limit is given.
+        """
+        limit = int(request.values.get("limit", 1000))
+        site = str(request.values.get("site", "None"))
+        status = str(request.values.get("status", "New"))
+        filetype = str(request.values.get("filetype", "root"))
         try:
-            dfs = DataFile.objects.filter(site=site, status=status, filetype=filetype).limit(limit)
-            logger.debug("DataCatalog:GET: found %i files matching query", dfs.count())
+            query = {"site": site, "status": status, "filetype": filetype}
+            after = ObjectId(request.values["after"]) if request.values.get("after", "") else None
+            if limit <= 0:
+                raise Exception("limit MUST be positive")
+            if request.values.get("format", "json") == "ndjson":
+                fields = request.values.get("fields", "filename,size,checksum,created_at").split(",")
+                projection = dict([(str(f), 1) for f in fields] + [("_id", 1)])
+                page = int(request.values.get("page", 1000))
+                if page <= 0:
+                    raise Exception("page MUST be positive")
+                limit = limit if "limit" in request.values else None
+                return Response(stream_with_context(self.__rows__(query, projection, after, limit, page)),
+                                mimetype="application/x-ndjson")
+            dfs = DataFile.page(query, after=after, limit=limit, projection={"filename": 1})
+            logger.debug("DataCatalog:GET: found %i files matching query", len(dfs))
         except Exception as ex:
             logger.error("DataCatalog:GET: %s", ex)
             return dumps({"result": "nok", "error": str(ex)})
-        return dumps({"result": "ok", "files": [f.filename for f in dfs]})
+        # no next page if this one is not full
+        last = str(dfs[-1]["_id"]) if len(dfs) and len(dfs) == limit else None
+        return dumps({"result": "ok", "files": [f["filename"] for f in dfs], "next": last})
+
+class DataCatalogClaim(MethodView):
+    """ claims the next <limit> files with <status> (default New) at a site for a transfer agent, 
+        the files are set InProgress under a lease token and returned with their ids.
+        the agent then sets them Copied (or back to New) through /datacat/. """
+
+    def get(self):
+        return dumps({"result": "nok", "error": "claiming files requires POST"})
+
+    def post(self):
+        logger.debug("DataCatalogClaim:POST: request form %s", str(request.form))
+        site = str(request.form.get("site", "None"))
+        filetype = str(request.form.get("filetype", "root"))
+        status = str(request.form.get("status", "New"))
+        try:
+            if status == "InProgress":
+                raise Exception("can't claim files InProgress, their leases expire after lease_timeout")
+            token, files = DataFile.claim(site, filetype=filetype, limit=int(request.form.get("limit", 100)), status=status)
+            logger.debug("DataCatalogClaim:POST: claimed %i files with lease %s", len(files), token)
+        except Exception as err:
+            logger.exception("DataCatalogClaim:POST: %s", err)
+            return dumps({"result": "nok", "error": str(err)})
+        files = [{"docId": str(f["_id"]), "filename": f["filename"], "size": f.get("size", None),
+                  "checksum": f.get("checksum", None)} for f in files]
+        return dumps({"result": "ok", "files": files, "lease": token})
+
+class DataCatalogBulk(MethodView):
+    """ registers a list of files with one insert_many (per chunk), the files are sent as JSON array of records
+        (filename or name, site, filetype or type, size, checksum, status), either as request body or in the form
+        field data. site, filetype & overwrite may also be given once for all files (form or query string).
+        returns one result per record, in the order received. 
+    """
+    aliases = {"name": "filename", "type": "filetype"}
+
+    def get(self):
+        return dumps({"result": "nok", "error": "bulk registration requires POST"})
+
+    def post(self):
+        try:
+            records = request.get_json(silent=True)
+            if records is None:
+                records = loads(request.form.get("data", "[]"))
+            if not isinstance(records, list):
+                raise Exception("files MUST be a list of file records.")
+            site = request.values.get("site", None)
+            filetype = request.values.get("filetype", None)
+            overwrite = str(request.values.get("overwrite", "False")) in ["true", "True", "TRUE"]
+        except Exception as err:
+            logger.exception("DataCatalogBulk:POST: %s", err)
+            return dumps({"result": "nok", "error": str(err)})
+        logger.debug("DataCatalogBulk:POST: found %i files to register", len(records))
+        results = [{"result": "nok", "error": "record MUST be dictionary."} for _ in records]
+        valid = []
+        files = []
+        for i, record in enumerate(records):
+            if not isinstance(record, dict): continue
+            record = {self.aliases.get(key, key): value for key, value in record.iteritems()}
+            if site is not None: record.setdefault("site", site)
+            if filetype is not None: record.setdefault("filetype", filetype)
+            valid.append(i)
+            files.append(record)
+        try:
+            for i, res in zip(valid, DataFile.registerMany(files, overwrite=overwrite)):
+                results[i] = {"result": "nok", "error": str(res)} if isinstance(res, Exception) else {"result": "ok", "docId": str(res)}
+        except Exception as err:
+            logger.exception("DataCatalogBulk:POST: %s", err)
+            return dumps({"result": "nok", "error": str(err)})
+        nok = len([r for r in results if r["result"] != "ok"])
+        return dumps({"result": "ok", "registered": len(records) - nok, "failed": nok, "results": results})
+
 
 # Register the urls
 jobs.add_url_rule('/', view_func=ListView.as_view('list'))
@@ -655,7 +1151,14 @@ jobs.add_url_rule("/job/", view_func=JobView.as_view('jobs'), methods=["GET", "P
 jobs.add_url_rule('/jobInstances/detail', view_func=InstanceView.as_view('instanceDetail'))
 jobs.add_url_rule("/jobInstances/", view_func=JobInstanceView.as_view('jobinstances'), methods=["GET", "POST"])
 jobs.add_url_rule("/jobstatus/", view_func=SetJobStatus.as_view('jobstatus'), methods=["GET", "POST"])
+jobs.add_url_rule("/jobstatus/batch/", view_func=SetJobStatusBatch.as_view('jobstatusBatch'), methods=["GET", "POST"])
 jobs.add_url_rule("/jobstatusBulk/", view_func=SetJobStatusBulk.as_view('jobstatusBulk'), methods=["GET", "POST"])
+jobs.add_url_rule("/rollback/bulk/", view_func=RollBackBulk.as_view('rollbackBulk'), methods=["GET", "POST"])
 jobs.add_url_rule("/newjobs/", view_func=NewJobs.as_view('newjobs'), methods=["GET"])
+jobs.add_url_rule("/newjobs/claim/", view_func=ClaimNewJobs.as_view('newjobsClaim'), methods=["GET", "POST"])
+jobs.add_url_rule("/newjobs/wait/", view_func=WaitNewJobs.as_view('newjobsWait'), methods=["GET", "POST"])
 jobs.add_url_rule("/testDB/", view_func=TestView.as_view('testDB'), methods=["GET", "POST"])
 jobs.add_url_rule("/datacat/", view_func=DataCatalog.as_view('datacat'), methods=["GET", "POST"])
+jobs.add_url_rule("/datacat/bulk/", view_func=DataCatalogBulk.as_view('datacatBulk'), methods=["GET", "POST"])
+jobs.add_url_rule("/datacat/claim/", view_func=DataCatalogClaim.as_view('datacatClaim'), methods=["GET", "POST"])
+jobs.add_url_rule("/api/jobs/<slug>/instances", view_func=InstanceExport.as_view('instanceExport'), methods=["GET"])
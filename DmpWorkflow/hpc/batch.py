@@ -3,12 +3,87 @@ Created on Mar 22, 2016
 
 @author: zimmer
 """
-from DmpWorkflow.utils.shell import run
+from DmpWorkflow.utils.shell import run, make_executable
+from DmpWorkflow.utils.tools import mkdir, random_string_generator
+from DmpWorkflow.config.defaults import cfg
+from os.path import join as oPjoin, isfile, isdir, islink, getmtime, lexists, realpath
+from os import rename, getpid, symlink, remove, listdir, lstat
+from shutil import rmtree
+from re import match
+from time import strftime, time
+from cPickle import load, dump, HIGHEST_PROTOCOL
+from fcntl import flock, LOCK_EX, LOCK_UN
+from xml.etree.cElementTree import iterparse
 import logging
 
 BATCH_ID_ENV = "NOT_DEFINED"
 
 
+class BatchRecord(object):
+    """ mixin for the namedtuple records holding one job of the batch queue,
+        keeps the read-only dictionary access (job['STAT'], job.get('STAT')) used throughout the client. 
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return list(self._fields)
+
+
+def padFields(fields, n):
+    """ returns exactly n fields, missing ones are None """
+    if len(fields) >= n:
+        return fields[0:n]
+    return fields + [None] * (n - len(fields))
+
+
+def parseQstatXml(source, record, status_map, filterUser=None):
+    """ streaming parser for the output of qstat -x (sge & pbs), source is a file-like object.
+        yields (batchId, record) with record(USER, STAT, EXEC_HOST, JOB_NAME, CPU_USED, MEM),
+        each Job element is discarded once it is parsed. array tasks (sge) are yielded as batchId.task,
+        array elements (pbs) keep their batchId[i]. 
+    """
+    context = iterparse(source, events=("start", "end"))
+    root = None
+    for event, elem in context:
+        if root is None:
+            root = elem
+        if event != "end" or elem.tag != "Job":
+            continue
+        usr = elem.findtext("Job_Owner", "None")
+        if "@" in usr:
+            usr = usr.split("@")[0]
+        if filterUser is None or usr == filterUser:
+            stat = elem.findtext("job_state", "U").lower()  # unknown
+            if stat not in status_map:
+                stat = 'u'
+            cpu = mem = None
+            res = elem.find("resources_used")
+            if res is not None:
+                mem = float(res.findtext("mem", "0kb").rsplit("kb")[0])
+                cpu = res.findtext("cput", "00:00:00.000")
+            batchId = elem.findtext("Job_Id", "None").split(".")[0]
+            task = elem.findtext("tasks", "")
+            if task.isdigit():
+                batchId = "%s.%s" % (batchId, task)
+            yield batchId, record(usr, stat, elem.findtext("exec_host"),
+                                                                        elem.findtext("Job_Name", "None-None"), cpu, mem)
+        root.clear()
+
+
 class BatchJob(object):
     """ generic batch job which can be expanded by classes inheriting from this class """
     name = None
@@ -104,13 +179,68 @@ class BATCH(object):
     parameter_map = {}
     kind = "generic"
     user = None
+    # key of the job name in the records of allJobs
+    name_key = "JOB_NAME"
+    # id of the i-th element of an array job (e.g. "%i[%i]") & the pattern splitting it into (batchId, index),
+    # backends that don't support arrays leave them None.
+    array_format = None
+    array_pattern = None
+    array_base = 1
+    # job name of the array jobs (where the batch system takes it from the submission)
+    array_name = "dwf-array"
 
     def __init__(self):
         self.logging = logging.getLogger("core")
+        self.arrayNames = {}
 
-    def update(self):
+    def aggregateStatii(self, *args, **kwargs):
+        """ should be implemented by subclass, queries the batch system & returns dictionary indexed by batchId """
         return {}
 
+    def __snapshotFile__(self):
+        """ one snapshot per batch system & user, shared among all tools running on this site """
+        return oPjoin(cfg.get("site", "workdir"), ".batch-%s-%s.snapshot" % (self.kind, self.getUser()))
+
+    def __readSnapshot__(self, fname, ttl):
+        """ returns the cached jobs if the snapshot is younger than ttl (seconds), None otherwise """
+        if not isfile(fname) or time() - getmtime(fname) > ttl:
+            return None
+        try:
+            with open(fname, "rb") as snapshot:
+                return load(snapshot)
+        except Exception as err:
+            self.logging.warning("could not read batch snapshot %s: %s", fname, err)
+            return None
+
+    def update(self, ttl=None):
+        """ fills allJobs with the state of the batch queue, the output of aggregateStatii is cached in a 
+            site-local snapshot for ttl seconds (default: batch_snapshot_ttl), 
+            a lock makes sure that concurrent callers wait for a single query instead of running their own.
+            ttl = 0 forces a refresh.
+        """
+        ttl = float(cfg.get("site", "batch_snapshot_ttl") if ttl is None else ttl)
+        fname = self.__snapshotFile__()
+        jobs = self.__readSnapshot__(fname, ttl)
+        if jobs is None:
+            mkdir(cfg.get("site", "workdir"))
+            with open("%s.lock" % fname, "w") as lock:
+                flock(lock, LOCK_EX)
+                try:
+                    # somebody else may have refreshed the snapshot while we were waiting for the lock.
+                    jobs = self.__readSnapshot__(fname, ttl) if ttl > 0 else None
+                    if jobs is None:
+                        self.allJobs = {}
+                        jobs = self.aggregateStatii()
+                        tmp = "%s.%i" % (fname, getpid())
+                        with open(tmp, "wb") as snapshot:
+                            dump(jobs, snapshot, HIGHEST_PROTOCOL)
+                        rename(tmp, fname)
+                        self.logging.debug("refreshed batch snapshot %s with %i jobs", fname, len(jobs))
+                finally:
+                    flock(lock, LOCK_UN)
+        self.allJobs = jobs
+        return self.allJobs
+
     def getCPUtime(self, job, key=None):
         print job, key
         return 0.
@@ -128,6 +258,127 @@ class BATCH(object):
     def checkJobsFast(self, pending=True):
         return len(self.getRunningJobs(pending=pending))
 
+    def elementId(self, batchId, index=None):
+        """ returns the id the batch system uses for element index of array batchId, batchId if index is None """
+        if index is None or self.array_format is None:
+            return batchId
+        return self.array_format % (int(batchId), int(index))
+
+    def splitElementId(self, elementId):
+        """ reverse of elementId, returns (batchId, index) or None if elementId is not an array element """
+        if self.array_pattern is None:
+            return None
+        res = match(self.array_pattern, str(elementId))
+        if res is None:
+            return None
+        return int(res.group(1)), int(res.group(2))
+
+    def __arrayLink__(self, batchId):
+        return oPjoin(cfg.get("site", "workdir"), "arrays", "%s-%s" % (self.kind, batchId))
+
+    def __registerArray__(self, wd, batchId):
+        """ links the directory of the array to its batchId, see getJobName """
+        link = self.__arrayLink__(batchId)
+        if lexists(link):
+            remove(link)
+        symlink(wd, link)
+
+    def __arrayNames__(self, batchId):
+        """ returns the job names of the elements of array batchId (read from its array.names), None if unknown """
+        if batchId not in self.arrayNames:
+            fname = oPjoin(self.__arrayLink__(batchId), "array.names")
+            self.arrayNames[batchId] = open(fname).read().split("\n") if isfile(fname) else None
+        return self.arrayNames[batchId]
+
+    def getJobName(self, batchId):
+        """ returns the job name (<jobId>-<instanceId>) of batchId, elements of array jobs,
+            which all carry the name of the array, are looked up by their index.
+        """
+        split = self.splitElementId(batchId)
+        if split is not None:
+            names = self.__arrayNames__(split[0])
+            pos = split[1] - self.array_base
+            if names is not None and 0 <= pos < len(names) and len(names[pos]):
+                return names[pos]
+        return self.allJobs[batchId][self.name_key]
+
+    def isArrayPlaceholder(self, batchId):
+        """ True for the single record some batch systems list for the pending elements of an array
+            (e.g. NNN_[1-10] in slurm), the elements are reported once they are listed on their own.
+        """
+        if self.splitElementId(batchId) is not None:
+            return False
+        if self.allJobs.get(batchId, {}).get(self.name_key, None) == self.array_name:
+            return True
+        res = match(r"^(\d+)\D", str(batchId))
+        return res is not None and self.__arrayNames__(int(res.group(1))) is not None
+
+    def cleanArrays(self, max_age=None):
+        """ removes the directories of arrays (and their links) that are no longer in the queue (see update) 
+            and older than max_age seconds (default: array_max_age), returns the number of directories removed.
+        """
+        max_age = float(cfg.get("site", "array_max_age") if max_age is None else max_age)
+        root = oPjoin(cfg.get("site", "workdir"), "arrays")
+        if not isdir(root):
+            return 0
+        queued = set()
+        for batchId in self.allJobs:
+            res = match(r"^(\d+)", str(batchId))
+            if res is not None:
+                queued.add(res.group(1))
+        prefix = "%s-" % self.kind
+        now = time()
+        kept = set()
+        for entry in listdir(root):
+            path = oPjoin(root, entry)
+            if not islink(path):
+                continue
+            # links of other batch systems sharing the workdir are left alone.
+            if not entry.startswith(prefix) or entry[len(prefix):] in queued or now - lstat(path).st_mtime < max_age:
+                kept.add(realpath(path))
+                continue
+            remove(path)
+        removed = 0
+        for entry in listdir(root):
+            path = oPjoin(root, entry)
+            if islink(path) or not isdir(path) or realpath(path) in kept or now - getmtime(path) < max_age:
+                continue
+            rmtree(path, ignore_errors=True)
+            removed += 1
+        return removed
+
+    def submitArray(self, jobs, **kwargs):
+        """ submits a list of BatchJob instances (sharing the same batch defaults), 
+            returns the batch ids in the order of jobs. 
+            backends supporting array jobs submit all of them with a single command, 
+            the generic implementation submits them one by one. 
+        """
+        return [job.submit(**kwargs) for job in jobs]
+
+    def __writeArrayWrapper__(self, jobs, index_env, element_id, base=1):
+        """ writes the commands of jobs to array.jobs (one per line, output going to the log file of the job)
+            and the wrapper array.sh which executes the line given by the array index in index_env,
+            the element id (shell expression element_id) is exported as DWF_BATCH_ID for the payload.
+            returns the directory and the path of the wrapper.
+        """
+        wd = oPjoin(cfg.get("site", "workdir"), "arrays", "%s-%s" % (strftime("%Y%m%d-%H%M%S"), random_string_generator(6)))
+        mkdir(wd)
+        with open(oPjoin(wd, "array.jobs"), "w") as job_list:
+            job_list.write("".join(["%s > %s 2>&1\n" % (job.command, job.logFile) for job in jobs]))
+        with open(oPjoin(wd, "array.names"), "w") as name_list:
+            name_list.write("".join(["%s\n" % job.name for job in jobs]))
+        wrapper = oPjoin(wd, "array.sh")
+        with open(wrapper, "w") as script:
+            script.write("\n".join(["#!/bin/bash",
+                                    "# array job wrapper, executes the command matching the array index",
+                                    "export DWF_BATCH_ID=\"%s\"" % element_id,
+                                    "LINE=$(( ${%s} - %i + 1 ))" % (index_env, base),
+                                    "CMD=$(sed -n \"${LINE}p\" %s)" % oPjoin(wd, "array.jobs"),
+                                    "echo \"array index ${%s}: ${CMD}\"" % index_env,
+                                    "eval ${CMD}\n"]))
+        make_executable(wrapper)
+        return wd, wrapper
+
     def addBatchJob(self, job):
         if not isinstance(job, BatchJob):
             self.logging.error("must be BatchJob instance")
@@ -147,10 +398,13 @@ class BATCH(object):
         return self.user
 
     def getJob(self, jobID, key="STAT"):
+        if jobID not in self.allJobs and str(jobID) in self.allJobs:
+            jobID = str(jobID)
         if jobID not in self.allJobs:
             self.logging.error("could not find job %s", jobID)
+            return None
         self.__checkKeys__(key)
-        return callable(self.allJobs[jobID][key])
+        return self.allJobs[jobID][key]
 
     def getAttributeForAllJobs(self, attr="MEM"):
         """ convenience function to return all values for a certain attribute """
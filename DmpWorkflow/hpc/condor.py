@@ -8,14 +8,40 @@ from warnings import warn, simplefilter
 simplefilter('always', DeprecationWarning)
 from re import findall
 from DmpWorkflow.config.defaults import BATCH_DEFAULTS as defaults 
-from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob
+from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob, BatchRecord, padFields
 from DmpWorkflow.utils.shell import run
-from collections import OrderedDict
-from copy import deepcopy
-from os.path import dirname, curdir
+from collections import OrderedDict, namedtuple
+from cStringIO import StringIO
+from os.path import dirname, curdir, join as op_join
 from os import chdir
 #raise ImportError("CondorHT class not supported")
 BATCH_ID_ENV = "CONDOR_ID"
+KEYS = ['id', 'owner', 'submit_date', 'submit_time', 'run_time', 'st', 'pri', 'size', 'cmd']
+
+
+class Record(BatchRecord, namedtuple("Record", KEYS)):
+    """ one line of condor_q """
+    __slots__ = ()
+
+
+def parseCondorQ(lines):
+    """ streaming parser for condor_q, lines is any iterable (e.g. a file), yields (batchId, record).
+        the batchId is the cluster for process 0 (single jobs), cluster.process for the other elements of an array.
+    """
+    nkeys = len(KEYS)
+    for i, line in enumerate(lines):
+        if i < 4:
+            continue  # header
+        fields = line.split()
+        if not len(fields) or "." not in fields[0]:
+            continue
+        cluster, process = fields[0].split(".", 1)
+        try:
+            batchId = int(cluster) if process == "0" else "%i.%i" % (int(cluster), int(process))
+        except ValueError:
+            batchId = fields[0]
+        yield batchId, Record(*padFields(fields, nkeys))
+
 
 class BatchJob(HPCBatchJob):
     def submit(self, **kwargs):
@@ -55,17 +81,57 @@ class BatchJob(HPCBatchJob):
         return bk
     
     def kill(self):
-        cmd = "condor_rm -name %s %s.0"%(defaults.extra,self.batchId)
+        # elements of an array are given as cluster.process already
+        bId = self.batchId if "." in str(self.batchId) else "%s.0" % self.batchId
+        cmd = "condor_rm -name %s %s"%(defaults['extra'],bId)
         self.__run__(cmd)
         self.update("status", "Failed")
 
 class BatchEngine(BATCH):
     kind = "condor"
+    keys = KEYS
     name = defaults['extra']
     status_map = {"R": "Running", "Q": "Submitted","X": "Terminated", "C": "Completed"}
+    array_format = "%i.%i"
+    array_pattern = r"^(\d+)\.(\d+)$"
+    array_base = 0
+
+    def elementId(self, batchId, index=None):
+        """ process 0 is listed under the cluster, see parseCondorQ """
+        if not index:
+            return batchId
+        return super(BatchEngine, self).elementId(batchId, index)
 
-    def update(self):
-        self.allJobs.update(self.aggregateStatii())
+    def splitElementId(self, elementId):
+        split = super(BatchEngine, self).splitElementId(elementId)
+        if split is None and str(elementId).isdigit():
+            return int(elementId), 0
+        return split
+
+    def submitArray(self, jobs, **kwargs):
+        """ submits all jobs with a single job.csi (queue N), returns cluster.process for each job """
+        if len(jobs) < 2:
+            return super(BatchEngine, self).submitArray(jobs, **kwargs)
+        wd, wrapper = self.__writeArrayWrapper__(jobs, "DWF_ARRAY_INDEX", "${CONDOR_ID}.${DWF_ARRAY_INDEX}", base=0)
+        bj = jobs[0]
+        d = OrderedDict()
+        d['universe']='vanilla'
+        d['executable']=wrapper
+        d['output']=op_join(wd, "$(Process).log")
+        d['error']=op_join(wd, "$(Process).err")
+        d['log']=op_join(wd, "array.clog")
+        d['request_cpus']=1
+        d['request_memory']=bj.memory
+        d['rank']='Memory'
+        d['requirements']= "MaxHosts == 1"
+        d['environment'] = "CONDOR_ID=$(Cluster) DWF_ARRAY_INDEX=$(Process)"
+        csi = op_join(wd, "job.csi")
+        with open(csi, "w") as csi_file:
+            csi_file.write("".join(["%s = %s\n"%(k,v) for k,v in d.iteritems()]))
+            csi_file.write("queue %i\n" % len(jobs))
+        batchId = bj.__regexId__(bj.__run__(["condor_submit", csi, "-name", defaults['extra']]))
+        self.__registerArray__(wd, batchId)
+        return [self.elementId(batchId, i) for i in xrange(len(jobs))]
 
     def getCPUtime(self, jobId, key="CPU_USED"):
         warn("not implemented", DeprecationWarning)
@@ -95,15 +161,4 @@ class BatchEngine(BATCH):
         if error is not None:
             for e in error.split("\n"):
                 self.logging.error(e)
-        try:
-            jobs = output.split("\n")[4:-1]
-            keys = ['id', 'owner', 'submit_date','submit_time','run_time', 'st', 'pri', 'size', 'cmd']
-            for job in jobs:
-                thisDict = dict(zip(keys,job.split()))
-                if "id" in thisDict:
-                    self.allJobs[int(float(thisDict['id']))]=deepcopy(thisDict)
-                thisDict = {}
-        except Exception as error:
-            print "error has occured:"
-            print error
-        return self.allJobs
+        return dict(parseCondorQ(StringIO(output)))
@@ -3,12 +3,43 @@ Created on Mar 23, 2016
 
 @author: zimmer
 """
-from re import findall
-from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob
+from re import findall, compile as re_compile
+from os.path import join as oPjoin
+from collections import namedtuple
+from cStringIO import StringIO
+from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob, BatchRecord, padFields
 from DmpWorkflow.utils.shell import run
 
 # LSF-specific stuff
 BATCH_ID_ENV = "LSB_JOBID"
+KEYS = ["USER", "STAT", "QUEUE", "FROM_HOST", "EXEC_HOST", "JOB_NAME", "SUBMIT_TIME", "PROJ_NAME", "CPU_USED",
+        "MEM", "SWAP", "PIDS", "START_TIME", "FINISH_TIME", "SLOTS"]
+ARRAY_INDEX = re_compile(r"\[(\d+)\]$")
+
+
+class Record(BatchRecord, namedtuple("Record", KEYS)):
+    """ one line of bjobs -Wa """
+    __slots__ = ()
+
+
+def parseBjobs(lines):
+    """ streaming parser for bjobs -Wa, lines is any iterable (e.g. a file), yields (batchId, record).
+        elements of array jobs share the JOBID, they are told apart by the [i] suffix of their JOB_NAME
+        and yielded as JOBID[i].
+    """
+    nkeys = len(KEYS)
+    name = KEYS.index("JOB_NAME")
+    header = True
+    for line in lines:
+        if header:
+            header = False
+            continue
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        record = Record(*padFields(fields[1:], nkeys))
+        index = ARRAY_INDEX.search(record[name] or "")
+        yield fields[0] if index is None else "%s[%s]" % (fields[0], index.group(1)), record
 
 
 class BatchJob(HPCBatchJob):
@@ -71,14 +102,30 @@ class BatchJob(HPCBatchJob):
 
 class BatchEngine(BATCH):
     kind = "lsf"
-    keys = ["USER", "STAT", "QUEUE", "FROM_HOST", "EXEC_HOST", "JOB_NAME", "SUBMIT_TIME", "PROJ_NAME", "CPU_USED", \
-            "MEM", "SWAP", "PIDS", "START_TIME", "FINISH_TIME", "SLOTS"]
+    keys = KEYS
     status_map = {"RUN": "Running", "PEND": "Submitted", "SSUSP": "Suspended", "USUSP": "Suspended",
                   "EXIT": "Failed", "DONE": "Done", "UNKWN": "Failed"}
     parameter_map = {"mem": "MEM", "cpu": "CPU_USED"}
-
-    def update(self):
-        self.allJobs.update(self.aggregateStatii())
+    array_format = "%i[%i]"
+    array_pattern = r"^(\d+)\[(\d+)\]$"
+
+    def submitArray(self, jobs, **kwargs):
+        """ submits all jobs as one array job (bsub -J name[1-N]), returns NNN[i] for each job """
+        if len(jobs) < 2:
+            return super(BatchEngine, self).submitArray(jobs, **kwargs)
+        wd, wrapper = self.__writeArrayWrapper__(jobs, "LSB_JOBINDEX", "${LSB_JOBID}[${LSB_JOBINDEX}]")
+        bj = jobs[0]
+        requirements = bj.requirements
+        if requirements == "": requirements = []
+        if isinstance(requirements, str): requirements = requirements.split(",")
+        requirements = list(requirements) + ["rusage[mem=%i]" % int(bj.memory)]
+        extra = bj.extra.replace('"', "").split() if isinstance(bj.extra, str) else []
+        cmd = ["bsub", "-J", "dwf-array[1-%i]" % len(jobs), "-c", bj.cputime, "-q", bj.queue,
+               "-oo", oPjoin(wd, "%I.log"), "-R", " && ".join(requirements)] + extra + [wrapper]
+        if 'verbose' in kwargs and kwargs['verbose']: print " ".join(cmd)
+        batchId = bj.__regexId__(bj.__run__(cmd))
+        self.__registerArray__(wd, batchId)
+        return [self.elementId(batchId, i + 1) for i in xrange(len(jobs))]
 
     def getCPUtime(self, jobId, key="CPU_USED"):
         """ format is: 000:00:00.00 """
@@ -127,10 +174,8 @@ class BatchEngine(BATCH):
             return out['RUN']
 
     def aggregateStatii(self, asDict=True, command=None):
-        # print self.keys
         if command is None:
             command = ["bjobs", "-Wa"]
-        jobs = {}
         output, error, rc = run(command, useLogging=False, interleaved=False, suppressLevel=True)
         self.logging.debug("rc: %i", int(rc))
         if error is not None:
@@ -140,17 +185,4 @@ class BatchEngine(BATCH):
                     self.logging.error(e)
         if not asDict:
             return output
-        else:
-            for i, line in enumerate(output.split("\n")):
-                if i > 0:
-                    this_line = line.split(" ")
-                    jobID = this_line[0]
-                    this_line.remove(this_line[0])
-                    while "" in this_line:   # TODO: What is the point of this???
-                        this_line.remove("")
-                    # print len(this_line), len(self.keys)
-                    this_job = dict(zip(self.keys, this_line))
-                    if len(this_job):
-                        # print i, this_job
-                        jobs[jobID] = this_job
-            return jobs
+        return dict(parseBjobs(StringIO(output)))
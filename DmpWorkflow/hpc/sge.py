@@ -4,17 +4,21 @@ Created on Mar 23, 2016
 @author: zimmer
 """
 import re
-from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob
+from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob, BatchRecord, parseQstatXml
 from DmpWorkflow.utils.shell import run
-from importlib import import_module
-
-xml2dict = import_module("xmltodict")
+from collections import namedtuple
+from cStringIO import StringIO
 # LSF-specific stuff
 
 # raise ImportError("SGE class not supported")
 BATCH_ID_ENV = "JOB_ID"
 
 
+class Record(BatchRecord, namedtuple("Record", ["USER", "STAT", "EXEC_HOST", "JOB_NAME", "CPU_USED", "MEM"])):
+    """ one job in the output of qstat -x """
+    __slots__ = ()
+
+
 class BatchJob(HPCBatchJob):
     def submit(self, **kwargs):
         """ each class MUST implement its own submission command """
@@ -39,17 +43,33 @@ class BatchJob(HPCBatchJob):
     def kill(self):
         """ likewise, it should implement its own batch-specific removal command """
         cmd = "qdel %s" % self.batchId
+        if "." in str(self.batchId):
+            # element of an array job: qdel NNN -t i
+            cmd = "qdel %s -t %s" % tuple(str(self.batchId).split(".", 1))
         self.__run__(cmd)
         self.update("status", "Failed")
 
 
 class BatchEngine(BATCH):
     kind = "sge"
+    keys = list(Record._fields)
     status_map = {"r": "Running", "qw": "Submitted", "s": "Suspended",
                   "c": "Suspended", "t": "Terminated", "e": "Failed"}
+    array_format = "%i.%i"
+    array_pattern = r"^(\d+)\.(\d+)$"
 
-    def update(self):
-        self.allJobs.update(self.aggregateStatii())
+    def submitArray(self, jobs, **kwargs):
+        """ submits all jobs as one array job (qsub -t 1-N), returns NNN.i for each job """
+        if len(jobs) < 2:
+            return super(BatchEngine, self).submitArray(jobs, **kwargs)
+        wd, wrapper = self.__writeArrayWrapper__(jobs, "SGE_TASK_ID", "${JOB_ID}.${SGE_TASK_ID}")
+        bj = jobs[0]
+        extra = bj.extra.split() if isinstance(bj.extra, str) else []
+        cmd = ["qsub", "-t", "1-%i" % len(jobs), "-m", "n", "-o", wd, "-j", "y", "-V",
+               "-l", "ct=%s" % bj.cputime, "-l", "vmem=%s" % bj.memory] + extra + [wrapper]
+        batchId = bj.__regexId__(bj.__run__(cmd))
+        self.__registerArray__(wd, batchId)
+        return [self.elementId(batchId, i + 1) for i in xrange(len(jobs))]
 
     def getCPUtime(self, jobId, key="CPU_USED"):
         """ format is: 000:00:00.00 """
@@ -80,33 +100,7 @@ class BatchEngine(BATCH):
 
     def __parseOutputAsXml__(self, xmloutput, filterUser):
         """ returns job dictionary """
-        jobs = {}
-        output = xml2dict.parse(xmloutput)
-        data = output.get("Data", "None")
-        if "None":
-            self.logging.error("could not get data content from qstat, check SGE")
-        sge_jobs = data.get("Job", "None")
-        if sge_jobs == "None": sge_jobs = []
-        if len(sge_jobs):
-            for j in sge_jobs:
-                usr = j.get("Job_Owner", "None")
-                if "@" in usr:
-                    usr = usr.rsplit("@")[0]
-                if filterUser is not None:
-                    if not usr == filterUser: continue
-                stat = j.get("job_state", "U").lower()  # unknown
-                if stat.lower() not in self.status_map.keys():
-                    stat = 'u'
-                cpu = None
-                mem = None
-                res = j.get("resources_used", "None")
-                if res != "None":
-                    mem = float(res.get("mem", "0kb").rsplit("kb")[0])
-                    cpu = res.get("cput", "00:00:00.000")
-                this_job = {"USER": usr, "MEM": mem, "CPU_USED": cpu, "JOB_NAME": "None-None",
-                            "STAT": stat, "EXEC_HOST": j.get("exec_host")}
-                jobs[j.get("Job_Id", "None").split(".")[0]] = this_job
-        return jobs
+        return dict(parseQstatXml(StringIO(xmloutput), Record, self.status_map, filterUser=filterUser))
 
     def aggregateStatii(self, asDict=True, command=None):
         checkUser = self.getUser()
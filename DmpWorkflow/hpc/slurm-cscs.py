@@ -9,16 +9,18 @@ from warnings import warn, simplefilter
 simplefilter('always', DeprecationWarning)
 from re import findall
 from DmpWorkflow.config.defaults import BATCH_DEFAULTS as defaults
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL
+from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URLS
 from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob
+from DmpWorkflow.hpc.slurm import KEYS, parseSqueue
 from DmpWorkflow.utils.shell import run
 from collections import OrderedDict
-from copy import deepcopy
+from cStringIO import StringIO
 from os.path import dirname, curdir, join as op_join
 from os import chdir
 
 BATCH_ID_ENV = "SLURM_JOB_ID"
 
+
 class BatchJob(HPCBatchJob):
     def submit(self, **kwargs):
         """ each class MUST implement its own submission command """
@@ -47,7 +49,7 @@ class BatchJob(HPCBatchJob):
         # now add CSCS specific stuff
         job_file.write("module load daint-{constraint}\n".format(constraint=d['constraint']))
         job_file.write("module load shifter-ng\n")
-        job_file.write("export DAMPE_WORKFLOW_SERVER_URL=%s\n"%DAMPE_WORKFLOW_URL)
+        job_file.write("export DAMPE_WORKFLOW_SERVER_URL=%s\n"%",".join(DAMPE_WORKFLOW_URLS))
         job_file.write("export NTHREADS=%i\n"%nCPU)
         ### shifter_call = '\nsrun -C gpu shifter --image={image} --volume={wd}:/workdir bash -c "bash /workdir/script"\n'.format(image=d['image'],wd=wd)
         shifter_call = '\nsrun -C {constraint} shifter run --mount=type=bind,source={wd},destination=/workdir --mount=type=bind,source=$HOME,destination=$HOME {image} bash -c "bash /workdir/script"\n'.format(image=img,wd=wd,constraint=d['constraint'])
@@ -78,7 +80,9 @@ class BatchJob(HPCBatchJob):
 
 class BatchEngine(BATCH):
     kind = "slurm-cscs"
+    keys = KEYS
     name = "cscs"
+    name_key = "name"
     status_map = {"CA":"Cancelled","CD":"Completed",
                   "CF":"Configuring","CG":"Completing",
                   "F":"Failed","NF":"Failed",
@@ -86,9 +90,6 @@ class BatchEngine(BATCH):
                   "R":"Running","S":"Pending",
                   "TO":"Failed"}
 
-    def update(self):
-        self.allJobs.update(self.aggregateStatii())
-
     def getCPUtime(self, jobId, key="cputime"):
         if not jobId in self.allJobs: return 0
         return self.allJobs[jobId].get("cputime","0:00")
@@ -116,15 +117,4 @@ class BatchEngine(BATCH):
         if error is not None:
             for e in error.split("\n"):
                 self.logging.error(e)
-        try:
-            jobs = output.split("\n")[1:-1]
-            keys = ['id', 'partition', 'name', 'user', 'st', 'cputime', 'nodes', 'reason']
-            for job in jobs:
-                thisDict = dict(zip(keys, job.split()))
-                if "id" in thisDict:
-                    self.allJobs[int(float(thisDict['id']))] = deepcopy(thisDict)
-                thisDict = {}
-        except Exception as error:
-            print "error has occured:"
-            print error
-        return self.allJobs
+        return dict(parseSqueue(StringIO(output)))
@@ -8,16 +8,38 @@ from warnings import warn, simplefilter
 
 simplefilter('always', DeprecationWarning)
 from re import findall
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL, BATCH_DEFAULTS as defaults
-from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob
+from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URLS, BATCH_DEFAULTS as defaults
+from DmpWorkflow.hpc.batch import BATCH, BatchJob as HPCBatchJob, BatchRecord, padFields
 from DmpWorkflow.utils.shell import run
-from collections import OrderedDict
-from copy import deepcopy
+from collections import OrderedDict, namedtuple
+from cStringIO import StringIO
 from os.path import dirname, curdir, join as op_join
 from os import chdir
 
 # raise ImportError("CondorHT class not supported")
 BATCH_ID_ENV = "SLURM_JOB_ID"
+KEYS = ['id', 'partition', 'name', 'user', 'st', 'cputime', 'nodes', 'reason']
+
+
+class Record(BatchRecord, namedtuple("Record", KEYS)):
+    """ one line of squeue """
+    __slots__ = ()
+
+
+def parseSqueue(lines):
+    """ streaming parser for squeue, lines is any iterable (e.g. a file), yields (batchId, record) """
+    nkeys = len(KEYS)
+    for i, line in enumerate(lines):
+        if i == 0:
+            continue  # header
+        fields = line.split()
+        if not len(fields):
+            continue
+        try:
+            batchId = int(float(fields[0]))
+        except ValueError:
+            batchId = fields[0]
+        yield batchId, Record(*padFields(fields, nkeys))
 
 
 class BatchJob(HPCBatchJob):
@@ -40,7 +62,7 @@ class BatchJob(HPCBatchJob):
 	csi_file.write("#!/bin/bash\n")
         data = ["#SBATCH --%s=%s\n" % (k, v) for k, v in d.iteritems()]
         csi_file.write("".join(data))
-	csi_file.write("export DAMPE_WORKFLOW_SERVER_URL=%s\n"%DAMPE_WORKFLOW_URL)
+	csi_file.write("export DAMPE_WORKFLOW_SERVER_URL=%s\n"%",".join(DAMPE_WORKFLOW_URLS))
         csi_file.write("bash script\n")
         csi_file.close()
         output = self.__run__("sbatch submit.sh")
@@ -66,6 +88,7 @@ class BatchJob(HPCBatchJob):
 
 class BatchEngine(BATCH):
     kind = "slurm"
+    keys = KEYS
     name = defaults['extra']
     status_map = {"CA":"Cancelled","CD":"Completed",
                   "CF":"Configuring","CG":"Completing",
@@ -73,9 +96,34 @@ class BatchEngine(BATCH):
                   "PD":"Pending", "PR":"Failed",
                   "R":"Running","S":"Pending",
                   "TO":"Failed"}
+    name_key = "name"
+    array_format = "%i_%i"
+    array_pattern = r"^(\d+)_(\d+)$"
 
-    def update(self):
-        self.allJobs.update(self.aggregateStatii())
+    def submitArray(self, jobs, **kwargs):
+        """ submits all jobs as one array job (sbatch --array=1-N), returns NNN_i for each job """
+        if len(jobs) < 2:
+            return super(BatchEngine, self).submitArray(jobs, **kwargs)
+        wd, wrapper = self.__writeArrayWrapper__(jobs, "SLURM_ARRAY_TASK_ID", "${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}")
+        bj = jobs[0]
+        d = OrderedDict()
+        d['job-name'] = "dwf-array"
+        d['array'] = "1-%i" % len(jobs)
+        d['nodes'] = 1
+        d['partition'] = bj.queue
+        d['time'] = bj.cputime
+        d['mem'] = bj.memory
+        d['output'] = op_join(wd, "%a.log")
+        d['error'] = op_join(wd, "%a.err")
+        submit_script = op_join(wd, "submit.sh")
+        with open(submit_script, "w") as csi_file:
+            csi_file.write("#!/bin/bash\n")
+            csi_file.write("".join(["#SBATCH --%s=%s\n" % (k, v) for k, v in d.iteritems()]))
+            csi_file.write("export DAMPE_WORKFLOW_SERVER_URL=%s\n" % ",".join(DAMPE_WORKFLOW_URLS))
+            csi_file.write("bash %s\n" % wrapper)
+        batchId = bj.__regexId__(bj.__run__(["sbatch", submit_script]))
+        self.__registerArray__(wd, batchId)
+        return [self.elementId(batchId, i + 1) for i in xrange(len(jobs))]
 
     def getCPUtime(self, jobId, key="cputime"):
         if not jobId in self.allJobs: return 0
@@ -104,15 +152,4 @@ class BatchEngine(BATCH):
         if error is not None:
             for e in error.split("\n"):
                 self.logging.error(e)
-        try:
-            jobs = output.split("\n")[1:-1]
-            keys = ['id', 'partition', 'name', 'user', 'st', 'cputime', 'nodes', 'reason']
-            for job in jobs:
-                thisDict = dict(zip(keys, job.split()))
-                if "id" in thisDict:
-                    self.allJobs[int(float(thisDict['id']))] = deepcopy(thisDict)
-                thisDict = {}
-        except Exception as error:
-            print "error has occured:"
-            print error
-        return self.allJobs
+        return dict(parseSqueue(StringIO(output)))
@@ -5,10 +5,10 @@ Created on May 18, 2016
 @brief: datacatalog script
 """
 from glob import glob
-from requests import post, get
+from DmpWorkflow.utils.client import post, get
+from DmpWorkflow.utils.tools import datacat_record, register_files
 from os.path import expandvars, abspath
 from argparse import ArgumentParser
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL
 
 
 def main(args=None):
@@ -27,9 +27,15 @@ def main(args=None):
     parser.add_argument("-F", "--force", dest="force", action='store_true', default=False,
                         help='if true, force overwriting existing file')
     parser.add_argument("-l", "--limit", dest="limit", type=int, default=100, help='limit list of entries returned')
+    parser.add_argument("-p", "--page", dest="page", type=int, default=1000, help='number of files listed per request')
+    parser.add_argument("--after", dest="after", type=str, default="", help='list files after this id (as printed by list)')
+    parser.add_argument("-c", "--chunk", dest="chunk", type=int, default=None,
+                        help='number of files registered per request (default: datacat_chunk in settings.cfg)')
+    parser.add_argument("-C", "--checksum", dest="checksum", action='store_true', default=False,
+                        help='if true, register the md5 checksum of local files')
 
     opts = parser.parse_args(args)
-    assert opts.action in ['register', 'setStatus', 'delete', 'list'], "action not supported"
+    assert opts.action in ['register', 'setStatus', 'delete', 'list', 'claim'], "action not supported"
     action = opts.action
     site = opts.site
     filename = expandvars(abspath(opts.filename)) if opts.expandVars else abspath(opts.filename)
@@ -45,25 +51,52 @@ def main(args=None):
     status = opts.status
     overwrite = opts.force
     try:
+        if opts.action == 'register':
+            # bulk registration, files carry their size (and checksum) if found locally.
+            records = [datacat_record(f, site, filetype=filetype, checksum=opts.checksum) for f in files]
+            results = register_files(records, overwrite=overwrite, chunk=opts.chunk)
+            failed = [(rec["filename"], res.get("error", "Not provided")) for rec, res in zip(records, results)
+                      if res.get("result", "nok") != "ok"]
+            if not opts.quiet:
+                print "POST register: %i files registered, %i failed" % (len(results) - len(failed), len(failed))
+            for f, err in failed: print 'ERROR: %s: %s' % (f, err)
+            return
         if opts.action == 'list':
-            res = get("%s/datacat/" % DAMPE_WORKFLOW_URL, data={"site": site,
-                                                                "status": status,
-                                                                "filetype": filetype,
-                                                                "limit": opts.limit})
+            # follows the next cursor until limit files are listed (all of them if limit is 0).
+            found, after = 0, opts.after
+            while opts.limit <= 0 or found < opts.limit:
+                n = opts.page if opts.limit <= 0 else min(opts.page, opts.limit - found)
+                res = get("/datacat/", data={"site": site, "status": status, "filetype": filetype, "limit": n, "after": after})
+                res.raise_for_status()
+                result = res.json()
+                if result.get("result", "nok") != "ok":
+                    raise Exception(result.get("error", "Not provided"))
+                for f in result.get("files", []): print f
+                found += len(result.get("files", []))
+                after = result.get("next", None)
+                if after is None: break
+            if not opts.quiet:
+                print 'found %i files' % found
+                if after is not None: print 'next: %s' % after
+            return
+        if opts.action == 'claim':
+            res = post("/datacat/claim/", data={"site": site, "status": status, "filetype": filetype, "limit": opts.limit})
+            res.raise_for_status()
+            result = res.json()
+            if result.get("result", "nok") != "ok":
+                raise Exception(result.get("error", "Not provided"))
+            if not opts.quiet: print 'claimed %i files with lease %s' % (len(result["files"]), result["lease"])
+            for f in result["files"]: print f["filename"]
+            return
         else:
             dd = {"site": opts.site, "action": action, "filetype": filetype, "overwrite": overwrite,
                   "status": 'New' if action == 'register' else status, 'filename': filename}
-            res = post("%s/datacat/" % DAMPE_WORKFLOW_URL, data=dd)
+            res = post("/datacat/", data=dd)
         if res is None: return
         res.raise_for_status()
         result = res.json()
         if result.get("result", "nok") == "ok":
-            if action == 'list':
-                files = result.get("files", [])
-                if not opts.quiet: print 'found %i files' % len(files)
-                for f in files: print f
-            else:
-                if not opts.quiet: print "POST %s %s" % (action, result.get("docId", "NONE"))
+            if not opts.quiet: print "POST %s %s" % (action, result.get("docId", "NONE"))
         else:
             raise Exception(result.get("error", "Not provided"))
     except Exception as err:
@@ -5,18 +5,71 @@ Created on Mar 15, 2016
 @todo: fix logging.
 """
 #import logging
-from requests import get, post 
+from DmpWorkflow.utils.client import get, post, getClient
 from sys import exit as sys_exit
 from json import dumps
 from argparse import ArgumentParser
 from DmpWorkflow.core.DmpJob import DmpJob
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL, BATCH_DEFAULTS
+from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL, BATCH_DEFAULTS, cfg
 from DmpWorkflow.utils.tools import send_heartbeat
 from importlib import import_module
+from multiprocessing import Pool
+from time import time
 HPC = import_module("DmpWorkflow.hpc.%s" % BATCH_DEFAULTS['system'])
 
 # from DmpWorkflow.scripts.client.watchdog import __getRunningJobs
 
+def submitJob(args):
+    """ prepares the working directory of one job and submits it, returns a dictionary with
+        t_id, instanceId, batchId, the time spent in each stage and the error (if any).
+        in array mode, the job is only prepared and the arguments of its batch job are returned instead.
+        module-level function so that it can be sent to the worker processes.
+    """
+    job, pilot, pythonbin, dry, array = args
+    out = {"t_id": None, "instanceId": None, "batchId": None, "prepare": 0., "submit": 0., "error": None}
+    try:
+        t0 = time()
+        j = DmpJob.fromJSON(job)
+        if pilot: j.setAsPilot(True)
+        out.update({"t_id": j.jobId, "instanceId": j.instanceId})
+        j.write_script(pythonbin=pythonbin, debug=dry)
+        t1 = time()
+        if array and not dry:
+            j.createLogFile()
+            out["batchJob"] = {"name": j.getJobName(), "command": j.execCommand, "logFile": j.logfile,
+                               "defaults": dict(BATCH_DEFAULTS)}
+            t1 = time()
+        else:
+            out["batchId"] = j.submit(dry=dry)
+        out.update({"prepare": t1 - t0, "submit": time() - t1})
+    except Exception as e:
+        out["error"] = str(e)
+    return out
+
+
+def submitArrays(results):
+    """ submits the prepared jobs as array jobs, one array per set of batch defaults, sets the batchId of each result """
+    arrays = {}
+    for result in results:
+        if result["error"] is None:
+            key = tuple(sorted(result["batchJob"]["defaults"].iteritems()))
+            arrays.setdefault(key, []).append(result)
+    engine = HPC.BatchEngine()
+    for members in arrays.itervalues():
+        t0 = time()
+        bjobs = [HPC.BatchJob(**member["batchJob"]) for member in members]
+        try:
+            batchIds = engine.submitArray(bjobs)
+        except Exception as e:
+            for member in members:
+                member["error"] = str(e)
+            continue
+        for member, batchId in zip(members, batchIds):
+            member["batchId"] = batchId
+            member["submit"] = (time() - t0) / float(len(members))
+        print 'INFO: {msg}'.format(msg="submitted array of %i jobs in %1.2f s"%(len(members), time() - t0))
+    return results
+
 def main(args=None):
     parser = ArgumentParser(usage="Usage: %(prog)s taskName xmlFile [options]", description="create new job in DB")
     parser.add_argument("-d", "--dry", dest="dry", action='store_true', default=False,
@@ -33,6 +86,14 @@ def main(args=None):
                         help='number of jobs that can be in the system')
     parser.add_argument("-s", "--skipDBcheck", dest="skipDBcheck", action='store_true', default=False,
                         help='skip DB check for jobs')
+    parser.add_argument("-w", "--workers", dest="workers", default=1, type=int,
+                        help='number of processes preparing & submitting jobs in parallel')
+    parser.add_argument("-a", "--array", dest="array", action='store_true', default=False,
+                        help='submit the jobs of one cycle as array job(s) with a single scheduler call')
+    parser.add_argument("--no-claim", dest="claim", action='store_false', default=True,
+                        help='use the legacy /newjobs/ query instead of claiming instances (servers without /newjobs/claim/)')
+    parser.add_argument("--wait", dest="wait", default=None, type=float,
+                        help='long-poll: let the server hold the request up to WAIT seconds until new instances can be claimed')
     send_heartbeat("JobFetcher") # encapsulates the heartbeat update!
     opts = parser.parse_args(args)
     pilot = opts.pilot
@@ -48,7 +109,7 @@ def main(args=None):
             print 'skipping DB check, assume no jobs to be in the system'
         else:
             stats = 'Running,Submitted'
-            res = get("%s/newjobs/" % DAMPE_WORKFLOW_URL,
+            res = get("/newjobs/",
                           data={"site": str(batchsite), "status_list": stats, "fastQuery":"True", "pilot":"True" if pilot else "False"})
             res.raise_for_status()
             res = res.json()
@@ -66,7 +127,19 @@ def main(args=None):
     d_dict = {"site": str(batchsite), "limit": opts.chunk}
     if pilot: 
         d_dict['pilot']='True'
-    res = get("%s/newjobs/" % DAMPE_WORKFLOW_URL, data=d_dict)
+    t_fetch = time()
+    if opts.dry:
+        # a dry run only looks at the instances, claiming them would hold them back until their leases expire.
+        res = get("/newjobs/", data=d_dict)
+    elif opts.wait is not None:
+        # returns as soon as there is something to claim, the http timeout must exceed the time the server may wait.
+        d_dict['timeout'] = opts.wait
+        res = post("/newjobs/wait/", data=d_dict, timeout=opts.wait + float(cfg.get("server", "client_timeout")))
+    elif opts.claim:
+        # claimed instances carry a lease, no other fetcher will receive them.
+        res = post("/newjobs/claim/", data=d_dict)
+    else:
+        res = get("/newjobs/", data=d_dict)
     res.raise_for_status()
     res = res.json()
     if not res.get("result", "nok") == "ok":
@@ -74,7 +147,7 @@ def main(args=None):
         #log.error(res.get("error"))
     jobs = res.get("jobs")
     #log.info('found %i new job instances to deploy this cycle', len(jobs))
-    print 'INFO: {msg}'.format(msg='found %i new job instances to deploy this cycle'%len(jobs))
+    print 'INFO: {msg}'.format(msg='found %i new job instances to deploy this cycle (%1.2f s)'%(len(jobs), time() - t_fetch))
     njobs = 0
     # replace old submission block with a bulk submit
     data = []
@@ -95,21 +168,33 @@ def main(args=None):
                 #log.exception(e)
                 print 'EXCEPTION: {exc}'.format(exc=e)
     else:
-        for job in jobs:
-            j = DmpJob.fromJSON(job)
-            if pilot: j.setAsPilot(True)
-            j.write_script(pythonbin=opts.python, debug=opts.dry)
-            try:
-                j.submit(dry=opts.dry)
-                if not opts.dry:
-                    data.append({"t_id":j.jobId, "instanceId":j.instanceId})
-                    njobs += 1 
-            except Exception, e:
+        t_submit = time()
+        args = [(job, pilot, opts.python, opts.dry, opts.array) for job in jobs]
+        if opts.workers > 1 and len(jobs) > 1:
+            # processes rather than threads: preparing a job modifies os.environ.
+            pool = Pool(processes=min(opts.workers, len(jobs)))
+            results = pool.map(submitJob, args)
+            pool.close()
+            pool.join()
+        else:
+            results = [submitJob(arg) for arg in args]
+        if opts.array and not opts.dry:
+            results = submitArrays(results)
+        for result in results:
+            if result["error"] is not None:
                 #log.exception(e)
-                print 'EXCEPTION: {exc}'.format(exc=e)
+                print 'EXCEPTION: {exc}'.format(exc=result["error"])
+                continue
+            if not opts.dry:
+                data.append({"t_id":result["t_id"], "instanceId":result["instanceId"], "batchId":result["batchId"]})
+                njobs += 1
+        print 'INFO: {msg}'.format(msg="processed %i jobs in %1.2f s with %i worker(s), cumulative: prepare %1.2f s, submit %1.2f s"%
+                                   (len(jobs), time() - t_submit, max(opts.workers, 1), sum([r["prepare"] for r in results]),
+                                    sum([r["submit"] for r in results])))
         if njobs:
-            # done submitting, now do bulk update
-            res = post("%s/jobstatusBulk/" % DAMPE_WORKFLOW_URL, 
+            # done submitting, now do bulk update (incl. batch ids)
+            t_update = time()
+            res = post("/jobstatusBulk/", 
                        data={"data":dumps(data),"status":"Submitted","minor_status":"WaitingForExecution"})
             res.raise_for_status()
             res = res.json()
@@ -118,9 +203,12 @@ def main(args=None):
                 print 'ERROR: {error}'.format(error=res.get("error","n/a"))
                 return
             #log.info("updated %i jobs", int(res.get("njobs",0)))
-            print 'INFO: {msg}'.format(msg="updated %i jobs"%int(res.get("njobs",0)))
+            print 'INFO: {msg}'.format(msg="updated %i jobs (%1.2f s)"%(int(res.get("njobs",0)), time() - t_update))
     #log.info("cycle completed, submitted %i new jobs", njobs)
     print "INFO: {msg}".format(msg = "cycle completed, submitted %i new jobs" % njobs)
+    for key, m in sorted(getClient().stats().iteritems()):
+        print "INFO: {msg}".format(msg = "%s: %i requests, %i retries, mean %1.3f s, max %1.3f s" % (key, m["requests"], m["retries"],
+                                                                                                   m["mean_time"], m["max_time"]))
 
 if __name__ == "__main__":
     main()
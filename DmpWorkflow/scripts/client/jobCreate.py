@@ -4,11 +4,11 @@ Created on Mar 30, 2016
 @author: zimmer
 @brief: prototype script to create a new job from the jobXml
 """
-from requests import post
+from DmpWorkflow.utils.client import post
 from os import environ
 from os.path import isfile
 from argparse import ArgumentParser
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL, TYPES, SITES
+from DmpWorkflow.config.defaults import TYPES, SITES
 from DmpWorkflow.utils.tools import parseJobXmlToDict
 
 
@@ -50,7 +50,7 @@ def createJob(args=None):
           "n_instances": n_instances, "site": site,"depends": dependent_tasks}
     if comment is not None:
         data['comment']=comment
-    res = post("%s/job/" % DAMPE_WORKFLOW_URL,data,files={"file": open(xmlFile, "rb")})
+    res = post("/job/", data=data, files={"file": open(xmlFile, "rb")})
     res.raise_for_status()
     if res.json().get("result", "nok") == "ok":
         print 'Added job %s with %i instances' % (taskName, n_instances)
@@ -75,7 +75,7 @@ def createJobInstance(args=None):
     taskName = opts.name
     environ['DWF_JOBNAME'] = taskName
     ninst = opts.inst
-    res = post("%s/jobInstances/" % DAMPE_WORKFLOW_URL,
+    res = post("/jobInstances/",
                data={"taskname": taskName, "tasktype": opts.tasktype, "n_instances": ninst, "instanceId": opts.instanceId,
                      "override_dict": str(override_dict)})
     res.raise_for_status()
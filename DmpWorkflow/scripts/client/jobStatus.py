@@ -2,13 +2,10 @@
 Created on Mar 15, 2016
 @author: zimmer
 """
-from requests import post
-from requests.exceptions import HTTPError
+from DmpWorkflow.utils.client import post
 from json import dumps
 from sys import exit as sys_exit
 from argparse import ArgumentParser
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL
-from DmpWorkflow.utils.tools import sleep
 
 def main(args=None):
     usage = "Usage: %(prog)s JobID InstanceID status [options]"
@@ -30,19 +27,13 @@ def main(args=None):
     natts = my_dict.get("retry",3)
     if 'retry' in my_dict: my_dict.pop("retry")
     res = None
-    counter = 0
-    while (natts >= counter) and (res is None):
-        try:
-            res = post("%s/jobstatus/" % DAMPE_WORKFLOW_URL, data={"args": dumps(my_dict)}, timeout=30.)
-            res.raise_for_status()
-        except HTTPError as err:
-            counter+=1
-            slt = 60*counter
-            print err
-            print '%i/%i: could not complete request, sleeping %i seconds and retrying again'%(counter, natts, slt)
-            sleep(slt)
-            res = None
-    if res is None and natts == counter:
+    try:
+        res = post("/jobstatus/", data={"args": dumps(my_dict)}, timeout=30., retries=natts)
+        res.raise_for_status()
+    except Exception as err:
+        print err
+        res = None
+    if res is None:
         print 'exiting process'
         sys_exit(0)
     else:
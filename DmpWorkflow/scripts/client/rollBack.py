@@ -3,11 +3,9 @@ Created on Mar 15, 2016
 
 @author: zimmer
 """
-from requests import get as Rget, post
-from json import dumps
+from DmpWorkflow.utils.client import post
 from sys import exit as sys_exit
 from argparse import ArgumentParser
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL
 from DmpWorkflow.utils.tools import query_yes_no
 
 
@@ -35,46 +33,36 @@ def main(args=None):
         if not q:
             print 'rollback aborted'
             sys_exit()
-    if not (opts.n_min is None and opts.n_max is None):
-        _range = opts.n_max - opts.n_min
-        if _range > 100: print 'WARNING: you are querying more than 100 jobs, this may take a while to complete'
     override_dict = {"InputFiles": [], "OutputFiles": [], "MetaData": []}
     if opts.set_var is not None:
         var_dict = dict({tuple(val.split("=")) for val in opts.set_var.split(";")})
         override_dict['MetaData'] = [{"name": k, "value": v, "var_type": "string"} for k, v in var_dict.iteritems()]
-    my_dict = {}
-    for key in opts.__dict__:
+    # the selection is applied on the server, which resets all matching instances with a single update.
+    my_dict = {"title": opts.title, "type": opts.type, "stat": opts.stat}
+    for key in ["inst", "n_min", "n_max"]:
         if opts.__dict__[key] is not None:
             my_dict[key] = opts.__dict__[key]
-    if 'set_var' in my_dict: del my_dict['set_var']
-    # get all jobs to roll back.
-    res = Rget("%s/jobstatus/" % DAMPE_WORKFLOW_URL, data=my_dict)
+    res = post("/rollback/bulk/", data=dict(my_dict, dry="True"))
     res.raise_for_status()
     res = res.json()
     if res.get("result", "nok") != "ok":
         print "error %s" % res.get("error")
-    jobs = res.get("jobs")
-    if len(jobs):
-        print 'found %i jobs that satisfy query conditions.' % len(jobs)
-        if query_yes_no("continue rolling back %i instances?" % len(jobs)):
-            for j in jobs:
-                my_dict = {"t_id": j['jobId'], "inst_id": j['instanceId'],
-                           "major_status": "New", "minor_status": "AwaitingBatchSubmission", "hostname": None,
-                           "batchId": None, "status_history": [], "body": str(override_dict),
-                           "log": "", "cpu": [], "memory": [], "created_at": "Now"}
-                res = post("%s/jobstatus/" % DAMPE_WORKFLOW_URL, data={"args": dumps(my_dict)})
-                res.raise_for_status()
-                res = res.json()
-                if not res.get("result", "nok") == "ok":
-                    print ("error resetting instance %s" % res.get("error"))
-            print 'rolled back %i instances' % len(jobs)
-        else:
-            print 'rollback aborted'
-            sys_exit()
-    else:
+        sys_exit()
+    njobs = int(res.get("njobs", 0))
+    if not njobs:
         print 'could not find any jobs satisfying the query.'
         sys_exit()
-
+    print 'found %i jobs that satisfy query conditions.' % njobs
+    if not query_yes_no("continue rolling back %i instances?" % njobs):
+        print 'rollback aborted'
+        sys_exit()
+    res = post("/rollback/bulk/", data=dict(my_dict, body=str(override_dict)))
+    res.raise_for_status()
+    res = res.json()
+    if not res.get("result", "nok") == "ok":
+        print "error rolling back instances %s" % res.get("error")
+        sys_exit()
+    print 'rolled back %i instances' % int(res.get("njobs", 0))
 
 if __name__ == '__main__':
     main()
@@ -5,12 +5,13 @@ Created on Mar 15, 2016
 @todo: add watchdog triggers.
 """
 import logging
-from requests import post
+from DmpWorkflow.utils.client import post
 from importlib import import_module
 from json import dumps
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL, BATCH_DEFAULTS, FINAL_STATII
+from DmpWorkflow.config.defaults import BATCH_DEFAULTS, FINAL_STATII
 
 HPC = import_module("DmpWorkflow.hpc.%s" % BATCH_DEFAULTS['system'])
+CHUNK_SIZE = 1000
 
 
 def main():
@@ -18,16 +19,21 @@ def main():
     site = BATCH_DEFAULTS['name']
     batchEngine = HPC.BatchEngine()
     batchEngine.update()
+    records = []
+    batchIds = []
     for batchId, job_dict in batchEngine.allJobs.iteritems():
         # print batchId, job_dict
         hostname = job_dict.get("EXEC_HOST", "None")
         JobId = "None"
         InstanceId = "None"
+        if batchEngine.isArrayPlaceholder(batchId):
+            log.debug("skipping pending array %s", str(batchId))
+            continue
         try:
-            JobId, InstanceId = job_dict['JOB_NAME'].split("-")
+            JobId, InstanceId = batchEngine.getJobName(batchId).split("-")
         except Exception as err:
             if hostname == "None":
-                log.error("trapped exception for job %s (%s)", str(batchId), str(job_dict['JOB_NAME']))
+                log.error("trapped exception for job %s (%s)", str(batchId), str(job_dict.get(batchEngine.name_key)))
                 log.debug(err)
                 continue
         status = "Unknown"
@@ -40,12 +46,24 @@ def main():
         my_dict = {"t_id": JobId, "inst_id": InstanceId, "hostname": hostname,
                    "major_status": status, "cpu": cpu, "memory": mem, "site": site}
         log.debug("%s : %s", batchId, my_dict)
-        res = post("%s/jobstatus/" % DAMPE_WORKFLOW_URL, data={"args": dumps(my_dict)})
+        records.append(my_dict)
+        batchIds.append(batchId)
+    # send the updates in chunks, the server applies each chunk with a single bulk write
+    for start in xrange(0, len(records), CHUNK_SIZE):
+        chunk = records[start:start + CHUNK_SIZE]
+        res = post("/jobstatus/batch/", data={"data": dumps(chunk)})
         res.raise_for_status()
         res = res.json()
         if not res.get("result", "nok") == "ok":
-            log.error("error updating %i %s", int(batchId), res.get("error"))
-    log.info("completed cycle")
+            log.error("error updating chunk of %i records: %s", len(chunk), res.get("error"))
+            continue
+        for i, result in enumerate(res.get("results", [])):
+            if not result.get("result", "nok") == "ok":
+                log.error("error updating %s %s", str(batchIds[start + i]), result.get("error"))
+    log.info("completed cycle, sent %i records", len(records))
+    removed = batchEngine.cleanArrays()
+    if removed:
+        log.info("removed %i directories of finished array jobs", removed)
 
 
 if __name__ == '__main__':
@@ -5,12 +5,12 @@ Created on Mar 15, 2016
 @author: zimmer
 @brief: watchdog that kills the job if needed.
 """
-from requests import get as Rget, post
+from DmpWorkflow.utils.client import get as Rget, post
 from importlib import import_module
 from json import dumps
 from logging import getLogger
 from argparse import ArgumentParser
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL, BATCH_DEFAULTS, FINAL_STATII, cfg
+from DmpWorkflow.config.defaults import BATCH_DEFAULTS, FINAL_STATII, cfg
 from DmpWorkflow.utils.tools import getSixDigits, convertHHMMtoSec
 HPC = import_module("DmpWorkflow.hpc.%s" % BATCH_DEFAULTS['system'])
 from warnings import warn, simplefilter
@@ -19,7 +19,7 @@ simplefilter('always', DeprecationWarning)
 def __getRunningJobs(batchsite):
     """ internal method to get running jobs """
     log = getLogger("script")
-    res = Rget("%s/watchdog/" % DAMPE_WORKFLOW_URL, data={"site": str(batchsite)})
+    res = Rget("/watchdog/", data={"site": str(batchsite)})
     res.raise_for_status()
     res = res.json()
     if not res.get("result", "nok") == "ok":
@@ -53,7 +53,7 @@ def __updateStatus(args, batchEngine=None, dry=True):
         return
     log.debug("about to call update with this data %s", my_dict)
     if not dry:
-        res = post("%s/jobstatus/" % DAMPE_WORKFLOW_URL, data={"args": dumps(my_dict)})
+        res = post("/jobstatus/", data={"args": dumps(my_dict)})
         res.raise_for_status()
         res = res.json()
         if res.get("result", "nok") != "ok":
@@ -67,7 +67,7 @@ def __reportKilledJob(j):
     log = getLogger("script")
     my_dict = {'t_id': j['t_id'], 'inst_id': j['inst_id'],
                'major_status': 'Terminated', 'minor_status': "KilledByWatchDog"}
-    res = post("%s/jobstatus/" % DAMPE_WORKFLOW_URL, data={"args": dumps(my_dict)})
+    res = post("/jobstatus/", data={"args": dumps(my_dict)})
     res.raise_for_status()
     res = res.json()
     if res.get("result", "nok") != "ok":
@@ -107,7 +107,7 @@ def main(args=None):
         if max_mem in [-1., 0.]:
             max_mem = float(BATCH_DEFAULTS['memory'])
         bj = HPC.BatchJob(name="%s-%s" % (j['t_id'], getSixDigits(j['inst_id'])),
-                          batchId=j['batchId'], defaults=BATCH_DEFAULTS)
+                          batchId=batchEngine.elementId(j['batchId'], j.get('batchIndex', None)), defaults=BATCH_DEFAULTS)
         bid = str(bj.batchId)
         if bid in batchEngine.allJobs:
             current_cpu = batchEngine.getCPUtime(bid)
@@ -32,7 +32,10 @@ class PayloadExecutor(object):
             self.logThis("PILOT MODE: waiting for new jobs to be run inside queue")
         self.debug = debug
         self.batchId = getenv(HPC.BATCH_ID_ENV, "-1")
-        if "." in self.batchId:
+        if getenv("DWF_BATCH_ID", ""):
+            # element of an array job, the server stores the id of the array & the index.
+            self.batchId = getenv("DWF_BATCH_ID")
+        elif "." in self.batchId:
             res = findall("\d+", self.batchId)
             if len(res):
                 self.batchId = int(res[0])
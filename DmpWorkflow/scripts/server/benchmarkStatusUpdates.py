@@ -0,0 +1,67 @@
+"""
+@brief: compares the bytes sent to the DB per status update, full document save vs. atomic $set/$push,
+        with --write also the time of the writes, measured on a scratch collection of the configured DB.
+"""
+from argparse import ArgumentParser
+from bson import BSON, ObjectId
+from datetime import datetime, timedelta
+from time import time
+from DmpWorkflow.core.models import statusUpdateDocument, JobInstance
+
+heartbeat = {"t_id": "dummy", "inst_id": 1, "major_status": "Running", "minor_status": "Running",
+             "hostname": "node001", "cpu": 3600., "memory": 1024.}
+
+
+def makeInstance(nupdates):
+    """ mock-up of a JobInstance document that received nupdates heartbeats """
+    t0 = datetime.now() - timedelta(seconds=60 * nupdates)
+    ts = [t0 + timedelta(seconds=60 * i) for i in xrange(nupdates)]
+    return {"_id": ObjectId(), "_cls": "JobInstance", "job": ObjectId(), "instanceId": 1, "body": str({"InputFiles": [], "OutputFiles": [], "MetaData": []}),
+            "site": "local", "batchId": 123456, "Nevents": 0, "hostname": "node001", "status": "Running", "minor_status": "Running",
+            "created_at": t0, "last_update": ts[-1], "cpu_max": 86400., "mem_max": 4096., "log": "",
+            "status_history": [{"status": "Running", "minor_status": "Running", "update": t} for t in ts[0:nupdates / 10]],
+            "cpu": [{"time": t, "value": float(i)} for i, t in enumerate(ts)],
+            "memory": [{"time": t, "value": 1024.} for t in ts]}
+
+
+def timeWrites(coll, doc, nsaves, repeat):
+    """ returns the mean time [s] of one status update written as nsaves full saves and as one atomic update """
+    coll.replace_one({"_id": doc["_id"]}, doc, upsert=True)
+    start = time()
+    for _ in xrange(repeat):
+        for _ in xrange(nsaves):
+            coll.replace_one({"_id": doc["_id"]}, doc)
+    full = (time() - start) / repeat
+    start = time()
+    for _ in xrange(repeat):
+        coll.update_one({"_id": doc["_id"]}, statusUpdateDocument(doc, heartbeat))
+    return full, (time() - start) / repeat
+
+
+def main(args=None):
+    parser = ArgumentParser(usage="Usage: %(prog)s [options]", description="benchmark the DB writes of a status update")
+    parser.add_argument('-w','--write',action='store_true',dest='write',help='also time the writes on a scratch collection of the DB')
+    parser.add_argument('-r','--repeat',type=int,default=20,dest='repeat',help='number of updates timed per document size')
+    opts = parser.parse_args(args)
+    # the old JobInstance.set saved the full document once per key (status, hostname, cpu, memory)
+    nsaves = 4
+    coll = JobInstance._get_db()["benchmark_status_updates"] if opts.write else None
+    header = '%10s %20s %20s %10s' % ("#updates", "full save [bytes]", "atomic [bytes]", "ratio")
+    print header + (' %16s %16s' % ("full save [ms]", "atomic [ms]") if opts.write else '')
+    try:
+        for nupdates in [1, 10, 100, 1000, 5000]:
+            doc = makeInstance(nupdates)
+            full = nsaves * len(BSON.encode(doc))
+            atomic = len(BSON.encode(statusUpdateDocument(doc, heartbeat)))
+            row = '%10i %20i %20i %10.1f' % (nupdates, full, atomic, float(full) / float(atomic))
+            if opts.write:
+                row += ' %16.2f %16.2f' % tuple([1e3 * t for t in timeWrites(coll, doc, nsaves, opts.repeat)])
+            print row
+    finally:
+        if coll is not None:
+            coll.drop()
+    print 'test done'
+
+
+if __name__ == '__main__':
+    main()
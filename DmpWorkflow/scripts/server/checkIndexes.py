@@ -0,0 +1,63 @@
+'''
+@brief: runs explain() on the canonical JobInstance queries of the server and reports collection scans.
+'''
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from bson import ObjectId
+from DmpWorkflow.core.models import JobInstance, Job
+from DmpWorkflow.scripts.server.removeDuplicates import findDuplicates
+
+
+def canonicalQueries(job_id, site):
+    """ returns list of (description, queryset) with the query shapes used by the server """
+    now = datetime.now()
+    return [("getInstance/setStatus (job, instanceId)", JobInstance.objects.filter(job=job_id, instanceId=1)),
+            ("aggregateStatii (job, status)", JobInstance.objects.filter(job=job_id, status="Done")),
+            ("NewJobs (status, site, job__in)", JobInstance.objects.filter(status="New", site=site, job__in=[job_id])),
+            ("reaper (status, last_update)", JobInstance.objects.filter(status="Running", last_update__lte=now - timedelta(hours=6))),
+            ("PilotView (last_update, isPilot)", JobInstance.objects.filter(last_update__gte=now - timedelta(days=1), isPilot=True)),
+            ("SetJobStatus (pilotReference)", JobInstance.objects.filter(pilotReference=ObjectId())),
+            ("ClaimNewJobs (lease)", JobInstance.objects.filter(lease="dummy", status="New"))]
+
+
+def findStages(plan):
+    """ returns all stage names in a (nested) query plan """
+    stages = [plan.get("stage", "UNKNOWN")]
+    if "inputStage" in plan:
+        stages += findStages(plan["inputStage"])
+    for stage in plan.get("inputStages", []):
+        stages += findStages(stage)
+    return stages
+
+
+def main(args=None):
+    parser = ArgumentParser(usage="Usage: %(prog)s [options]", description="check that the server queries are covered by indexes")
+    parser.add_argument('-c','--create',action='store_true',dest='create',help='create missing indexes (in the background) before running the checks')
+    opts = parser.parse_args(args)
+    if opts.create:
+        # the unique (job, instanceId) index can't be built while duplicates exist.
+        if next(findDuplicates(JobInstance._get_collection()), None) is not None:
+            print 'found duplicate instances, run dampe-server-remove-duplicates first'
+            return
+        print 'creating indexes in the background, this may take a while on large collections'
+        JobInstance.ensure_indexes()
+    print 'indexes found on collection: %s'%", ".join(sorted(JobInstance._get_collection().index_information().keys()))
+    job = Job.objects.only("id", "execution_site").first()
+    job_id = job.id if job is not None else ObjectId()
+    site = job.execution_site if job is not None else "local"
+    nscans = 0
+    for description, query in canonicalQueries(job_id, site):
+        plan = query.explain()["queryPlanner"]["winningPlan"]
+        stages = findStages(plan)
+        status = "OK"
+        if "COLLSCAN" in stages:
+            status = "COLLSCAN"
+            nscans += 1
+        print '%-45s %-10s %s'%(description, status, " <- ".join(stages))
+    if nscans:
+        print 'found %i queries without index support, run with --create'%nscans
+    else:
+        print 'all queries are covered by indexes'
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,6 @@ Created on Dec 8, 2016
 from yaml import load as yload
 from os import getpid
 from os.path import isfile, join as pjoin
-from datetime import datetime
 from tqdm import tqdm
 from json import loads
 from time import sleep
@@ -15,7 +14,7 @@ from copy import deepcopy
 from argparse import ArgumentParser
 from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_ROOT
 from DmpWorkflow.utils.tools import send_heartbeat
-from DmpWorkflow.core.models import JobInstance, Job
+from DmpWorkflow.core.models import JobInstance, Job, rollbackDocument
 
 
 def yaml_load(fi):
@@ -38,20 +37,7 @@ def main(args=None):
     parser.add_argument('-d','--dry',action='store_true',dest='dry',help='do not reap but show what you would reap (dry-run)')
     opts = parser.parse_args(args)
     
-    update_dict  =  {
-                        "created_at"    : datetime.now(),
-                        "last_update"   : datetime.now(),
-                        "batchId"       : None,
-                        "Nevents"       : 0,
-                        "hostname"      : None,
-                        "status"        : "New",
-                        "minor_status"  : "AwaitingBatchSubmission",
-                        "status_history": [],
-                        "memory"        : [],
-                        "cpu"           : [],
-                        "pilotReference": None,
-                        "log"           : ""
-                    }
+    update_dict = rollbackDocument()
     cfg_default_path=pjoin(DAMPE_WORKFLOW_ROOT,"config/pilot.yaml")
     if opts.cfg is None:
         opts.cfg = cfg_default_path
@@ -100,11 +86,10 @@ def main(args=None):
                         for key in [u'instanceId', u'created_at', u'_cls', u'_id']:
                             if key in blueprint_js: blueprint_js.pop(key)
                         blueprint_js.update(update_dict)
-                        pilotInstances = [JobInstance(**blueprint_js)] * pilots_to_fill
-                        for p in pilotInstances:
+                        for i in xrange(pilots_to_fill):
+                            p = JobInstance(**blueprint_js)
                             p.setAsPilot(True)
                             pilot.addInstance(p)
-                        pilot.save()
         ## done loop
         print 'sleeping for pre-determined time {sleep}...'.format(sleep=cfg['global']['sleeptime'])
         sleep(cfg['global']['sleeptime'])
@@ -7,7 +7,7 @@ Created on Aug 23, 2016
 from argparse import ArgumentParser
 from DmpWorkflow.config.defaults import SITES as batchSites
 from DmpWorkflow.config.defaults import MAJOR_STATII as statii
-from DmpWorkflow.core.models import JobInstance
+from DmpWorkflow.core.models import StatusCounter
 from sys import exit as sys_exit
 from traceback import print_exc
 from pprint import PrettyPrinter
@@ -43,8 +43,8 @@ def main(args=None):
     json_bdy = []
     for site in batchSites:
         status_dict = {key: 0 for key in statii}
-        stats = JobInstance.objects.filter(site=site).item_frequencies("status")
-        status_dict.update(stats)
+        stats = StatusCounter.totals({"site": site})
+        status_dict.update({key: total[0] for key, total in stats.iteritems()})
         for stat, freq in status_dict.iteritems():
             json_bdy.append(__makeEntry__(stat, site, freq))
     print 'found %i measurements to add'%len(json_bdy)
@@ -0,0 +1,40 @@
+"""
+@brief: server-side script to backfill the per-job instanceId counters from the existing instances
+        and to empty the (no longer maintained) jobInstances lists of the jobs.
+"""
+from argparse import ArgumentParser
+from pymongo import UpdateOne
+from DmpWorkflow.core.models import Job, JobInstance, InstanceCounter
+
+
+def lastInstanceIds(coll):
+    """ yields (job id, largest instanceId) for all jobs that have instances """
+    pipeline = [{"$group": {"_id": "$job", "last": {"$max": "$instanceId"}}}]
+    for item in coll.aggregate(pipeline, allowDiskUse=True):
+        if item["_id"] is None or item["last"] is None: continue
+        yield item["_id"], int(item["last"])
+
+
+def main(args=None):
+    parser = ArgumentParser(usage="Usage: %(prog)s [options]", description="backfill instanceId counters of all jobs")
+    parser.add_argument('-d','--dry',action='store_true',dest='dry',help='do not write but show how many counters would be set (dry-run)')
+    parser.add_argument('-c','--chunk',type=int,default=1000,dest='chunk',help='number of counters written per query')
+    parser.add_argument('-k','--keep-lists',action='store_true',dest='keep',help='do not empty the jobInstances lists of the jobs')
+    opts = parser.parse_args(args)
+    counters = InstanceCounter._get_collection()
+    # $max: counters that are ahead already (instances created since) are left alone.
+    ops = [UpdateOne({"_id": job}, {"$max": {"last": last}}, upsert=True) for job, last in lastInstanceIds(JobInstance._get_collection())]
+    print 'found %i jobs with instances' % len(ops)
+    if opts.dry:
+        return
+    for start in xrange(0, len(ops), opts.chunk):
+        counters.bulk_write(ops[start:start + opts.chunk], ordered=False)
+    print 'backfilled %i counters' % len(ops)
+    if not opts.keep:
+        res = Job._get_collection().update_many({"jobInstances.0": {"$exists": True}}, {"$set": {"jobInstances": []}})
+        print 'emptied jobInstances of %i jobs' % res.modified_count
+    print 'done'
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,7 @@ from argparse import ArgumentParser
 from os.path import isfile
 from DmpWorkflow.config.defaults import SITES as batchSites
 from DmpWorkflow.config.defaults import MAJOR_STATII as statii
-from DmpWorkflow.core.models import JobInstance
+from DmpWorkflow.core.models import StatusCounter
 from datetime import datetime
 from json import dumps, loads
 
@@ -25,8 +25,8 @@ def main(args=None):
     ts = datetime.now()
     for site in batchSites:
         status_dict = {key: 0 for key in statii}
-        stats = JobInstance.objects.filter(site=site).item_frequencies("status")
-        status_dict.update(stats)
+        stats = StatusCounter.totals({"site": site})
+        status_dict.update({key: total[0] for key, total in stats.iteritems()})
         out[site].append({"time": ts.isoformat(), "statii": status_dict})
     fout.write(dumps(out))
     fout.close()
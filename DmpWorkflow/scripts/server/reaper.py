@@ -5,7 +5,7 @@ Created on Oct 4, 2016
 @brief: reaper, kills instances whose last update has been too long ago.
 '''
 from argparse import ArgumentParser
-from DmpWorkflow.core.models import JobInstance
+from DmpWorkflow.core.models import JobInstance, updateInstances
 from DmpWorkflow.utils.tools import send_heartbeat
 from DmpWorkflow.config.defaults import DAMPE_VERSION
 from datetime import datetime, timedelta
@@ -24,7 +24,8 @@ def main(args=None):
         return
     print 'found %i instances to potentially reap'%clen
     if not opts.dry:
-        res=query.update(status="Terminated",minor_status="KilledByReaper")
+        res = updateInstances({"status": "Running", "last_update": {"$lte": past}},
+                              {"status": "Terminated", "minor_status": "KilledByReaper"})
         print 'reaped %i instances'%res
 
 if __name__ == "__main__":
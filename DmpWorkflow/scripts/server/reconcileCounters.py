@@ -0,0 +1,33 @@
+"""
+@brief: server-side script to recount the instances per (job, site, status) and to repair the StatusCounters that drifted,
+        run it periodically (like the reaper), a full run also marks the counters as seeded
+        (otherwise the server counts all instances once when it first reads the counters).
+"""
+from argparse import ArgumentParser
+from DmpWorkflow.core.models import Job, StatusCounter, StatusCounterSeed
+from DmpWorkflow.utils.tools import send_heartbeat
+from DmpWorkflow.config.defaults import DAMPE_VERSION
+
+
+def main(args=None):
+    parser = ArgumentParser(usage="Usage: %(prog)s [options]", description="reconcile status counters with the instances")
+    parser.add_argument('-d','--dry',action='store_true',dest='dry',help='do not repair but show which counters differ (dry-run)')
+    parser.add_argument('-t','--title',type=str,default=None,dest='title',help='only reconcile the job(s) with this title')
+    parser.add_argument('-v','--verbose',action='store_true',dest='verbose',help='print every counter that differs')
+    opts = parser.parse_args(args)
+    send_heartbeat("CounterReconciliation", DAMPE_VERSION)
+    job_ids = None
+    if opts.title is not None:
+        job_ids = list(Job.objects.filter(title=opts.title).scalar("id"))
+    diffs = StatusCounter.reconcile(job_ids=job_ids, dry=opts.dry)
+    if job_ids is None and not opts.dry:
+        StatusCounterSeed(id="seeded").save()
+    if opts.verbose:
+        for key, stored, counted in sorted(diffs):
+            print '%s %-10s %-12s count: %i -> %i nevents: %i -> %i' % (key[0], key[1], key[2], stored[0], counted[0],
+                                                                        stored[1], counted[1])
+    print '%s %i status counters' % ("found" if opts.dry else "corrected", len(diffs))
+
+
+if __name__ == "__main__":
+    main()
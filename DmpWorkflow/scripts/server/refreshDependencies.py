@@ -0,0 +1,26 @@
+"""
+@brief: server-side script to recompute the dependencies_met flag of the New instances of all jobs with dependencies,
+        needed once for instances created before the flag existed (they count as claimable otherwise).
+"""
+from argparse import ArgumentParser
+from DmpWorkflow.core.models import Job
+
+
+def main(args=None):
+    parser = ArgumentParser(usage="Usage: %(prog)s [options]", description="recompute dependencies_met of New instances")
+    parser.add_argument('-d','--dry',action='store_true',dest='dry',help='do not write but show which jobs would be refreshed (dry-run)')
+    parser.add_argument('-t','--title',type=str,default=None,dest='title',help='only refresh the job(s) with this title')
+    opts = parser.parse_args(args)
+    query = Job.objects.filter(dependencies__not__size=0)
+    if opts.title is not None:
+        query = query.filter(title=opts.title)
+    for job in query:
+        if opts.dry:
+            print 'would refresh %s (%s)' % (job.title, job.type)
+            continue
+        print '%s (%s): %i New instances claimable' % (job.title, job.type, job.refreshDependencies())
+    print 'done'
+
+
+if __name__ == "__main__":
+    main()
@@ -2,50 +2,53 @@
 Created on May 18, 2016
 
 @author: zimmer
-@brief: server-side script to remove duplicate jobInstances.
-@fixme: need to implement atomic queries.
+@brief: server-side script to remove duplicate jobInstances,
+        i.e. instances sharing the same (job, instanceId), and to enforce uniqueness with an index afterwards.
+        with --heartbeats (--datafiles), the same is done for heartbeats sharing the same (hostname, process)
+        (data catalog entries sharing the same (filename, site)).
 """
-import progressbar
-from DmpWorkflow.core.models import JobInstance
+from argparse import ArgumentParser
+from DmpWorkflow.core.models import JobInstance, HeartBeat, DataFile, StatusCounter
 
 
-def main():
-    print Warning("This script is very slow, consider using alternatives")
-    try:
-        from DmpWorkflow.core import db
-        db.connect()
-    except Exception as err:
-        import sys
-        print 'could not import DB, is this configuration a server setup?'
-        print 'ERROR: %s' % err
-        sys.exit(0)
-    instances = JobInstance.objects.all()
-    print 'found %i instances' % len(instances)
-    pb = progressbar.ProgressBar(maxval=len(instances))
+def findDuplicates(coll, keys=("job", "instanceId"), newest="last_update"):
+    """ yields the _ids of all documents to remove, for each combination of keys the one with the largest newest is kept. """
+    pipeline = [{"$sort": {newest: -1}},
+                {"$group": {"_id": {key: "$%s" % key for key in keys},
+                            "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+                {"$match": {"count": {"$gt": 1}}}]
+    for group in coll.aggregate(pipeline, allowDiskUse=True):
+        for _id in group["ids"][1:]:
+            yield _id
 
-    duplicates = []
-    good_instances = []
-    pb.start()
-    for i, inst in enumerate(instances):
-        if inst.instanceId in good_instances:
-            duplicates.append(inst)
-        else:
-            good_instances.append(inst.instanceId)
-        pb.update(i + 1)
-    pb.finish()
+
+def main(args=None):
+    parser = ArgumentParser(usage="Usage: %(prog)s [options]", description="remove duplicate instances & create unique index")
+    parser.add_argument('-d','--dry',action='store_true',dest='dry',help='do not remove but show how many duplicates exist (dry-run)')
+    parser.add_argument('-c','--chunk',type=int,default=10000,dest='chunk',help='number of instances removed per query')
+    parser.add_argument('--heartbeats',action='store_true',dest='heartbeats',help='remove duplicate heartbeats instead of instances')
+    parser.add_argument('--datafiles',action='store_true',dest='datafiles',help='remove duplicate data catalog entries instead of instances')
+    opts = parser.parse_args(args)
+    model, keys, newest = JobInstance, ("job", "instanceId"), "last_update"
+    if opts.heartbeats:
+        model, keys, newest = HeartBeat, ("hostname", "process"), "timestamp"
+    elif opts.datafiles:
+        model, keys, newest = DataFile, ("filename", "site"), "created_at"
+    # raw collection, _get_collection() would try to build the unique index before the duplicates are gone.
+    coll = model._get_db()[model._get_collection_name()]
+    duplicates = list(findDuplicates(coll, keys=keys, newest=newest))
     print 'found %i duplicates' % len(duplicates)
-    if len(duplicates):
-        print 'removing...'
-        pb = progressbar.ProgressBar(maxval=len(duplicates))
-        pb.start()
-    for i, inst in enumerate(duplicates):
-        # do cleanup
-        ref_instance = inst.job.getInstance(inst.instanceId)
-        if ref_instance.id != inst.id:
-            # print inst.instanceId
-            inst.delete()
-        pb.update(i + 1)
-    pb.finish()
+    if opts.dry:
+        return
+    removed = 0
+    for start in xrange(0, len(duplicates), opts.chunk):
+        res = coll.delete_many({"_id": {"$in": duplicates[start:start + opts.chunk]}})
+        removed += res.deleted_count
+    print 'removed %i duplicates' % removed
+    if model is JobInstance:
+        print 'corrected %i status counters' % len(StatusCounter.reconcile())
+    # from now on, the DB rejects any duplicate
+    model.ensure_indexes()
     print 'done'
 
 
@@ -5,7 +5,7 @@ Created on Nov 24, 2016
 @brief: remove orphaned instances
 '''
 from argparse import ArgumentParser
-from DmpWorkflow.core.models import JobInstance, Job
+from DmpWorkflow.core.models import JobInstance, Job, StatusCounter
 
 def main(args=None):
     parser = ArgumentParser(usage="Usage: %(prog)s [options]", description="reap instances which have not send any heartbeat")
@@ -20,6 +20,7 @@ def main(args=None):
     if not opts.dry:
         res = query.delete()
         print 'reaped %i instances'%res
+        print 'corrected %i status counters'%len(StatusCounter.reconcile())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
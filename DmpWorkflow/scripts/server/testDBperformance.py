@@ -10,12 +10,12 @@ number = 10  # 10 executions per command
 
 # first let's do a check how long it takes to retrieve the total number of events per job
 
-header = "from DmpWorkflow.core.models import Job, JobInstance; jobs = Job.objects.all();"
-tests = ['Query nEvents', 'Query Instances']
-slow_way = ["jobs[0].getNevents();", "len(jobs[0].jobInstances);"]
+header = "from DmpWorkflow.core.models import Job, JobInstance, InstanceCounter; jobs = Job.objects.all();"
+tests = ['Query nEvents', 'Query last instanceId']
+slow_way = ["jobs[0].getNevents();", 'JobInstance.objects.filter(job=jobs[0]).order_by("-instanceId").first();']
 
 fast_way = ['JobInstance.objects.filter(job=jobs[0]).aggregate_sum("Nevents");',
-            'JobInstance.objects.filter(job=jobs[0]).count();']
+            'InstanceCounter.objects.filter(id=jobs[0].id).first();']
 
 print 'testing - patience'
 for i in xrange(len(slow_way)):
@@ -0,0 +1,114 @@
+'''
+@brief: compares the throughput of the scheduler output parsers with the former dictionary-based ones,
+        the recorded dumps in test/scheduler are replicated to the requested number of jobs.
+'''
+from argparse import ArgumentParser
+from copy import deepcopy
+from cStringIO import StringIO
+from os.path import dirname, abspath, join as oPjoin
+from sys import getsizeof
+from time import time
+from DmpWorkflow.hpc import lsf, slurm, condor, pbs
+from DmpWorkflow.hpc.batch import parseQstatXml
+
+DUMPS = oPjoin(dirname(abspath(__file__)), "scheduler")
+
+
+def replicate(fname, njobs, nheader, footer=0):
+    """ returns the dump with its job lines repeated until there are njobs, job ids are made unique """
+    lines = open(oPjoin(DUMPS, fname)).read().split("\n")
+    footer += 1  # trailing newline
+    head, rows, tail = lines[0:nheader], [l for l in lines[nheader:len(lines) - footer] if len(l.strip())], lines[len(lines) - footer:]
+    out = list(head)
+    for i in xrange(njobs):
+        fields = rows[i % len(rows)].split(None, 1)
+        out.append("%i%s %s" % (1000000 + i, ".0" if fname.startswith("condor") else "", fields[1]))
+    return "\n".join(out + tail)
+
+
+def replicateXml(njobs):
+    data = open(oPjoin(DUMPS, "qstat.xml")).read()
+    head, body = data.split("<Data>")
+    jobs = ["<Job>%s" % j for j in body.replace("</Data>", "").split("<Job>") if len(j.strip())]
+    out = [jobs[i % len(jobs)].replace(">88420", ">%i" % i, 1) for i in xrange(njobs)]
+    return "%s<Data>%s</Data>\n" % (head, "".join(out))
+
+
+def legacyBjobs(output, keys=lsf.KEYS):
+    jobs = {}
+    for i, line in enumerate(output.split("\n")):
+        if i > 0:
+            this_line = line.split(" ")
+            jobID = this_line[0]
+            this_line.remove(this_line[0])
+            while "" in this_line:
+                this_line.remove("")
+            this_job = dict(zip(keys, this_line))
+            if len(this_job):
+                jobs[jobID] = this_job
+    return jobs
+
+
+def legacyTable(output, keys, nheader):
+    jobs = {}
+    for job in output.split("\n")[nheader:-1]:
+        thisDict = dict(zip(keys, job.split()))
+        if "id" in thisDict:
+            try:
+                jobs[int(float(thisDict['id']))] = deepcopy(thisDict)
+            except ValueError:
+                pass
+    return jobs
+
+
+def legacyQstat(output, status_map, filterUser=None):
+    from xmltodict import parse
+    jobs = {}
+    for j in parse(output)["Data"]["Job"]:
+        usr = j.get("Job_Owner", "None").split("@")[0]
+        if filterUser is not None and usr != filterUser: continue
+        stat = j.get("job_state", "U").lower()
+        if stat not in status_map: stat = 'u'
+        cpu = mem = None
+        res = j.get("resources_used", "None")
+        if res != "None":
+            mem = float(res.get("mem", "0kb").rsplit("kb")[0])
+            cpu = res.get("cput", "00:00:00.000")
+        jobs[j.get("Job_Id", "None").split(".")[0]] = {"USER": usr, "MEM": mem, "CPU_USED": cpu, "JOB_NAME": "None-None",
+                                                      "STAT": stat, "EXEC_HOST": j.get("exec_host")}
+    return jobs
+
+
+def measure(func, *args):
+    """ returns time needed to parse, number of jobs and the memory held by the job containers """
+    t0 = time()
+    jobs = func(*args)
+    return time() - t0, len(jobs), sum([getsizeof(job) for job in jobs.itervalues()])
+
+
+def main(args=None):
+    parser = ArgumentParser(usage="Usage: %(prog)s [options]", description="benchmark scheduler output parsers")
+    parser.add_argument('-n', '--njobs', type=int, default=50000, dest='njobs', help='number of jobs in the queue')
+    opts = parser.parse_args(args)
+    bjobs = replicate("bjobs.txt", opts.njobs, 1)
+    squeue = replicate("squeue.txt", opts.njobs, 1)
+    condor_q = replicate("condor_q.txt", opts.njobs, 4, footer=2)
+    qstat = replicateXml(opts.njobs)
+    cases = [("lsf (bjobs -Wa)", (legacyBjobs, bjobs), (lambda o: dict(lsf.parseBjobs(StringIO(o))), bjobs)),
+             ("slurm (squeue)", (legacyTable, squeue, slurm.KEYS, 1), (lambda o: dict(slurm.parseSqueue(StringIO(o))), squeue)),
+             ("condor (condor_q)", (legacyTable, condor_q, condor.KEYS, 4), (lambda o: dict(condor.parseCondorQ(StringIO(o))), condor_q)),
+             ("sge/pbs (qstat -x)", (legacyQstat, qstat, pbs.BatchEngine.status_map),
+              (lambda o: dict(parseQstatXml(StringIO(o), pbs.Record, pbs.BatchEngine.status_map)), qstat))]
+    print 'parsing %i jobs per scheduler' % opts.njobs
+    print '%-20s %8s %8s %11s %11s %9s %15s %15s' % ("scheduler", "legacy", "stream", "legacy [s]", "stream [s]",
+                                                      "speed-up", "legacy [bytes]", "stream [bytes]")
+    for name, legacy, stream in cases:
+        t_legacy, n_legacy, m_legacy = measure(*legacy)
+        t_stream, n_stream, m_stream = measure(*stream)
+        print '%-20s %8i %8i %11.3f %11.3f %9.1f %15i %15i' % (name, n_legacy, n_stream, t_legacy, t_stream,
+                                                               t_legacy / max(t_stream, 1e-6), m_legacy, m_stream)
+    print 'test done'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+@brief: small process-wide caches used on the server side.
+"""
+from collections import OrderedDict
+from threading import RLock
+from time import time
+
+
+class LRUCache(object):
+    """ bounded, thread-safe least-recently-used cache which keeps track of hits & misses,
+        if ttl (seconds) is positive, entries older than ttl are treated as misses. 
+    """
+
+    def __init__(self, maxsize=128, ttl=0.):
+        self.maxsize = int(maxsize)
+        self.ttl = float(ttl)
+        self.hits = 0
+        self.misses = 0
+        self.__data = OrderedDict()
+        self.__lock = RLock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            if key not in self.__data:
+                self.misses += 1
+                return default
+            value, expires = self.__data.pop(key)
+            if expires is not None and expires < time():
+                self.misses += 1
+                return default
+            # re-insert to mark as most recently used
+            self.__data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time() + self.ttl if self.ttl > 0 else None
+        with self.__lock:
+            if key in self.__data:
+                self.__data.pop(key)
+            self.__data[key] = (value, expires)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.__lock:
+            self.__data.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return key in self.__data
+
+    def stats(self):
+        """ returns dictionary with size & hit/miss counters """
+        total = self.hits + self.misses
+        ratio = float(self.hits) / float(total) if total else 0.
+        return {"size": len(self.__data), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses, "hit_ratio": ratio}
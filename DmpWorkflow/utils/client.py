@@ -0,0 +1,132 @@
+"""
+@brief: shared HTTP session used by all client-side interactions with the workflow server,
+        keeps connections alive, retries with exponential backoff & jitter, fails over between servers
+        and keeps track of request timings.
+"""
+import logging
+from os import getpid
+from random import uniform
+from threading import Lock
+from time import time, sleep
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout, HTTPError
+from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URLS, cfg
+
+log = logging.getLogger("script")
+
+# status codes that are worth retrying, anything else is returned to the caller right away.
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+class Client(object):
+    """ keep-alive session over a list of server urls, requests are sent to the current url,
+        if it can't be reached (or answers with a RETRY_STATUS) the next one is tried.
+    """
+
+    def __init__(self, urls=None, retries=None, backoff=None, max_backoff=None, timeout=None, pool_size=None):
+        self.urls = list(urls if urls is not None else DAMPE_WORKFLOW_URLS)
+        if not len(self.urls):
+            raise Exception("no server url configured")
+        self.retries = int(retries if retries is not None else cfg.get("server", "client_retries"))
+        self.backoff = float(backoff if backoff is not None else cfg.get("server", "client_backoff"))
+        self.max_backoff = float(max_backoff if max_backoff is not None else cfg.get("server", "client_max_backoff"))
+        self.timeout = float(timeout if timeout is not None else cfg.get("server", "client_timeout"))
+        pool_size = int(pool_size if pool_size is not None else cfg.get("server", "client_pool_size"))
+        self.current = 0
+        self.metrics = {}
+        self.__lock = Lock()
+        self.session = Session()
+        adapter = HTTPAdapter(pool_connections=len(self.urls), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @property
+    def url(self):
+        return self.urls[self.current]
+
+    def __failover__(self):
+        with self.__lock:
+            self.current = (self.current + 1) % len(self.urls)
+        if len(self.urls) > 1:
+            log.warning("failing over to %s", self.url)
+
+    def __delay__(self, attempt, backoff=None):
+        """ exponential backoff with jitter: uniformly distributed in [delay/2, delay] """
+        delay = min(self.max_backoff, (self.backoff if backoff is None else backoff) * 2 ** attempt)
+        return uniform(delay / 2., delay)
+
+    def __record__(self, key, elapsed, failed=False, retried=False):
+        with self.__lock:
+            m = self.metrics.setdefault(key, {"requests": 0, "failures": 0, "retries": 0, "total_time": 0., "max_time": 0.})
+            m["requests"] += 1
+            m["total_time"] += elapsed
+            m["max_time"] = max(m["max_time"], elapsed)
+            if failed: m["failures"] += 1
+            if retried: m["retries"] += 1
+
+    def request(self, method, path, retries=None, timeout=None, backoff=None, **kwargs):
+        """ sends the request to path (e.g. /jobstatus/) on the current server,
+            backoff (seconds) overrides client_backoff for this request, raises the last error if all attempts failed.
+        """
+        retries = self.retries if retries is None else int(retries)
+        kwargs["timeout"] = self.timeout if timeout is None else timeout
+        key = "%s %s" % (method.upper(), path)
+        attempt = 0
+        while True:
+            start = time()
+            try:
+                res = self.session.request(method, "%s%s" % (self.url, path), **kwargs)
+                if res.status_code in RETRY_STATUS:
+                    res.raise_for_status()
+                self.__record__(key, time() - start, retried=attempt > 0)
+                return res
+            except (ConnectionError, Timeout, HTTPError) as err:
+                self.__record__(key, time() - start, failed=True, retried=attempt > 0)
+                if attempt >= retries:
+                    log.error("%s failed after %i attempts: %s", key, attempt + 1, err)
+                    raise
+                slt = self.__delay__(attempt, backoff=backoff)
+                attempt += 1
+                log.warning("%i/%i: %s on %s failed (%s), retrying in %1.1f seconds", attempt, retries, key, self.url, err, slt)
+                self.__failover__()
+                sleep(slt)
+
+    def get(self, path, **kwargs):
+        return self.request("get", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("post", path, **kwargs)
+
+    def stats(self):
+        """ returns dictionary with number of requests, failures, retries & timings per endpoint """
+        with self.__lock:
+            out = {}
+            for key, m in self.metrics.iteritems():
+                out[key] = dict(m)
+                out[key]["mean_time"] = m["total_time"] / float(m["requests"]) if m["requests"] else 0.
+            return out
+
+    def logStats(self):
+        for key, m in sorted(self.stats().iteritems()):
+            log.info("%s: %i requests, %i failures, %i retries, mean %1.3f s, max %1.3f s",
+                     key, m["requests"], m["failures"], m["retries"], m["mean_time"], m["max_time"])
+
+
+__client = {"pid": None, "client": None}
+
+
+def getClient():
+    """ returns the client of this process (a forked process gets its own session) """
+    if __client["pid"] != getpid():
+        __client["client"] = Client()
+        __client["pid"] = getpid()
+    return __client["client"]
+
+
+def get(path, **kwargs):
+    return getClient().get(path, **kwargs)
+
+
+def post(path, **kwargs):
+    return getClient().post(path, **kwargs)
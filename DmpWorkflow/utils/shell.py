@@ -5,49 +5,126 @@ Created on Mar 22, 2016
 """
 import logging
 from subprocess import PIPE, Popen
-from select import poll as spoll, POLLIN, POLLHUP
+from select import poll as spoll, POLLIN, POLLHUP, POLLERR
 from tempfile import NamedTemporaryFile
-from os import chmod, stat, environ, remove
+from os import chmod, stat, environ, remove, read as os_read, O_NONBLOCK
 from os.path import expandvars
+from fcntl import fcntl, F_GETFL, F_SETFL
+from errno import EAGAIN, EINTR
+from time import time, sleep
 
 logger = logging.getLogger("core")
+CHUNK_SIZE = 65536
 
-def run(cmd_args, useLogging=True, suppressErrors=False, interleaved=True, suppressLevel=False):
-    # inspired from http://tinyurl.com/hslhjfe (StackOverflow)
+
+def __splitLines(pending, chunk):
+    """ appends chunk to the pending bytes, returns the complete lines (without newline) """
+    pending.extend(chunk)
+    end = pending.rfind("\n")
+    if end < 0:
+        return []
+    lines = str(pending[0:end]).split("\n")
+    del pending[0:end + 1]
+    return lines
+
+
+def run(cmd_args, useLogging=True, suppressErrors=False, interleaved=True, suppressLevel=False,
+        timeout=None, maxBytes=None, callback=None, walltime=False):
+    """ runs cmd_args (list), returns output, error & return code (& the wall time in seconds if walltime is True).
+        stdout & stderr are read in non-blocking chunks of up to CHUNK_SIZE bytes as soon as they are available.
+        timeout: kill the process after this many seconds, maxBytes: kill it once it has written more than that
+        to stdout (or stderr), the output read so far is returned with a negative return code in both cases.
+        callback(line, stream) is called for each line, stream being 'stdout' or 'stderr'.
+    """
     if not isinstance(cmd_args, list):
         raise RuntimeError('must be list to be called')
     if useLogging: logger.info("attempting to run: %s", str(cmd_args))
-    args = [[], []]  # first is output, second is errors
-    tsk = Popen(cmd_args, stdout=PIPE, stderr=PIPE)
+    start = time()
+    tsk = Popen(cmd_args, stdout=PIPE, stderr=PIPE, close_fds=True)
+    streams = {tsk.stdout.fileno(): "stdout", tsk.stderr.fileno(): "stderr"}
+    data = {"stdout": bytearray(), "stderr": bytearray()}
+    pending = {"stdout": bytearray(), "stderr": bytearray()}
+    args = [[], []]  # first is output, second is errors, only used if lines need to be processed.
+    byLine = useLogging or interleaved or callback is not None or not suppressLevel
+
+    def processLines(name, lines):
+        for val in lines:
+            if callback is not None:
+                callback(val, name)
+            if name == "stdout":
+                if useLogging: logger.info(val)
+                args[0].append(val if suppressLevel else "INFO: %s" % val)
+            elif not suppressErrors:
+                args[1].append(val)
+                if useLogging: logger.error(val)
+                if interleaved:
+                    args[0].append(val if suppressLevel else "*ERROR*: %s" % val)
+
     poll = spoll()
-    poll.register(tsk.stdout, POLLIN | POLLHUP)
-    poll.register(tsk.stderr, POLLIN | POLLHUP)
-    pollc = 2
-    events = poll.poll()
-    while pollc > 0 and len(events) > 0:
-        for rfd, event in events:
-            if event & POLLIN:
-                if rfd == tsk.stdout.fileno():
-                    if len(tsk.stdout.readline())>0:
-                        val = str(tsk.stdout.readline()[:-1])
-                        if useLogging:
-                            logger.info(val)
-                        args[0].append(val if suppressLevel else "INFO: %s" % val)
-                if rfd == tsk.stderr.fileno():
-                    if len(tsk.stderr.readline()) > 0:
-                        if suppressErrors: continue
-                        args[1].append(tsk.stderr.readline()[:-1])
-                        val = args[1][-1]
-                        if useLogging:
-                            logger.error(val)
-                        if interleaved:
-                            args[0].append(val if suppressLevel else "*ERROR*: %s" % val)
-            if event & POLLHUP:
-                poll.unregister(rfd)
-                pollc -= 1
-            if pollc > 0:
-                events = poll.poll()
-    return "\n".join(args[0]), "\n".join(args[1]), tsk.wait()
+    for fd in streams:
+        fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | O_NONBLOCK)
+        poll.register(fd, POLLIN | POLLHUP | POLLERR)
+    killed = None
+    while len(streams) and killed is None:
+        wait = None
+        if timeout is not None:
+            wait = timeout - (time() - start)
+            if wait <= 0.:
+                killed = "timeout of %1.1f s reached" % timeout
+                break
+        try:
+            events = poll.poll(None if wait is None else wait * 1000.)
+        except Exception as err:
+            if getattr(err, "errno", err.args[0]) == EINTR: continue
+            raise
+        for fd, event in events:
+            name = streams[fd]
+            try:
+                chunk = os_read(fd, CHUNK_SIZE)
+            except OSError as err:
+                if err.errno in (EAGAIN, EINTR): continue
+                raise
+            if not chunk:
+                # EOF, the process closed the stream
+                poll.unregister(fd)
+                del streams[fd]
+                continue
+            if maxBytes is not None and len(data[name]) + len(chunk) > maxBytes:
+                chunk = chunk[0:max(0, maxBytes - len(data[name]))]
+                killed = "more than %i bytes written to %s" % (maxBytes, name)
+            data[name].extend(chunk)
+            if byLine:
+                processLines(name, __splitLines(pending[name], chunk))
+    if killed is None and timeout is not None:
+        # the process may have closed its streams but still be running, the timeout holds for it as well.
+        delay = 0.001
+        while tsk.poll() is None:
+            wait = timeout - (time() - start)
+            if wait <= 0.:
+                killed = "timeout of %1.1f s reached" % timeout
+                break
+            sleep(min(delay, wait))
+            delay = min(delay * 2, 0.1)
+    if killed is not None:
+        logger.error("killing %s: %s", str(cmd_args), killed)
+        tsk.kill()
+    rc = tsk.wait()
+    tsk.stdout.close()
+    tsk.stderr.close()
+    elapsed = time() - start
+    logger.debug("%s finished with rc %i after %1.3f s", str(cmd_args), rc, elapsed)
+    if byLine:
+        for name in ("stdout", "stderr"):
+            if len(pending[name]):
+                processLines(name, [str(pending[name])])
+        output, error = "\n".join(args[0]), "\n".join(args[1])
+    else:
+        output, error = str(data["stdout"]), "" if suppressErrors else str(data["stderr"])
+        if output.endswith("\n"): output = output[0:-1]
+        if error.endswith("\n"): error = error[0:-1]
+    if walltime:
+        return output, error, rc, elapsed
+    return output, error, rc
 
 
 def run_cached(cmd_args, cachedir="/tmp"):
@@ -3,19 +3,18 @@ Created on Mar 25, 2016
 
 @author: zimmer
 """
-from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL
+from DmpWorkflow.config.defaults import DAMPE_WORKFLOW_URL, cfg
 try:
     from requests import get as r_get
     import logging
     import shutil
     from DmpWorkflow.utils.shell import run
     from os import makedirs, environ, utime
-    from os.path import exists, expandvars, dirname
+    from os.path import exists, expandvars, dirname, getsize, isfile
     from sys import stdout
     from random import choice, randint
     from shlex import split as shlex_split
     from string import ascii_letters, digits
-    import subprocess as sub
     from time import mktime, sleep as time_sleep
     from re import split as re_split
     from datetime import timedelta, datetime
@@ -54,7 +53,7 @@ def updateJobStatus(**kwargs):
 
         returns an S_OK dictionary with "result" (ok/nok) and "error" which defaults to None
     """
-    from requests import post
+    from DmpWorkflow.utils.client import post
     my_dict = {}
     for key in ['t_id','inst_id','retry','major_status','minor_status','hostname','batchId']:
         val = kwargs.get(key,None)
@@ -65,19 +64,14 @@ def updateJobStatus(**kwargs):
     if 'retry' in my_dict: my_dict.pop("retry")
     if 'timeout' in my_dict: my_dict.pop("timeout")
     res = None
-    counter = 0
-    while (natts >= counter) and (res is None):
-        try:
-            res = post("%s/jobstatus/" % DAMPE_WORKFLOW_URL, data={"args": dumps(my_dict)}, timeout=tout)
-            res.raise_for_status()
-        except Exception as err:
-            counter+=1
-            slt = 60*counter
-            print err
-            print '%i/%i: could not complete request, sleeping %i seconds and retrying again'%(counter, natts, slt)
-            sleep(slt)
-            res = None
-    if res is None and natts == counter:
+    try:
+        res = post("/jobstatus/", data={"args": dumps(my_dict)}, timeout=tout, retries=natts,
+                   backoff=float(cfg.get("server", "client_status_backoff")))
+        res.raise_for_status()
+    except Exception as err:
+        print err
+        res = None
+    if res is None:
         return S_OK("nok",error="failed to connect to server %s"%DAMPE_WORKFLOW_URL)
     else:
         res = res.json()
@@ -98,22 +92,46 @@ def send_heartbeat(proc,version=None):
           - proc: name of process, e.g. JobFetcher
           - version: None (version of process)
     """
-    from requests import post as r_post
+    from DmpWorkflow.utils.client import post as r_post
     if version is None:
         from DmpWorkflow import version as SW_VERSION
         version = SW_VERSION
         
     from socket import getfqdn as gethostname # use full domain name.
     host = gethostname()
-    url = "%s/testDB/"%DAMPE_WORKFLOW_URL
     dt = datetime.now()
-    res = r_post(url, data={"hostname":host, "timestamp":dt,"process":proc, "version":version})
+    res = r_post("/testDB/", data={"hostname":host, "timestamp":dt,"process":proc, "version":version})
     res.raise_for_status()
     res = res.json()
     if res.get("result","nok") != "ok":
         print res.get("error")
     return
 
+def datacat_record(filename, site, filetype="root", checksum=False):
+    """ returns the data catalog record of filename, size (and md5 checksum) are added if the file is found locally """
+    record = {"filename": filename, "site": site, "filetype": filetype}
+    if isfile(filename):
+        record["size"] = getsize(filename)
+        if checksum: record["checksum"] = md5sum(filename)
+    return record
+
+def register_files(records, overwrite=False, chunk=None):
+    """ 
+        registers a list of data catalog records (see datacat_record) through /datacat/bulk/,
+        <chunk> files per request (default: datacat_chunk in settings.cfg), returns the per-file results.
+    """
+    from DmpWorkflow.utils.client import post as r_post
+    chunk = int(cfg.get("site", "datacat_chunk")) if chunk is None else int(chunk)
+    results = []
+    for start in xrange(0, len(records), chunk):
+        res = r_post("/datacat/bulk/", data={"data": dumps(records[start:start + chunk]), "overwrite": str(overwrite)})
+        res.raise_for_status()
+        res = res.json()
+        if res.get("result", "nok") != "ok":
+            raise Exception(res.get("error", "No error provided."))
+        results += res.get("results", [])
+    return results
+
 def sortTimeStampList(my_list, timestamp='time', reverse=False):
     if not len(my_list):
         return []
@@ -275,6 +293,7 @@ def safe_copy(infile, outfile, **kwargs):
     kwargs.setdefault('checksum', False)
     kwargs.setdefault("checksum_blocksize", 4096)
     kwargs.setdefault('mkdir',False)
+    kwargs.setdefault('timeout', None)
     if infile.startswith("url:"):
         download_file(infile,outfile,attempts=kwargs['attempts'],debug=kwargs['debug'], sleep = kwargs['sleep'])
     sleep = parse_sleep(kwargs['sleep'])
@@ -301,7 +320,11 @@ def safe_copy(infile, outfile, **kwargs):
     while i < kwargs['attempts']:
         if kwargs['debug'] and i > 0:
             print "Attempting to copy file..."
-        status = sub.call(shlex_split(cmnd))
+        # a hanging transfer is killed after timeout seconds (if set) and counts as failed attempt
+        output, error, status = run(shlex_split(cmnd), useLogging=False, interleaved=False, suppressLevel=True,
+                                    timeout=kwargs['timeout'])
+        if kwargs['debug'] and len(output):
+            print output
         if status == 0:
             if kwargs['checksum'] and not xrootd:
                 md5out = md5sum(outfile, blocksize=kwargs['checksum_blocksize'])
@@ -311,7 +334,7 @@ def safe_copy(infile, outfile, **kwargs):
                 print '%i - copy successful but checksum does not match, try again in 5s'%i
                 time_sleep(5)
         else:
-            print "%i - Copy failed; sleep %ss" % (i, sleep)
+            print "%i - Copy failed (%s); sleep %ss" % (i, error, sleep)
             time_sleep(sleep)
         i += 1
     raise IOError("Failed to copy file")